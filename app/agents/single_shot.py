@@ -0,0 +1,278 @@
+"""
+Single-shot trip engine.
+
+The graph engine sends four prompts with overlapping context (the same
+preferences every time, the itinerary again for activities). Here all the
+LLM-backed sections come from one structured-output call against
+TripPlanDraft, while the Serper link lookup runs alongside it.
+
+Parsing is forgiving: the response is streamed through the incremental
+JSON repair parser, so fenced, truncated or partially invalid JSON is
+recovered field by field, even when the call runs out of time. Sections
+still missing afterwards are filled by the per-section tools, and if nothing
+usable comes back the whole plan falls back to the graph engine.
+
+Like the graph, the engine reads and fills the per-section tools' cache
+entries, so cached sections are not generated again (with at most one
+section missing, its tool is cheaper than the whole call). The plan runs
+under the request deadline, and a section filled by a tool keeps the
+tool's status, so stale or mock data is reported as such.
+"""
+
+import asyncio
+import json
+import logging
+from typing import Any, Dict, Optional
+
+from app.schemas.trip_schema import TripPlanDraft
+from app.services.deadlines import node_timeout, request_deadline
+from app.services.llm_client import message_text
+from app.services.metrics import ERRORS, STRUCTURED_PARSES, UPSTREAM_SECONDS, timed
+from app.services.rate_limit import limited
+from app.services.section_cache import get_section_cache
+from app.services.structured_output import IncrementalJSONParser
+from app.services.token_usage import record_usage
+from app.tools import all_tools
+
+logger = logging.getLogger(__name__)
+
+LLM_SECTIONS = list(TripPlanDraft.model_fields)
+
+# Section -> the tool whose cache entry holds it and that tool's cache inputs.
+# Itinerary first, the activities key reads it
+_CACHE_ENTRIES = {
+    "itinerary": ("generate_itinerary", all_tools._itinerary_inputs),
+    "weather_forecast": ("weather_forecaster", all_tools._weather_inputs),
+    "food_culture_info": ("food_culture_recommender", all_tools._food_inputs),
+    "activity_suggestions": ("recommend_activities", all_tools._activities_inputs),
+}
+# Section -> graph node, for the per-section timeouts of the tools
+_NODES = {
+    "itinerary": "generate_itinerary",
+    "weather_forecast": "weather",
+    "activity_suggestions": "activities",
+    "food_culture_info": "food",
+}
+
+
+def _prompt(preferences: Dict[str, Any]) -> str:
+    from langchain_core.output_parsers import PydanticOutputParser
+
+    parser = PydanticOutputParser(pydantic_object=TripPlanDraft)
+    return f"""
+        You are planning a trip with these preferences:
+        {json.dumps(preferences)}
+
+        Produce every section below in one response:
+        - itinerary: a detailed itinerary with sections for each day, dining options, and downtime.
+        - weather_forecast: a detailed weather forecast for the destination in that month,
+          including temperature, precipitation, and advice for travelers.
+        - activity_suggestions: unique local activities that fit the itinerary,
+          in bullet points for each day.
+        - food_culture_info: popular local dishes and dining options for the budget, then
+          cultural norms and etiquette, with 'Food & Dining' and 'Culture & Etiquette' sections.
+
+        {parser.get_format_instructions()}
+        """
+
+
+def _parsed_sections(parser: IncrementalJSONParser) -> Dict[str, str]:
+    """
+    Sections from the output fed to `parser` so far. Code fences, trailing
+    commas and truncated JSON are tolerated (a field cut off mid-string is
+    dropped); fields that are missing, empty or not strings are left out
+    rather than failing the whole parse.
+    """
+    data = parser.snapshot()
+    if not isinstance(data, dict):
+        STRUCTURED_PARSES.labels(schema="TripPlanDraft", outcome="failed").inc()
+        return {}
+    STRUCTURED_PARSES.labels(schema="TripPlanDraft", outcome="repaired" if parser.repaired else "clean").inc()
+
+    return {
+        section: data[section].strip()
+        for section in LLM_SECTIONS
+        if isinstance(data.get(section), str) and data[section].strip()
+    }
+
+
+def parse_sections(text: str) -> Dict[str, str]:
+    """Recover whatever sections can be read from the complete model output"""
+    parser = IncrementalJSONParser()
+    parser.feed(text)
+    return _parsed_sections(parser)
+
+
+def _earliest(loop: asyncio.AbstractEventLoop, budget: Optional[float], deadline: Optional[float]):
+    times = [t for t in (loop.time() + budget if budget is not None else None, deadline) if t is not None]
+    return min(times) if times else None
+
+
+async def _cached_sections(user_state: Dict[str, Any]) -> Dict[str, str]:
+    """LLM sections already in the section cache under their tool's key"""
+    cached: Dict[str, str] = {}
+    try:
+        cache = get_section_cache()
+        for section, (tool_name, inputs) in _CACHE_ENTRIES.items():
+            if section == "activity_suggestions" and "itinerary" not in cached:
+                # Keyed on the itinerary, which is about to be generated
+                continue
+            hit, value = await cache.aget(tool_name, cache.make_key(tool_name, inputs({**user_state, **cached})))
+            if hit:
+                cached[section] = value
+    except Exception as e:
+        logger.warning("Section cache lookup failed: %s", e)
+    return cached
+
+
+async def _cache_generated(user_state: Dict[str, Any], sections: Dict[str, str], generated: Dict[str, str]) -> None:
+    """Store generated sections where the per-section tools look for them"""
+    try:
+        cache = get_section_cache()
+        state = {**user_state, **sections}
+        for section in generated:
+            tool_name, inputs = _CACHE_ENTRIES[section]
+            await cache.aset(cache.make_key(tool_name, inputs(state)), generated[section])
+    except Exception as e:
+        logger.warning("Section cache write failed: %s", e)
+
+
+async def _generate(preferences: Dict[str, Any], deadline: Optional[float]) -> Dict[str, str]:
+    """
+    Every LLM section from one structured call, bounded by its
+    TRIP_NODE_TIMEOUT_SINGLE_SHOT budget and the request deadline; streamed
+    into an incremental parser, so a call cut off still yields the sections
+    that were complete by then
+    """
+    parser = IncrementalJSONParser()
+    try:
+        llm = all_tools.get_llm("single_shot")
+        messages = all_tools._human(_prompt(preferences))
+
+        async def generate():
+            from langchain_core.messages import AIMessage
+            from langchain_core.messages.ai import add_usage
+
+            text, usage = [], None
+            try:
+                async for chunk in llm.astream(messages):
+                    chunk_text = message_text(chunk)
+                    parser.feed(chunk_text)
+                    text.append(chunk_text)
+                    if chunk.usage_metadata:
+                        usage = add_usage(usage, chunk.usage_metadata)
+            finally:
+                # A stream cut off by its budget was still paid for up to there
+                if text:
+                    record_usage("single_shot", messages, AIMessage(content="".join(text), usage_metadata=usage))
+
+        loop = asyncio.get_running_loop()
+        with timed(UPSTREAM_SECONDS, "gemini", provider="gemini", operation="single_shot"):
+            async with asyncio.timeout_at(_earliest(loop, node_timeout("single_shot"), deadline)):
+                await limited("gemini", all_tools._model_name(llm), generate)
+        return _parsed_sections(parser)
+    except TimeoutError:
+        ERRORS.labels(component="timeout_single_shot").inc()
+        logger.warning("Single-shot call ran out of time")
+        return _parsed_sections(parser)
+    except Exception as e:
+        ERRORS.labels(component="single_shot").inc()
+        logger.error("Error in single-shot generation: %s", e)
+        return {}
+
+
+async def _fill_missing(state: Dict[str, Any], sections: Dict[str, str], statuses: Dict[str, str]) -> None:
+    """
+    Run the per-section tools for anything still missing, each under its node
+    timeout. Every section is written into `sections` and `statuses` as soon
+    as its tool returns, so a deadline keeps the ones that made it.
+    """
+    def store(key: str, result: Dict[str, Any]) -> None:
+        sections[key] = result.get(key, "")
+        statuses[key] = all_tools.tool_status(result)
+
+    async def run(key: str, tool, tool_state: Dict[str, Any]) -> None:
+        try:
+            async with asyncio.timeout(node_timeout(_NODES[key])):
+                result = await tool(tool_state)
+        except TimeoutError:
+            ERRORS.labels(component=f"timeout_{_NODES[key]}").inc()
+            statuses[key] = "timeout"
+            return
+        store(key, result)
+
+    independent = {
+        "weather_forecast": all_tools.aweather_forecaster,
+        "food_culture_info": all_tools.afood_culture_recommender,
+    }
+
+    async def itinerary_then_activities():
+        if "itinerary" not in sections:
+            await run("itinerary", all_tools.agenerate_itinerary, state)
+        if "activity_suggestions" not in sections and "itinerary" in sections:
+            await run("activity_suggestions", all_tools.arecommend_activities,
+                      {**state, "itinerary": sections["itinerary"]})
+
+    await asyncio.gather(
+        itinerary_then_activities(),
+        *[run(key, tool, state) for key, tool in independent.items() if key not in sections],
+    )
+
+
+async def arun_single_shot(user_state: Dict[str, Any], fallback) -> Dict[str, Any]:
+    """
+    Produce the same final state as the graph engine, under the request
+    deadline. `fallback` is awaited with the initial state and
+    `deadline=` what is left of the budget (event loop time) when nothing is
+    cached and the structured call yields nothing usable.
+    """
+    if not all_tools.llm_available():
+        # Mock data mode has no round trips to save
+        return await fallback(user_state)
+
+    loop = asyncio.get_running_loop()
+    deadline = _earliest(loop, request_deadline(), None)
+    preferences = user_state.get("preferences", {})
+    links_task = asyncio.create_task(all_tools.afetch_useful_links(user_state))
+    sections = await _cached_sections(user_state)
+    statuses = {section: "ok" for section in sections}
+    links: Dict[str, Any] = {}
+    try:
+        missing = [section for section in LLM_SECTIONS if section not in sections]
+        if len(missing) > 1:
+            generated = await _generate(preferences, deadline)
+            if not generated and not sections:
+                logger.warning("Single-shot output unusable, falling back to the graph engine")
+                links_task.cancel()
+                return await fallback(user_state, deadline=deadline)
+            if "itinerary" in sections:
+                # Written for the call's own itinerary, not the cached one
+                generated.pop("activity_suggestions", None)
+            generated = {section: value for section, value in generated.items() if section in missing}
+            sections.update(generated)
+            statuses.update({section: "ok" for section in generated})
+            await _cache_generated(user_state, sections, generated)
+
+        try:
+            async with asyncio.timeout_at(deadline):
+                if len(sections) < len(LLM_SECTIONS):
+                    missing = [section for section in LLM_SECTIONS if section not in sections]
+                    logger.info("Single-shot plan missing %s, filling per section", missing)
+                    await _fill_missing(user_state, sections, statuses)
+                links = await links_task
+        except TimeoutError:
+            ERRORS.labels(component="request_deadline").inc()
+            logger.warning("Single-shot plan hit the %ss request deadline", request_deadline())
+    finally:
+        if not links_task.done():
+            links_task.cancel()
+
+    for section in LLM_SECTIONS:
+        statuses.setdefault(section, "timeout")
+    statuses["useful_links"] = all_tools.tool_status(links) if links else "timeout"
+    return {
+        **user_state,
+        **sections,
+        "useful_links": links.get("useful_links", []),
+        "section_status": statuses,
+    }
@@ -1,16 +1,76 @@
-# Fix 1: Update your trip_agent.py with proper state management
+"""
+Graph trip engine.
 
-from langgraph.graph import StateGraph, END
-from typing import Dict, Any, TypedDict
-from IPython.display import Image, display
+Each section is a LangGraph node around its tool. The nodes run in
+parallel from the start, except activities, which waits for the itinerary
+it builds on (NODE_DEPENDENCIES). Every node reports its
+section's status (ok, timeout, or how the tool degraded) into
+section_status, so a plan with a failed section is still served.
+
+A request for some sections runs only their nodes and what they depend on,
+each subset compiled once. Runs with a request_id or job id are
+checkpointed (see app/services/checkpoints.py), so a retry resumes them.
+The whole run is bounded by the request deadline, each node by its own
+timeout.
+"""
+
+# LangGraph and LangChain are imported inside the builder so importing this
+# module stays cheap and side-effect free; the graph compiles on first use
+# (or in the FastAPI lifespan, see app.main)
+import asyncio
+import logging
+import threading
+from typing import Annotated, AsyncIterator, Callable, Dict, Any, FrozenSet, Iterable, Optional, Tuple, TypedDict
+from app.services.deadlines import node_timeout, request_deadline
+from app.services.metrics import ERRORS, NODE_SECONDS, timed
 from app.tools.all_tools import (
     recommend_activities,
     weather_forecaster,
     generate_itinerary,
     fetch_useful_links,
     food_culture_recommender,
+    arecommend_activities,
+    aweather_forecaster,
+    agenerate_itinerary,
+    afetch_useful_links,
+    afood_culture_recommender,
+    tool_status,
 )
 
+logger = logging.getLogger(__name__)
+
+# Node name -> the state key (and TripResponse field) it produces
+SECTION_KEYS = {
+    "generate_itinerary": "itinerary",
+    "weather": "weather_forecast",
+    "activities": "activity_suggestions",
+    "links": "useful_links",
+    "food": "food_culture_info",
+}
+NODE_FOR_SECTION = {section: node for node, section in SECTION_KEYS.items()}
+
+# Node -> the nodes whose output it reads
+NODE_DEPENDENCIES = {
+    "activities": ["generate_itinerary"],
+}
+
+# Preference field -> the nodes whose prompt (and cache key) reads it, see
+# the _*_inputs functions in app.tools.all_tools. Nodes downstream of these
+# are invalidated through NODE_DEPENDENCIES.
+PREFERENCE_DEPENDENCIES = {
+    "destination": ["generate_itinerary", "weather", "activities", "links", "food"],
+    "month": ["generate_itinerary", "weather", "activities", "links"],
+    "budget_type": ["generate_itinerary", "activities", "food"],
+    "travelStyle": ["generate_itinerary", "activities"],
+    "interests": ["generate_itinerary", "activities"],
+}
+
+
+def _merge_status(left: Dict[str, str], right: Dict[str, str]) -> Dict[str, str]:
+    """Reducer so parallel nodes can each report their own section status"""
+    return {**(left or {}), **(right or {})}
+
+
 class TripState(TypedDict):
     """
     Trip state holds all the data throughout the workflow
@@ -21,89 +81,294 @@ class TripState(TypedDict):
     activity_suggestions: str
     useful_links: list
     food_culture_info: str
+    # section key -> ok | stale | mock | error | timeout
+    section_status: Annotated[Dict[str, str], _merge_status]
 
 
-def node_generate_itinerary(state: TripState) -> Dict[str, Any]:
-    """Generate itinerary and return state update"""
-    print("DEBUG: Running node_generate_itinerary")
-    result = generate_itinerary(state)
-    print(f"DEBUG: generate_itinerary returned: {result}")
-    
-    # Return the state update - this is crucial!
-    return {
-        "itinerary": result.get("itinerary", ""),
-        # Keep existing state
-        **{k: v for k, v in state.items() if k != "itinerary"}
-    }
+def _make_node(name: str, key: str, default: Any, tool, atool):
+    """
+    Wrap a sync/async tool pair as a graph node. ainvoke drives the async tool
+    so the event loop is never blocked, invoke still works for scripts.
+    Only the key the node owns is returned - parallel branches write to the
+    same state, so echoing the whole state back would conflict on merge.
+    """
+    def update(result: Dict[str, Any]) -> Dict[str, Any]:
+        return {key: result.get(key, default), "section_status": {key: tool_status(result)}}
 
-def node_weather(state: TripState) -> Dict[str, Any]:
-    """Get weather forecast and return state update"""
-    print("DEBUG: Running node_weather")
-    result = weather_forecaster(state)
-    print(f"DEBUG: weather_forecaster returned: {result}")
-    
-    return {
-        "weather_forecast": result.get("weather_forecast", ""),
-        **{k: v for k, v in state.items() if k != "weather_forecast"}
-    }
+    def done(state: TripState) -> bool:
+        # Produced by an earlier attempt of a checkpointed run, see arun_trip_agent
+        return (state.get("section_status") or {}).get(key) == "ok"
 
-def node_activities(state: TripState) -> Dict[str, Any]:
-    """Get activity suggestions and return state update"""
-    print("DEBUG: Running node_activities")
-    result = recommend_activities(state)
-    print(f"DEBUG: recommend_activities returned: {result}")
-    
-    return {
-        "activity_suggestions": result.get("activity_suggestions", ""),
-        **{k: v for k, v in state.items() if k != "activity_suggestions"}
-    }
+    def node(state: TripState) -> Dict[str, Any]:
+        if done(state):
+            return {}
+        logger.debug("Running node_%s", name)
+        with timed(NODE_SECONDS, f"node_{name}", node=name):
+            result = tool(state)
+        logger.debug("%s returned: %s", tool.__name__, result)
+        return update(result)
 
-def node_links(state: TripState) -> Dict[str, Any]:
-    """Fetch useful links and return state update"""
-    print("DEBUG: Running node_links")
-    result = fetch_useful_links(state)
-    print(f"DEBUG: fetch_useful_links returned: {result}")
-    
-    return {
-        "useful_links": result.get("useful_links", []),
-        **{k: v for k, v in state.items() if k != "useful_links"}
+    async def anode(state: TripState) -> Dict[str, Any]:
+        # Only the async path can enforce the budget, a sync tool running in a
+        # worker thread cannot be cancelled
+        if done(state):
+            return {}
+        logger.debug("Running node_%s", name)
+        try:
+            with timed(NODE_SECONDS, f"node_{name}", node=name):
+                async with asyncio.timeout(node_timeout(name)):
+                    result = await atool(state)
+        except TimeoutError:
+            ERRORS.labels(component=f"timeout_{name}").inc()
+            logger.warning("node_%s exceeded its %ss budget", name, node_timeout(name))
+            return {key: default, "section_status": {key: "timeout"}}
+        logger.debug("%s returned: %s", atool.__name__, result)
+        return update(result)
+
+    from langchain_core.runnables import RunnableLambda
+
+    return RunnableLambda(node, afunc=anode, name=f"node_{name}")
+
+
+def nodes_for(sections: Optional[Iterable[str]] = None) -> FrozenSet[str]:
+    """Graph nodes needed for the requested sections, dependencies included"""
+    if not sections:
+        return frozenset(SECTION_KEYS)
+    needed = set()
+    pending = [NODE_FOR_SECTION[section] for section in sections]
+    while pending:
+        node = pending.pop()
+        if node not in needed:
+            needed.add(node)
+            pending.extend(NODE_DEPENDENCIES.get(node, ()))
+    return frozenset(needed)
+
+
+def invalidated_nodes(changed_fields: Iterable[str]) -> FrozenSet[str]:
+    """Nodes to recompute after a change to these preference fields"""
+    invalid = set()
+    for field in changed_fields:
+        # Unknown fields may be read by any prompt
+        invalid.update(PREFERENCE_DEPENDENCIES.get(field, SECTION_KEYS))
+    return downstream_of(invalid)
+
+
+def downstream_of(nodes: Iterable[str]) -> FrozenSet[str]:
+    """The nodes plus every node that reads their output, directly or not"""
+    result = set(nodes)
+    grew = True
+    while grew:
+        grew = False
+        for node, dependencies in NODE_DEPENDENCIES.items():
+            if node not in result and result.intersection(dependencies):
+                result.add(node)
+                grew = True
+    return frozenset(result)
+
+
+def build_trip_graph(nodes: Optional[FrozenSet[str]] = None, checkpointer=None):
+    """
+    Build and compile the trip workflow, limited to `nodes` when given. A
+    node whose dependency is left out starts right away and reads that
+    section from the input state instead.
+    """
+    from langgraph.graph import StateGraph, START, END
+
+    nodes = nodes or frozenset(SECTION_KEYS)
+    # Node -> (default value, sync tool, async tool)
+    tools = {
+        "generate_itinerary": ("", generate_itinerary, agenerate_itinerary),
+        "weather": ("", weather_forecaster, aweather_forecaster),
+        "activities": ("", recommend_activities, arecommend_activities),
+        "links": ([], fetch_useful_links, afetch_useful_links),
+        "food": ("", food_culture_recommender, afood_culture_recommender),
     }
+    # Node order of SECTION_KEYS, so every subset compiles the same way
+    selected = [name for name in SECTION_KEYS if name in nodes]
 
-def node_food(state: TripState) -> Dict[str, Any]:
-    """Get food culture info and return state update"""
-    print("DEBUG: Running node_food")
-    result = food_culture_recommender(state)
-    print(f"DEBUG: food_culture_recommender returned: {result}")
-    
+    workflow = StateGraph(TripState)
+
+    for name in selected:
+        default, tool, atool = tools[name]
+        workflow.add_node(name, _make_node(name, SECTION_KEYS[name], default, tool, atool))
+
+    # Fan out: only activities reads the itinerary, everything else needs just
+    # the preferences, so those nodes start together from the entry point
+    for name in selected:
+        dependencies = [d for d in NODE_DEPENDENCIES.get(name, ()) if d in nodes]
+        if dependencies:
+            for dependency in dependencies:
+                workflow.add_edge(dependency, name)
+        else:
+            workflow.add_edge(START, name)
+
+    # Join: END is reached once every branch has written its section
+    leaves = [
+        name for name in selected
+        if not any(name in NODE_DEPENDENCIES.get(other, ()) for other in selected)
+    ]
+    workflow.add_edge(leaves, END)
+
+    # Compile agent
+    return workflow.compile(checkpointer=checkpointer)
+
+
+# One compiled graph per node subset, at most 2^5 - 1 of them, and the same
+# again with the checkpointer of the current event loop
+_trip_agents: Dict[FrozenSet[str], Any] = {}
+_checkpointed_agents: Dict[FrozenSet[str], Tuple[Any, Any]] = {}
+_compile_lock = threading.Lock()
+
+
+def get_trip_agent(sections: Optional[Iterable[str]] = None):
+    """
+    The compiled trip agent for the requested sections (all of them by
+    default), built once per process on first use
+    """
+    return _compiled(nodes_for(sections))
+
+
+def _compiled(nodes: FrozenSet[str]):
+    agent = _trip_agents.get(nodes)
+    if agent is None:
+        with _compile_lock:
+            agent = _trip_agents.get(nodes)
+            if agent is None:
+                agent = _trip_agents[nodes] = build_trip_graph(nodes)
+    return agent
+
+
+def _checkpointed(nodes: FrozenSet[str], checkpointer):
+    saver, agent = _checkpointed_agents.get(nodes, (None, None))
+    if saver is not checkpointer:
+        with _compile_lock:
+            agent = build_trip_graph(nodes, checkpointer)
+            _checkpointed_agents[nodes] = (checkpointer, agent)
+    return agent
+
+
+async def _resume_point(agent, config: Dict[str, Any], user_state: Dict[str, Any]):
+    """
+    Input for a checkpointed run and the state saved by its earlier attempts.
+    None as input continues a run that was cut off; otherwise the failed
+    sections (and those reading them) are reset and the graph runs again,
+    skipping every section that is still ok.
+    """
+    from app.services.checkpoints import get_checkpoint_store
+
+    snapshot = await agent.aget_state(config)
+    saved = dict(snapshot.values or {})
+    if not saved:
+        return user_state, {}
+    if saved.get("preferences") != user_state.get("preferences"):
+        # Same id, different trip: start over
+        await get_checkpoint_store().forget(config["configurable"]["thread_id"])
+        return user_state, {}
+    if snapshot.next:
+        logger.info("Resuming run %s at %s", config["configurable"]["thread_id"], list(snapshot.next))
+        return None, saved
+
+    statuses = saved.get("section_status") or {}
+    failed = [node for node, key in SECTION_KEYS.items() if key in statuses and statuses[key] != "ok"]
+    rerun = downstream_of(failed)
+    logger.info("Retrying run %s for %s", config["configurable"]["thread_id"], sorted(rerun))
+    saved["section_status"] = {key: status for key, status in statuses.items() if NODE_FOR_SECTION[key] not in rerun}
     return {
-        "food_culture_info": result.get("food_culture_info", ""),
-        **{k: v for k, v in state.items() if k != "food_culture_info"}
-    }
+        "preferences": user_state.get("preferences", {}),
+        "section_status": {SECTION_KEYS[node]: "pending" for node in rerun},
+    }, saved
+
 
-# ---- Build the graph ----
-workflow = StateGraph(TripState)
+def _deadline_scope(deadline: Optional[float]):
+    if deadline is not None:
+        return asyncio.timeout_at(deadline)
+    return asyncio.timeout(request_deadline())
 
-# Add nodes
-workflow.add_node("generate_itinerary", node_generate_itinerary)
-workflow.add_node("weather", node_weather)
-workflow.add_node("activities", node_activities)
-workflow.add_node("links", node_links)
-workflow.add_node("food", node_food)
 
-# Set entry point
-workflow.set_entry_point("generate_itinerary")
+async def astream_trip_agent(user_state: Dict[str, Any],
+                             sections: Optional[Iterable[str]] = None,
+                             nodes: Optional[FrozenSet[str]] = None,
+                             thread_id: Optional[str] = None,
+                             stream_mode: Iterable[str] = ("updates",)) -> AsyncIterator[Tuple[str, Any]]:
+    """
+    Stream (mode, chunk) pairs like CompiledStateGraph.astream with a list of
+    stream modes. `sections` and `nodes` select the nodes as in
+    arun_trip_agent. With `thread_id` (and TRIP_CHECKPOINTS on) the run is
+    checkpointed, and a later call with the same id resumes it; sections
+    restored from the checkpoint come first, as updates of their nodes.
+    The request deadline is the caller's.
+    """
+    from app.services.checkpoints import checkpoints_enabled, get_checkpoint_store
+
+    nodes = nodes or nodes_for(sections)
+    run_input, config, agent = user_state, None, _compiled(nodes)
+    if thread_id and checkpoints_enabled():
+        store = get_checkpoint_store()
+        agent = _checkpointed(nodes, await store.saver())
+        # A different node set is a different graph, it gets its own thread
+        config = {"configurable": {"thread_id": f"{thread_id}:{'+'.join(sorted(nodes))}"}}
+        run_input, saved = await _resume_point(agent, config, user_state)
+        restored = saved.get("section_status") or {}
+        for node in nodes:
+            key = SECTION_KEYS[node]
+            if key in restored:
+                yield "updates", {node: {key: saved.get(key), "section_status": {key: restored[key]}}}
+    try:
+        async for mode, chunk in agent.astream(run_input, config, stream_mode=list(stream_mode)):
+            yield mode, chunk
+    finally:
+        if config is not None:
+            try:
+                await store.record(config["configurable"]["thread_id"])
+            except Exception as e:
+                logger.warning("Could not record checkpointed run: %s", e)
+
 
-# Chain execution
-workflow.add_edge("generate_itinerary", "weather")
-workflow.add_edge("weather", "activities")
-workflow.add_edge("activities", "links")
-workflow.add_edge("links", "food")
-workflow.add_edge("food", END)
+async def arun_trip_agent(user_state: Dict[str, Any],
+                          on_progress: Optional[Callable[[Dict[str, str]], None]] = None,
+                          sections: Optional[Iterable[str]] = None,
+                          nodes: Optional[FrozenSet[str]] = None,
+                          thread_id: Optional[str] = None,
+                          deadline: Optional[float] = None) -> Dict[str, Any]:
+    """
+    Run the agent under the overall request deadline. Sections are collected
+    as their nodes finish, so when the deadline hits the sections that did
+    finish are returned and the rest are marked as timed out.
+    `on_progress` is called with the section statuses so far after each node.
+    With `sections` only those nodes and their dependencies run; `nodes`
+    runs exactly those nodes on top of the sections already in `user_state`.
+    With `thread_id` (and TRIP_CHECKPOINTS on) the run is checkpointed, and
+    a later call with the same id resumes it, see app.services.checkpoints.
+    `deadline` (event loop time) replaces TRIP_REQUEST_DEADLINE_S from now,
+    for a run that takes over what is left of another one's budget.
+    """
+    nodes = nodes or nodes_for(sections)
+    state = dict(user_state)
+    statuses: Dict[str, str] = {}
+    try:
+        async with _deadline_scope(deadline):
+            async for _, chunk in astream_trip_agent(user_state, nodes=nodes, thread_id=thread_id):
+                for update in chunk.values():
+                    update = dict(update or {})
+                    statuses.update(update.pop("section_status", {}))
+                    state.update(update)
+                if on_progress is not None:
+                    on_progress(dict(statuses))
+    except TimeoutError:
+        ERRORS.labels(component="request_deadline").inc()
+        logger.warning("Trip plan hit the %ss request deadline", request_deadline())
 
-# Compile agent
-trip_agent = workflow.compile()
+    for node in nodes:
+        statuses.setdefault(SECTION_KEYS[node], "timeout")
+    state["section_status"] = statuses
+    return state
 
-display(Image(trip_agent.get_graph().draw_mermaid_png()))
+
+def __getattr__(name: str):
+    # Keep `from app.agents.trip_agent import trip_agent` working, lazily
+    if name == "trip_agent":
+        return get_trip_agent()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 # ---- Test runner with better debugging ----
@@ -123,12 +388,17 @@ if __name__ == "__main__":
         "food_culture_info": ""
     }
     
-    print("DEBUG: Starting agent with state:", user_state)
+    trip_agent = get_trip_agent()
+    # Graph as Mermaid text, paste into https://mermaid.live to render it
+    print(trip_agent.get_graph().draw_mermaid())
+
+    logging.basicConfig(level=logging.DEBUG)
+    logger.debug("Starting agent with state: %s", user_state)
     result = trip_agent.invoke(user_state)
-    print("DEBUG: Final result:", result)
+    logger.debug("Final result: %s", result)
     print("\n---- Final Trip Plan ----\n")
     if result:
         for key, value in result.items():
             print(f"{key}: {value[:100]}..." if isinstance(value, str) and len(value) > 100 else f"{key}: {value}")
     else:
-        print("ERROR: Agent returned None!")
\ No newline at end of file
+        logger.error("Agent returned None!")
\ No newline at end of file
@@ -1,16 +1,46 @@
-from fastapi import FastAPI
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Response
 from fastapi.middleware.cors import CORSMiddleware
-from app.routes import trip_routes
+from app.routes import course_routes, trip_routes
+from app.agents.trip_agent import get_trip_agent
+from app.services.checkpoints import aclose_checkpoints
+from app.services.llm_client import aclose_chat_models
+from app.services.metrics import render_metrics
+from app.services.prewarm import flush_demand, prewarm_enabled, run_warmer
+from app.services.serper_client import aclose_serper_client
 from dotenv import load_dotenv
+import asyncio
+import logging
 import os
 
 # Load environment variables
 load_dotenv()
 
+# DEBUG dumps whole agent states, keep it off in production
+logging.basicConfig(
+    level=os.getenv("LOG_LEVEL", "INFO").upper(),
+    format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Compile the graph before serving, off the import path of every worker
+    get_trip_agent()
+    warmer = asyncio.create_task(run_warmer()) if prewarm_enabled() else None
+    yield
+    if warmer is not None:
+        warmer.cancel()
+    # Release the pooled Gemini and Serper connections on the loop that used them
+    await aclose_chat_models()
+    await aclose_serper_client()
+    await aclose_checkpoints()
+    await asyncio.to_thread(flush_demand)
+
 app = FastAPI(
     title="TripTrek API",
     description="AI-powered travel planning API",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 # Add CORS middleware
@@ -24,6 +54,7 @@ app.add_middleware(
 
 # Include routers
 app.include_router(trip_routes.router)
+app.include_router(course_routes.router)
 
 @app.get("/")
 def read_root():
@@ -36,3 +67,9 @@ def read_root():
 @app.get("/ping")
 def ping():
     return {"message": "pong"}
+
+@app.get("/metrics")
+def metrics():
+    """Prometheus metrics for this worker"""
+    body, content_type = render_metrics()
+    return Response(content=body, media_type=content_type)
@@ -0,0 +1,40 @@
+from fastapi import APIRouter
+from fastapi.responses import StreamingResponse
+from app.schemas.course_schema import CourseRequest
+from app.services.metrics import ERRORS
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter(prefix="/course", tags=["course"])
+
+
+@router.post("/generate/stream")
+async def generate_course_stream(request: CourseRequest):
+    """
+    Build a course, streamed as NDJSON: the skeleton first, then each topic as
+    it completes, then a final `course` event. Progress is checkpointed per
+    topic, so calling again with the same inputs after a failure resumes from
+    the missing topics instead of starting over.
+    """
+    # Imported here: the course builder pulls in langchain_core at import time
+    from app.services.course_generate import astream_course
+
+    async def lines():
+        try:
+            async for event in astream_course(
+                course_title=request.course_title,
+                description=request.description,
+                knowledge=request.knowledge,
+                difficulty=request.difficulty,
+                experience=request.experience,
+                concurrency=request.concurrency,
+            ):
+                yield json.dumps(event) + "\n"
+        except Exception as e:
+            ERRORS.labels(component="course").inc()
+            logger.exception("Course build failed: %s", e)
+            yield json.dumps({"event": "error", "message": f"Failed to build course: {str(e)}"}) + "\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
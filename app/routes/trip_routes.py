@@ -1,16 +1,161 @@
-from fastapi import APIRouter, HTTPException
-from app.schemas.trip_schema import TripRequest, TripResponse, ErrorResponse
-from app.agents.trip_agent import trip_agent
+from fastapi import APIRouter, HTTPException, Response
+from fastapi.responses import StreamingResponse
+from app.schemas.trip_schema import (
+    BatchTripRequest,
+    ErrorResponse,
+    JobAccepted,
+    JobStatus,
+    ReplanRequest,
+    TokenUsage,
+    TripPreferences,
+    TripRequest,
+    TripResponse,
+)
+from app.agents.trip_agent import (
+    NODE_FOR_SECTION,
+    SECTION_KEYS,
+    arun_trip_agent,
+    astream_trip_agent,
+    downstream_of,
+    get_trip_agent,
+    invalidated_nodes,
+    nodes_for,
+)
+from app.agents.single_shot import arun_single_shot
+from app.services.circuit_breaker import breaker_stats
+from app.services.deadlines import request_deadline
+from app.services.job_queue import get_job_queue
+from app.services.llm_client import message_text
+from app.services.metrics import (
+    ERRORS,
+    IN_FLIGHT,
+    REPLAN_SECTIONS,
+    REQUEST_SECONDS,
+    server_timing_enabled,
+    server_timing_header,
+    start_request_timings,
+    timed,
+)
+from app.services.plan_store import get_plan_store, save_plan
+from app.services.preferences import destination_key, get_canonicalizer, preferences_key
+from app.services.prewarm import record_demand
+from app.services.rate_limit import Overloaded, get_admission, limiter_stats
+from app.services.section_cache import get_section_cache
+from app.services.singleflight import SingleFlight
+from app.services.token_usage import current_token_usage, start_token_usage
+import asyncio
+import json
+import logging
 import os
 import traceback
+from typing import List, Optional
+
+logger = logging.getLogger(__name__)
 
 router = APIRouter(prefix="/trip", tags=["trip"])
 
-@router.post("/generate", response_model=TripResponse)
-async def generate_trip_plan(request: TripRequest):
+# Identical trip requests that arrive while one is running share its result
+_trip_flights = SingleFlight()
+
+
+def _request_key(preferences: dict) -> str:
+    """Stable key for preferences already canonicalized by _initial_state"""
+    return preferences_key(preferences)
+
+def _engine(requested: Optional[str]) -> str:
+    """Engine for a request: explicit choice first, then TRIP_ENGINE, then graph"""
+    engine = requested or os.getenv("TRIP_ENGINE", "graph").strip().lower()
+    return engine if engine in ("graph", "single_shot") else "graph"
+
+
+def _sections(requested: Optional[List[str]]) -> Optional[List[str]]:
+    """Requested sections in a stable order, None when all of them are wanted"""
+    if not requested:
+        return None
+    sections = [section for section in SECTION_KEYS.values() if section in requested]
+    return None if len(sections) == len(SECTION_KEYS) else sections
+
+
+def _run_agent(user_state: dict, engine: Optional[str] = None, sections: Optional[List[str]] = None,
+               request_id: Optional[str] = None):
+    """Run the agent, sharing the result with identical requests already in flight"""
+    engine = _engine(engine)
+    if sections or request_id:
+        # single_shot always writes every LLM section and has no checkpoints,
+        # the graph is the cheaper way to a partial or resumable plan
+        engine = "graph"
+    if engine == "single_shot":
+        compute = lambda: arun_single_shot(user_state, fallback=arun_trip_agent)
+    else:
+        compute = lambda: arun_trip_agent(user_state, sections=sections, thread_id=request_id)
+    key = f"{engine}:{','.join(sections or ['all'])}:{_request_key(user_state['preferences'])}"
+    if request_id:
+        # Retries of one request share its checkpoint, not other requests' flights
+        key = f"{key}:{request_id}"
+    return _trip_flights.do(key, compute)
+
+
+def _initial_state(preferences: TripPreferences) -> dict:
+    """
+    COMPLETE initial state for the agent from the request preferences,
+    canonicalized so that spelling variants share cache entries and flights
+    """
+    canonical, _ = get_canonicalizer().canonicalize({
+        "destination": preferences.destination,
+        "month": preferences.month,
+        "budget_type": preferences.budget_type,
+        "travelStyle": preferences.travel_style,
+        "interests": preferences.interests
+    })
+    # Live demand decides what the pre-warmer fills during off-peak hours
+    record_demand(canonical)
+    return {
+        "preferences": canonical,
+        # Initialize ALL required state fields
+        "itinerary": "",
+        "weather_forecast": "",
+        "activity_suggestions": "",
+        "useful_links": [],
+        "food_culture_info": ""
+    }
+
+
+def _token_usage() -> Optional[TokenUsage]:
+    """Tokens collected for the current request since start_token_usage()"""
+    usage = current_token_usage()
+    return TokenUsage.model_validate(usage) if usage is not None else None
+
+
+def _overloaded(error: Overloaded) -> HTTPException:
+    """Fast 503 telling the client when to come back"""
+    return HTTPException(
+        status_code=503,
+        detail=str(error),
+        headers={"Retry-After": str(error.retry_after)},
+    )
+
+
+@router.post("/generate", response_model=TripResponse, response_model_exclude_none=True)
+async def generate_trip_plan(request: TripRequest, response: Response):
     """
     Generate a complete trip plan using AI agent
     """
+    timings = start_request_timings()
+    start_token_usage()
+    IN_FLIGHT.labels(endpoint="generate").inc()
+    try:
+        with timed(REQUEST_SECONDS, "total", endpoint="generate"):
+            async with get_admission().slot():
+                return await _generate_trip_plan(request)
+    except Overloaded as e:
+        raise _overloaded(e)
+    finally:
+        IN_FLIGHT.labels(endpoint="generate").dec()
+        if server_timing_enabled():
+            response.headers["Server-Timing"] = server_timing_header(timings)
+
+
+async def _generate_trip_plan(request: TripRequest) -> TripResponse:
     try:
         # Remove the strict API key validation - let tools handle mock data
         # if not os.getenv("GOOGLE_API_KEY"):
@@ -19,32 +164,19 @@ async def generate_trip_plan(request: TripRequest):
         #     raise HTTPException(status_code=500, detail="Serper API key not configured")
         
         # Prepare COMPLETE initial state for the agent
-        user_state = {
-            "preferences": {
-                "destination": request.preferences.destination,
-                "month": request.preferences.month,
-                "budget_type": request.preferences.budget_type,
-                "travelStyle": request.preferences.travel_style,
-                "interests": request.preferences.interests
-            },
-            # Initialize ALL required state fields
-            "itinerary": "",
-            "weather_forecast": "",
-            "activity_suggestions": "",
-            "useful_links": [],
-            "food_culture_info": ""
-        }
+        user_state = _initial_state(request.preferences)
+        sections = _sections(request.sections)
         
-        print(f"DEBUG - Initial user state: {user_state}")
+        logger.debug("Initial user state: %s", user_state)
         
-        # Run the agent with error handling
+        # Run the agent with error handling - ainvoke keeps the event loop free
+        # for other requests while the upstream calls are in flight
         try:
-            result = trip_agent.invoke(user_state)
-            print(f"DEBUG - Agent result type: {type(result)}")
-            print(f"DEBUG - Agent result: {result}")
+            result = await _run_agent(user_state, request.engine, sections, request.request_id)
+            logger.debug("Agent result: %s", result)
         except Exception as agent_error:
-            print(f"DEBUG - Agent execution error: {str(agent_error)}")
-            print(f"DEBUG - Agent traceback: {traceback.format_exc()}")
+            ERRORS.labels(component="agent").inc()
+            logger.exception("Agent execution error: %s", agent_error)
             raise HTTPException(
                 status_code=500,
                 detail=f"Agent execution failed: {str(agent_error)}"
@@ -52,7 +184,7 @@ async def generate_trip_plan(request: TripRequest):
         
         # Handle case where result might be None
         if result is None:
-            print("ERROR - Agent returned None result")
+            logger.error("Agent returned None result")
             raise HTTPException(
                 status_code=500,
                 detail="Agent returned None result. Check agent configuration and tool implementations."
@@ -62,29 +194,276 @@ async def generate_trip_plan(request: TripRequest):
         expected_keys = ["itinerary", "weather_forecast", "activity_suggestions", "useful_links", "food_culture_info"]
         missing_keys = [key for key in expected_keys if key not in result]
         if missing_keys:
-            print(f"WARNING - Missing keys in result: {missing_keys}")
+            logger.warning("Missing keys in result: %s", missing_keys)
         
         # Return the response with safe defaults
-        return TripResponse(
-            itinerary=result.get("itinerary", "No itinerary generated"),
-            weather_forecast=result.get("weather_forecast", "No weather forecast available"),
-            activity_suggestions=result.get("activity_suggestions", "No activity suggestions available"),
-            useful_links=result.get("useful_links", []),
-            food_culture_info=result.get("food_culture_info", "No food/culture info available"),
-            message="Trip plan generated successfully!"
-        )
+        response = TripResponse.from_state(result, sections)
+        response.plan_id = await asyncio.to_thread(save_plan, result, sections)
+        response.token_usage = _token_usage()
+        return response
         
     except HTTPException:
         # Re-raise HTTP exceptions as-is
         raise
     except Exception as e:
-        print(f"ERROR - Unexpected error: {str(e)}")
-        print(f"ERROR - Traceback: {traceback.format_exc()}")
+        ERRORS.labels(component="route").inc()
+        logger.exception("Unexpected error: %s", e)
         raise HTTPException(
             status_code=500,
             detail=f"Failed to generate trip plan: {str(e)}"
         )
 
+def _sse(event: str, data) -> str:
+    """One Server-Sent Events frame"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+@router.post("/generate/stream")
+async def generate_trip_plan_stream(request: TripRequest, tokens: bool = False):
+    """
+    Stream the trip plan as Server-Sent Events.
+
+    A `section` event is pushed as soon as each node finishes, so the first
+    bytes arrive after the fastest node instead of the whole pipeline. With
+    `?tokens=true` the Gemini output is forwarded as `token` events while it is
+    generated. The stream ends with a `summary` event holding the full
+    TripResponse, or an `error` event.
+
+    `request_id` checkpoints the run like POST /generate: a retry first
+    streams the sections restored from the checkpoint, then the rest. The
+    single_shot engine has no per-node progress, its sections arrive
+    together once its call finishes (and there are no `token` events).
+    """
+    try:
+        get_admission().check()
+    except Overloaded as e:
+        raise _overloaded(e)
+
+    user_state = _initial_state(request.preferences)
+    sections = _sections(request.sections)
+    stream_mode = ["updates", "messages"] if tokens else ["updates"]
+    # Same rule as _run_agent: partial or resumable plans need the graph
+    single_shot = _engine(request.engine) == "single_shot" and not (sections or request.request_id)
+
+    async def chunks():
+        if not single_shot:
+            async for chunk in astream_trip_agent(user_state, sections, thread_id=request.request_id,
+                                                  stream_mode=stream_mode):
+                yield chunk
+            return
+        result = await _run_agent(user_state, "single_shot")
+        yield "updates", {
+            NODE_FOR_SECTION[section]: {section: result.get(section), "section_status": {section: status}}
+            for section, status in result.get("section_status", {}).items()
+        }
+
+    async def events():
+        start_token_usage()
+        result = dict(user_state)
+        section_status = {}
+        try:
+            try:
+                async with get_admission().slot(), asyncio.timeout(request_deadline()):
+                    async for mode, chunk in chunks():
+                        if mode == "messages":
+                            message, metadata = chunk
+                            text = message_text(message)
+                            if text:
+                                yield _sse("token", {"node": metadata.get("langgraph_node"), "text": str(text)})
+                            continue
+                        for node, update in chunk.items():
+                            update = dict(update or {})
+                            statuses = update.pop("section_status", {})
+                            section_status.update(statuses)
+                            for section, value in update.items():
+                                result[section] = value
+                                yield _sse("section", {
+                                    "node": node,
+                                    "section": section,
+                                    "status": statuses.get(section, "ok"),
+                                    "value": value,
+                                })
+            except TimeoutError:
+                ERRORS.labels(component="request_deadline").inc()
+                logger.warning("Streamed trip plan hit the %ss request deadline", request_deadline())
+
+            for node in nodes_for(sections):
+                section_status.setdefault(SECTION_KEYS[node], "timeout")
+            result["section_status"] = section_status
+            summary = TripResponse.from_state(result, sections)
+            summary.plan_id = await asyncio.to_thread(save_plan, result, sections)
+            summary.token_usage = _token_usage()
+            yield _sse("summary", summary.model_dump(exclude_none=True))
+        except Overloaded as e:
+            yield _sse("error", {"status": "error", "message": str(e), "retry_after": e.retry_after})
+        except Exception as e:
+            ERRORS.labels(component="stream").inc()
+            logger.exception("Streaming agent failed: %s", e)
+            yield _sse("error", {"status": "error", "message": f"Failed to generate trip plan: {str(e)}"})
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@router.post("/replan", response_model=TripResponse, response_model_exclude_none=True)
+async def replan_trip(request: ReplanRequest):
+    """
+    Re-plan a stored plan after a preference change. Only the sections that
+    read a changed field (see PREFERENCE_DEPENDENCIES), sections downstream of
+    them and sections that failed last time are generated again; the others
+    are reused from the stored plan. The result gets a new plan_id.
+    """
+    start_token_usage()
+    plan = await asyncio.to_thread(get_plan_store().get, request.plan_id)
+    if plan is None:
+        raise HTTPException(status_code=404, detail="Plan not found or expired")
+
+    previous = plan["preferences"]
+    preferences = TripPreferences(
+        destination=previous.get("destination", ""),
+        month=previous.get("month", ""),
+        budget_type=previous.get("budget_type", "mid-range"),
+        travel_style=previous.get("travelStyle", "cultural"),
+        interests=previous.get("interests", []),
+    ).model_copy(update=request.changes.model_dump(exclude_none=True))
+    user_state = _initial_state(preferences)
+    # Compared after canonicalization, "apr" -> "April" is no change
+    current = user_state["preferences"]
+    keyed = lambda prefs: {**prefs, "destination": destination_key(prefs.get("destination", ""))}
+    previous_key, current_key = keyed(previous), keyed(current)
+    changed = [field for field in set(previous_key) | set(current_key) if previous_key.get(field) != current_key.get(field)]
+
+    sections = plan.get("sections")
+    planned = nodes_for(sections)
+    previous_status = plan.get("section_status", {})
+    failed = [node for node in planned if previous_status.get(SECTION_KEYS[node]) != "ok"]
+    rerun = downstream_of(invalidated_nodes(changed) | set(failed)) & planned
+    reused = planned - rerun
+    for node in reused:
+        user_state[SECTION_KEYS[node]] = plan["values"].get(SECTION_KEYS[node])
+    REPLAN_SECTIONS.labels(outcome="reused").inc(len(reused))
+    REPLAN_SECTIONS.labels(outcome="recomputed").inc(len(rerun))
+    logger.info("Replan of %s: changed %s, recomputing %s", request.plan_id, changed, sorted(rerun))
+
+    result = user_state
+    if rerun:
+        try:
+            async with get_admission().slot():
+                result = await arun_trip_agent(user_state, nodes=rerun)
+        except Overloaded as e:
+            raise _overloaded(e)
+        except Exception as e:
+            ERRORS.labels(component="agent").inc()
+            logger.exception("Replan failed: %s", e)
+            raise HTTPException(status_code=500, detail=f"Failed to re-plan trip: {str(e)}")
+
+    result["section_status"] = {
+        **{SECTION_KEYS[node]: previous_status[SECTION_KEYS[node]] for node in reused},
+        **result.get("section_status", {}),
+    }
+    response = TripResponse.from_state(result, sections)
+    response.plan_id = await asyncio.to_thread(save_plan, result, sections)
+    response.token_usage = _token_usage()
+    return response
+
+@router.post("/generate/batch")
+async def generate_trip_plan_batch(request: BatchTripRequest):
+    """
+    Generate plans for a list of preference sets, streamed back as NDJSON in
+    completion order. Each line carries the item `index` so callers can match
+    results to inputs.
+
+    At most `concurrency` plans run at once (TRIP_BATCH_CONCURRENCY by default,
+    capped at TRIP_BATCH_MAX_CONCURRENCY). Sections shared between items, such
+    as one destination's food and culture across twelve months, are computed
+    once through the section cache and in-flight coalescing of the tools.
+    """
+    try:
+        get_admission().check()
+    except Overloaded as e:
+        raise _overloaded(e)
+
+    max_items = int(os.getenv("TRIP_BATCH_MAX_ITEMS", "100"))
+    if len(request.items) > max_items:
+        raise HTTPException(status_code=413, detail=f"Batch too large, at most {max_items} items allowed")
+
+    max_concurrency = int(os.getenv("TRIP_BATCH_MAX_CONCURRENCY", "16"))
+    concurrency = request.concurrency or int(os.getenv("TRIP_BATCH_CONCURRENCY", "4"))
+    semaphore = asyncio.Semaphore(max(1, min(concurrency, max_concurrency)))
+    sections = _sections(request.sections)
+
+    async def run_item(index: int, preferences: TripPreferences) -> dict:
+        async with semaphore:
+            # Each item runs in its own task, so it gets its own token count
+            start_token_usage()
+            try:
+                # Batch items share the in-flight slots with interactive requests
+                async with get_admission().slot():
+                    result = await _run_agent(_initial_state(preferences), sections=sections)
+                response = TripResponse.from_state(result, sections)
+                response.plan_id = await asyncio.to_thread(save_plan, result, sections)
+                response.token_usage = _token_usage()
+                return {"index": index, "status": "success", "result": response.model_dump(exclude_none=True)}
+            except Overloaded as e:
+                return {"index": index, "status": "error", "message": str(e), "retry_after": e.retry_after}
+            except Exception as e:
+                ERRORS.labels(component="batch").inc()
+                logger.exception("Batch item %s failed: %s", index, e)
+                return {"index": index, "status": "error", "message": f"Failed to generate trip plan: {str(e)}"}
+
+    async def lines():
+        tasks = [asyncio.create_task(run_item(i, p)) for i, p in enumerate(request.items)]
+        try:
+            for finished in asyncio.as_completed(tasks):
+                yield json.dumps(await finished) + "\n"
+        finally:
+            # Client went away mid-stream, don't keep burning quota for it
+            for task in tasks:
+                task.cancel()
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+@router.post("/jobs", response_model=JobAccepted, status_code=202)
+async def create_trip_job(request: TripRequest):
+    """
+    Queue a trip plan and return at once. Worker processes
+    (`python -m app.services.job_worker`) pick the job up; poll
+    GET /trip/jobs/{job_id} for per-section progress and the result.
+    """
+    # The queue is synchronous SQLite and the insert fsyncs (synchronous=FULL),
+    # so it runs in a worker thread rather than on the event loop
+    queue = await asyncio.to_thread(get_job_queue)
+    max_queued = int(os.getenv("TRIP_JOB_MAX_QUEUED", "10000"))
+    counts = await asyncio.to_thread(queue.counts)
+    if counts.get("queued", 0) >= max_queued:
+        raise _overloaded(Overloaded(retry_after=30))
+    sections = _sections(request.sections)
+    # The worker pops `sections` off the state before running the agent
+    state = {**_initial_state(request.preferences), "sections": sections}
+    job_id = await asyncio.to_thread(queue.enqueue, state, "graph" if sections else _engine(request.engine))
+    return JobAccepted(job_id=job_id, status_url=f"{router.prefix}/jobs/{job_id}")
+
+@router.get("/jobs/{job_id}", response_model=JobStatus, response_model_exclude_none=True)
+async def get_trip_job(job_id: str):
+    """Status of a queued trip job, with the TripResponse once it is done"""
+    queue = await asyncio.to_thread(get_job_queue)
+    job = await asyncio.to_thread(queue.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found or expired")
+    return JobStatus(
+        job_id=job["id"],
+        status=job["status"],
+        progress=job["progress"],
+        attempts=job["attempts"],
+        result=job["result"],
+        # A retried job keeps the last error around while it is queued again
+        error=job["error"] if job["status"] == "failed" else None,
+        created_at=job["created_at"],
+        updated_at=job["updated_at"],
+    )
+
 @router.get("/health")
 async def trip_health_check():
     """Health check for trip service"""
@@ -103,6 +482,31 @@ async def get_config():
         "status": "ready" if os.getenv("GOOGLE_API_KEY") and os.getenv("SERPER_API_KEY") else "mock_data_mode"
     }
 
+@router.get("/cache/stats")
+async def cache_stats():
+    """Section cache hit/miss counters for this worker"""
+    return get_section_cache().stats()
+
+@router.get("/preferences/report")
+async def preferences_report(top: int = 20):
+    """How many distinct raw preference payloads collapsed into each canonical key"""
+    return get_canonicalizer().tracker.report(top)
+
+@router.get("/limits")
+async def limits():
+    """Current adaptive upstream rates, circuit breakers and admission queue for this worker"""
+    admission = get_admission()
+    return {
+        "upstream": limiter_stats(),
+        "circuits": breaker_stats(),
+        "admission": {
+            "in_flight": admission.in_flight,
+            "queued": admission.queued,
+            "max_in_flight": admission.max_in_flight,
+            "max_queue": admission.max_queue,
+        },
+    }
+
 @router.post("/debug-agent")
 async def debug_agent():
     """Debug endpoint to test the agent step by step"""
@@ -123,23 +527,23 @@ async def debug_agent():
             "food_culture_info": ""
         }
         
-        print("DEBUG - Testing agent with state:", test_state)
+        logger.debug("Testing agent with state: %s", test_state)
         
         # Test individual tools first
-        from app.tools.all_tools import generate_itinerary, weather_forecaster
+        from app.tools.all_tools import agenerate_itinerary, aweather_forecaster
         
-        print("DEBUG - Testing generate_itinerary tool...")
-        itinerary_result = generate_itinerary(test_state)
-        print(f"DEBUG - Itinerary tool result: {itinerary_result}")
+        logger.debug("Testing generate_itinerary tool...")
+        itinerary_result = await agenerate_itinerary(test_state)
+        logger.debug("Itinerary tool result: %s", itinerary_result)
         
-        print("DEBUG - Testing weather_forecaster tool...")
-        weather_result = weather_forecaster(test_state)
-        print(f"DEBUG - Weather tool result: {weather_result}")
+        logger.debug("Testing weather_forecaster tool...")
+        weather_result = await aweather_forecaster(test_state)
+        logger.debug("Weather tool result: %s", weather_result)
         
         # Now test the full agent
-        print("DEBUG - Testing full agent...")
-        agent_result = trip_agent.invoke(test_state)
-        print(f"DEBUG - Full agent result: {agent_result}")
+        logger.debug("Testing full agent...")
+        agent_result = await get_trip_agent().ainvoke(test_state)
+        logger.debug("Full agent result: %s", agent_result)
         
         return {
             "individual_tools": {
@@ -151,8 +555,7 @@ async def debug_agent():
         }
         
     except Exception as e:
-        print(f"DEBUG ERROR: {str(e)}")
-        print(f"DEBUG TRACEBACK: {traceback.format_exc()}")
+        logger.exception("Debug agent failed: %s", e)
         return {
             "error": str(e),
             "traceback": traceback.format_exc(),
@@ -0,0 +1,30 @@
+from pydantic import BaseModel, Field
+from typing import List, Optional
+
+class TopicOutline(BaseModel):
+    title: str = Field(description="Topic title")
+    summary: str = Field(description="One or two sentences on what the topic covers")
+
+class CourseSkeleton(BaseModel):
+    title: str = Field(description="Course title")
+    duration: str = Field(description="Expected duration, e.g. '6 weeks'")
+    topics: List[TopicOutline] = Field(description="Topics in teaching order")
+
+class Topic(BaseModel):
+    title: str = Field(description="Topic title")
+    overview: str = Field(description="Short introduction to the topic")
+    lessons: List[str] = Field(description="Lesson contents in teaching order")
+    exercises: List[str] = Field(description="Practice exercises for the learner")
+
+class Course(BaseModel):
+    title: str
+    duration: str
+    topics: List[Topic]
+
+class CourseRequest(BaseModel):
+    course_title: str
+    description: str
+    knowledge: str
+    difficulty: str = "beginner"  # beginner, intermediate, advanced
+    experience: str = "0"  # years with the technology
+    concurrency: Optional[int] = None  # defaults to COURSE_TOPIC_CONCURRENCY, capped at COURSE_TOPIC_MAX_CONCURRENCY
@@ -1,5 +1,5 @@
-from pydantic import BaseModel
-from typing import List, Optional, Dict, Any
+from pydantic import BaseModel, Field
+from typing import List, Literal, Optional, Dict, Any
 
 class TripPreferences(BaseModel):
     destination: str
@@ -8,17 +8,113 @@ class TripPreferences(BaseModel):
     travel_style: str = "cultural"  # adventure, relaxation, cultural
     interests: List[str] = []
 
+SectionName = Literal["itinerary", "weather_forecast", "activity_suggestions", "useful_links", "food_culture_info"]
+
 class TripRequest(BaseModel):
     preferences: TripPreferences
+    # graph: one LLM call per section, run in parallel
+    # single_shot: every LLM section in one structured call
+    # None falls back to the TRIP_ENGINE setting (default graph)
+    engine: Optional[Literal["graph", "single_shot"]] = None
+    # Only these TripResponse sections are generated and returned, plus
+    # whatever they depend on (activities need the itinerary). None = all
+    sections: Optional[List[SectionName]] = None
+    # Client-chosen id; retrying with the same id resumes the checkpointed
+    # run, so sections that already succeeded are not generated again
+    request_id: Optional[str] = Field(default=None, min_length=1, max_length=128)
+
+class BatchTripRequest(BaseModel):
+    items: List[TripPreferences]
+    sections: Optional[List[SectionName]] = None  # applies to every item
+    concurrency: Optional[int] = None  # defaults to TRIP_BATCH_CONCURRENCY
+
+class TokenCount(BaseModel):
+    input_tokens: int = 0
+    output_tokens: int = 0
+    calls: int = 0
+
+class TokenUsage(TokenCount):
+    """LLM tokens this request spent; cache hits and shared calls cost nothing"""
+    # Calls the provider reported no usage for, their counts are estimates
+    estimated_calls: int = 0
+    # tool (generate_itinerary, single_shot, ...) -> its share
+    by_tool: Dict[str, TokenCount] = {}
 
 class TripResponse(BaseModel):
-    itinerary: str
-    weather_forecast: str
-    activity_suggestions: str
-    useful_links: List[Dict[str, str]]
-    food_culture_info: str
-    status: str = "success"
+    # Sections left out of TripRequest.sections stay None and are dropped
+    # from the JSON (the routes use response_model_exclude_none)
+    itinerary: Optional[str] = None
+    weather_forecast: Optional[str] = None
+    activity_suggestions: Optional[str] = None
+    useful_links: Optional[List[Dict[str, str]]] = None
+    food_culture_info: Optional[str] = None
+    status: str = "success"  # success, or partial when a section is missing
     message: Optional[str] = None
+    # section -> ok | stale | mock | error | timeout
+    section_status: Dict[str, str] = {}
+    # Stored plan, pass it to POST /trip/replan to change a preference
+    plan_id: Optional[str] = None
+    token_usage: Optional[TokenUsage] = None
+
+    @classmethod
+    def from_state(cls, result: dict, sections: Optional[List[str]] = None) -> "TripResponse":
+        """TripResponse from the final agent state, with safe defaults, limited to `sections`"""
+        defaults = {
+            "itinerary": "No itinerary generated",
+            "weather_forecast": "No weather forecast available",
+            "activity_suggestions": "No activity suggestions available",
+            "useful_links": [],
+            "food_culture_info": "No food/culture info available",
+        }
+        wanted = sections or list(defaults)
+        section_status = {
+            section: status for section, status in result.get("section_status", {}).items() if section in wanted
+        }
+        missing = [f"{section} ({status})" for section, status in section_status.items() if status != "ok"]
+        return cls(
+            **{section: result.get(section, defaults[section]) for section in wanted},
+            status="partial" if missing else "success",
+            message=(
+                f"Trip plan generated with missing sections: {', '.join(missing)}"
+                if missing else "Trip plan generated successfully!"
+            ),
+            section_status=section_status,
+        )
+
+class PreferenceChanges(BaseModel):
+    """Fields of TripPreferences to change, the rest stay as they were"""
+    destination: Optional[str] = None
+    month: Optional[str] = None
+    budget_type: Optional[str] = None
+    travel_style: Optional[str] = None
+    interests: Optional[List[str]] = None
+
+class ReplanRequest(BaseModel):
+    plan_id: str
+    changes: PreferenceChanges
+
+class JobAccepted(BaseModel):
+    job_id: str
+    status: str = "queued"
+    status_url: str
+
+class JobStatus(BaseModel):
+    job_id: str
+    status: str  # queued, running, done or failed
+    # section -> ok | error | timeout, for the sections finished so far
+    progress: Dict[str, str] = {}
+    attempts: int = 0
+    result: Optional[TripResponse] = None
+    error: Optional[str] = None
+    created_at: float
+    updated_at: float
+
+class TripPlanDraft(BaseModel):
+    """The LLM-backed sections of TripResponse, generated in one structured call"""
+    itinerary: str = Field(description="Detailed day-by-day itinerary in Markdown, with dining options and downtime")
+    weather_forecast: str = Field(description="Weather for the destination in that month: temperature, precipitation, advice")
+    activity_suggestions: str = Field(description="Unique local activities as bullet points per itinerary day")
+    food_culture_info: str = Field(description="Markdown with 'Food & Dining' and 'Culture & Etiquette' sections")
 
 class ErrorResponse(BaseModel):
     status: str = "error"
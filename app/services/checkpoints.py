@@ -0,0 +1,171 @@
+"""
+Checkpoints for trip_agent runs, so a retried request resumes instead of
+starting over.
+
+A request that carries a request_id (and every job, under its job id) runs
+the graph with a LangGraph SQLite checkpointer, keyed by that id. On a retry
+with the same id:
+
+- a run that was cut off (deadline, crash, cancelled client) continues with
+  the nodes that had not finished
+- a run that finished with failed sections runs only those sections and
+  the ones that depend on them; sections that succeeded are reused
+
+Only the latest checkpoint of each run is kept. Runs are dropped after
+TRIP_CHECKPOINT_TTL_S seconds, and beyond TRIP_CHECKPOINT_MAX_RUNS the
+oldest go first.
+
+Configuration (environment):
+    TRIP_CHECKPOINTS          use checkpoints for requests with an id (default: on)
+    TRIP_CHECKPOINT_PATH      sqlite file           (default: .cache/checkpoints.sqlite3)
+    TRIP_CHECKPOINT_TTL_S     seconds a run is kept (default: 86400)
+    TRIP_CHECKPOINT_MAX_RUNS  runs kept at most     (default: 10000)
+"""
+
+import asyncio
+import logging
+import os
+import threading
+import time
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHECKPOINT_PATH = os.path.join(".cache", "checkpoints.sqlite3")
+DEFAULT_TTL = 24 * 60 * 60
+DEFAULT_MAX_RUNS = 10000
+# Expired runs are deleted at most this often
+PURGE_INTERVAL = 60.0
+
+
+def checkpoints_enabled() -> bool:
+    return os.getenv("TRIP_CHECKPOINTS", "1").strip().lower() not in ("0", "false", "no", "off")
+
+
+class CheckpointStore:
+    """An AsyncSqliteSaver per event loop, plus retention for the runs in it"""
+
+    def __init__(self, path: str = DEFAULT_CHECKPOINT_PATH, ttl: float = DEFAULT_TTL,
+                 max_runs: int = DEFAULT_MAX_RUNS):
+        self.path = path
+        self.ttl = ttl
+        self.max_runs = max_runs
+        self._saver = None
+        self._loop = None
+        # Guards opening the saver; an asyncio.Lock belongs to one loop too
+        self._init_lock: Optional[asyncio.Lock] = None
+        self._init_loop = None
+        self._last_purge = 0.0
+
+    def _loop_lock(self, loop) -> asyncio.Lock:
+        if self._init_lock is None or self._init_loop is not loop:
+            self._init_lock = asyncio.Lock()
+            self._init_loop = loop
+        return self._init_lock
+
+    async def saver(self):
+        """The checkpointer for the running loop; aiosqlite connections belong to one loop"""
+        loop = asyncio.get_running_loop()
+        if self._saver is not None and self._loop is loop:
+            return self._saver
+        # Concurrent first requests would each open a connection, and the
+        # later saver would replace the one graphs were already compiled with
+        async with self._loop_lock(loop):
+            if self._saver is None or self._loop is not loop:
+                import aiosqlite
+                from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
+
+                directory = os.path.dirname(self.path)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                conn = await aiosqlite.connect(self.path, timeout=10)
+                try:
+                    await conn.execute("PRAGMA synchronous=NORMAL")
+                    await conn.execute(
+                        "CREATE TABLE IF NOT EXISTS checkpoint_runs "
+                        "(thread_id TEXT PRIMARY KEY, updated_at REAL NOT NULL)"
+                    )
+                    await conn.commit()
+                except BaseException:
+                    await conn.close()
+                    raise
+                self._saver = AsyncSqliteSaver(conn)
+                self._loop = loop
+        return self._saver
+
+    async def record(self, thread_id: str) -> None:
+        """After a run: keep only its latest checkpoint, refresh it and apply retention"""
+        saver = await self.saver()
+        await saver.setup()
+        now = time.time()
+        async with saver.lock:
+            conn = saver.conn
+            latest = "(SELECT MAX(checkpoint_id) FROM checkpoints WHERE thread_id = ?)"
+            await conn.execute(
+                f"DELETE FROM writes WHERE thread_id = ? AND checkpoint_id != {latest}", (thread_id, thread_id)
+            )
+            await conn.execute(
+                f"DELETE FROM checkpoints WHERE thread_id = ? AND checkpoint_id != {latest}", (thread_id, thread_id)
+            )
+            await conn.execute(
+                "INSERT INTO checkpoint_runs (thread_id, updated_at) VALUES (?, ?) "
+                "ON CONFLICT (thread_id) DO UPDATE SET updated_at = excluded.updated_at",
+                (thread_id, now),
+            )
+            await conn.commit()
+        if now - self._last_purge > PURGE_INTERVAL:
+            self._last_purge = now
+            await self.purge()
+
+    async def forget(self, thread_id: str) -> None:
+        saver = await self.saver()
+        await saver.adelete_thread(thread_id)
+        async with saver.lock:
+            await saver.conn.execute("DELETE FROM checkpoint_runs WHERE thread_id = ?", (thread_id,))
+            await saver.conn.commit()
+
+    async def purge(self) -> int:
+        """Drop runs past the TTL, then the oldest beyond max_runs"""
+        saver = await self.saver()
+        async with saver.lock:
+            cursor = await saver.conn.execute(
+                "SELECT thread_id FROM checkpoint_runs WHERE updated_at < ? OR thread_id NOT IN "
+                "(SELECT thread_id FROM checkpoint_runs ORDER BY updated_at DESC LIMIT ?)",
+                (time.time() - self.ttl, self.max_runs),
+            )
+            expired = [row[0] for row in await cursor.fetchall()]
+        for thread_id in expired:
+            await self.forget(thread_id)
+        if expired:
+            logger.info("Dropped %s expired checkpointed runs", len(expired))
+        return len(expired)
+
+    async def aclose(self) -> None:
+        if self._saver is not None:
+            await self._saver.conn.close()
+            self._saver = None
+            self._loop = None
+
+
+_store: Optional[CheckpointStore] = None
+_init_lock = threading.Lock()
+
+
+def get_checkpoint_store() -> CheckpointStore:
+    """Process-wide checkpoint store, configured from the environment on first use"""
+    global _store
+    if _store is None:
+        with _init_lock:
+            if _store is None:
+                _store = CheckpointStore(
+                    os.getenv("TRIP_CHECKPOINT_PATH", DEFAULT_CHECKPOINT_PATH),
+                    ttl=float(os.getenv("TRIP_CHECKPOINT_TTL_S", DEFAULT_TTL)),
+                    max_runs=int(os.getenv("TRIP_CHECKPOINT_MAX_RUNS", DEFAULT_MAX_RUNS)),
+                )
+    return _store
+
+
+async def aclose_checkpoints() -> None:
+    """Close the checkpoint connection, call from the FastAPI lifespan on shutdown"""
+    if _store is not None:
+        await _store.aclose()
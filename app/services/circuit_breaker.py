@@ -0,0 +1,160 @@
+"""
+Per-provider circuit breakers for Gemini and Serper.
+
+After <PROVIDER>_CIRCUIT_FAILURES failed calls in a row the breaker opens,
+and every call to that provider fails at once with CircuitOpen instead of
+waiting for its own error or timeout. After <PROVIDER>_CIRCUIT_OPEN_S
+seconds it half-opens: one call is let through as a probe, its success
+closes the breaker and its failure opens it again.
+
+The breakers sit inside rate_limit.limited(), so every upstream call is
+covered. The tools answer a CircuitOpen with the last known good cached
+section (marked stale), and refresh it in the background once the breaker
+half-opens, see app/tools/all_tools.py.
+
+A call that is cancelled after running for CIRCUIT_SLOW_CALL_S seconds
+(a node timeout) counts as a failure, so a provider that hangs opens the
+breaker just like one that errors. A 429 / quota error does not: the
+provider is healthy, just busy, and the AIMD bucket in rate_limit.py backs
+off for it.
+
+Configuration (environment), per provider GEMINI_* / SERPER_*:
+    <PROVIDER>_CIRCUIT_FAILURES   consecutive failures that open it (default: 5)
+    <PROVIDER>_CIRCUIT_OPEN_S     seconds before the probe          (default: 30)
+    CIRCUIT_SLOW_CALL_S           cancelled calls this slow count as failures (default: 15)
+"""
+
+import logging
+import os
+import threading
+import time
+from typing import Any, Dict
+
+from app.services.metrics import ERRORS
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+DEFAULT_FAILURES = 5
+DEFAULT_OPEN_SECONDS = 30.0
+DEFAULT_SLOW_CALL = 15.0
+
+
+class CircuitOpen(Exception):
+    """The provider's breaker is open, the call was not attempted"""
+
+    def __init__(self, provider: str, retry_after: float):
+        super().__init__(f"{provider} circuit is open, retry after {retry_after:.0f}s")
+        self.provider = provider
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """Consecutive-failure breaker with a single half-open probe"""
+
+    def __init__(self, name: str, failure_threshold: int = DEFAULT_FAILURES,
+                 open_seconds: float = DEFAULT_OPEN_SECONDS, slow_call: float = DEFAULT_SLOW_CALL):
+        self.name = name
+        self.failure_threshold = max(1, failure_threshold)
+        self.open_seconds = open_seconds
+        self.slow_call = slow_call
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def _current(self, now: float) -> str:
+        if self._state == OPEN and now >= self._opened_at + self.open_seconds:
+            return HALF_OPEN
+        return self._state
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._current(time.monotonic())
+
+    def before_call(self) -> bool:
+        """Raise CircuitOpen unless the call may go ahead; True when it is the half-open probe"""
+        with self._lock:
+            now = time.monotonic()
+            state = self._current(now)
+            if state == CLOSED:
+                return False
+            if state == HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            retry_after = max(0.0, self._opened_at + self.open_seconds - now)
+        ERRORS.labels(component=f"circuit_open_{self.name}").inc()
+        raise CircuitOpen(self.name, retry_after)
+
+    def on_success(self) -> None:
+        with self._lock:
+            if self._state != CLOSED:
+                logger.info("%s circuit closed", self.name)
+            self._state = CLOSED
+            self._failures = 0
+            self._probing = False
+
+    def on_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            if self._probing or (self._state == CLOSED and self._failures >= self.failure_threshold):
+                if self._state == CLOSED:
+                    logger.warning("%s circuit opened after %s failures", self.name, self._failures)
+                self._state = OPEN
+                self._opened_at = time.monotonic()
+            self._probing = False
+
+    def on_throttled(self) -> None:
+        """The provider answered 429; left to the rate limiter, not a failure"""
+        with self._lock:
+            self._probing = False
+
+    def on_abandoned(self, elapsed: float) -> None:
+        """The call was cancelled; only a slow one says something about the provider"""
+        if elapsed >= self.slow_call:
+            self.on_failure()
+            return
+        with self._lock:
+            self._probing = False
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"state": self._current(time.monotonic()), "failures": self._failures}
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def _env_number(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, default))
+    except ValueError:
+        return default
+
+
+def get_breaker(provider: str) -> CircuitBreaker:
+    """Shared breaker for a provider, configured from the environment"""
+    breaker = _breakers.get(provider)
+    if breaker is None:
+        with _breakers_lock:
+            breaker = _breakers.get(provider)
+            if breaker is None:
+                prefix = provider.upper()
+                breaker = CircuitBreaker(
+                    provider,
+                    failure_threshold=int(_env_number(f"{prefix}_CIRCUIT_FAILURES", DEFAULT_FAILURES)),
+                    open_seconds=_env_number(f"{prefix}_CIRCUIT_OPEN_S", DEFAULT_OPEN_SECONDS),
+                    slow_call=_env_number("CIRCUIT_SLOW_CALL_S", DEFAULT_SLOW_CALL),
+                )
+                _breakers[provider] = breaker
+    return breaker
+
+
+def breaker_stats() -> Dict[str, Dict[str, Any]]:
+    return {name: breaker.stats() for name, breaker in list(_breakers.items())}
@@ -1,11 +1,43 @@
 from app.schemas.course_schema import Course, Topic, CourseSkeleton
-from langchain.output_parsers import PydanticOutputParser
-from langchain_google_genai import ChatGoogleGenerativeAI
-from langchain.prompts import PromptTemplate
+from langchain_core.output_parsers import PydanticOutputParser
+from app.services.course_store import course_key, get_course_store
+from app.services.llm_client import get_chat_model, message_text
+from app.services.circuit_breaker import CircuitOpen
+from app.services.rate_limit import limited, limited_sync
+from app.services.structured_output import aparse_or_reask, parse_or_reask
+from langchain_core.prompts import PromptTemplate
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
+import asyncio
+import logging
+import os
+import time
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
+# Topics are independent once the skeleton exists, so they are generated
+# concurrently: COURSE_TOPIC_CONCURRENCY at a time (a request may ask for
+# more, up to COURSE_TOPIC_MAX_CONCURRENCY), each retried up to
+# COURSE_TOPIC_RETRIES times on its own before the build gives up.
+DEFAULT_TOPIC_CONCURRENCY = 4
+DEFAULT_TOPIC_MAX_CONCURRENCY = 16
+DEFAULT_TOPIC_RETRIES = 2
+RETRY_BACKOFF_S = 0.5
+
+
+def _topic_concurrency(concurrency=None):
+    if concurrency is None:
+        concurrency = int(os.getenv("COURSE_TOPIC_CONCURRENCY", DEFAULT_TOPIC_CONCURRENCY))
+    # Client-supplied, so capped server-side like the trip batch endpoint
+    max_concurrency = int(os.getenv("COURSE_TOPIC_MAX_CONCURRENCY", DEFAULT_TOPIC_MAX_CONCURRENCY))
+    return max(1, min(concurrency, max_concurrency))
+
+
+def _topic_retries():
+    return max(0, int(os.getenv("COURSE_TOPIC_RETRIES", DEFAULT_TOPIC_RETRIES)))
+
 # Parsers
 parser_course_skeleton = PydanticOutputParser(pydantic_object=CourseSkeleton)
 parser_course = PydanticOutputParser(pydantic_object=Course)
@@ -61,9 +93,22 @@ Experience: {experience}
 )
 
 
+# Output that does not parse is repaired locally first; only if that fails is
+# the model asked to fix its answer, which is much cheaper than regenerating it
+def _reask(model):
+    return lambda prompt: message_text(limited_sync("gemini", model.model, lambda: model.invoke(prompt)))
+
+
+def _areask(model):
+    async def reask(prompt):
+        result = await limited("gemini", model.model, lambda: model.ainvoke(prompt))
+        return message_text(result)
+    return reask
+
+
 # Create course skeleton
 def create_course(course_title: str, description: str, knowledge: str, difficulty: str, experience: str):
-    model = ChatGoogleGenerativeAI(model="gemini-2.0-flash")
+    model = get_chat_model()
     prompt = course_template.invoke({
         "course_title": course_title,
         "description": description,
@@ -71,14 +116,16 @@ def create_course(course_title: str, description: str, knowledge: str, difficult
         "difficulty": difficulty,
         "experience": experience,
     })
-    result = model.invoke(prompt)
-    course_data = parser_course_skeleton.parse(result.content)
+    result = limited_sync("gemini", model.model, lambda: model.invoke(prompt))
+    course_data = parse_or_reask(
+        message_text(result), CourseSkeleton, _reask(model), parser_course_skeleton.get_format_instructions()
+    )
     return course_data
 
 
 # Create topic content
 def create_topic(topic_title: str, description: str, knowledge: str, difficulty: str, experience: str):
-    model = ChatGoogleGenerativeAI(model="gemini-2.0-flash")
+    model = get_chat_model()
     prompt = topic_template.invoke({
         "topic_title": topic_title,
         "description": description,
@@ -86,36 +133,217 @@ def create_topic(topic_title: str, description: str, knowledge: str, difficulty:
         "difficulty": difficulty,
         "experience": experience,
     })
-    result = model.invoke(prompt)
-    topic_data = parser_topic.parse(result.content)
+    result = limited_sync("gemini", model.model, lambda: model.invoke(prompt))
+    topic_data = parse_or_reask(message_text(result), Topic, _reask(model), parser_topic.get_format_instructions())
     return topic_data
 
 
-# Build full course
-def build_whole_fucking_course(course_title: str, description: str, knowledge: str, difficulty: str, experience: str):
-    course_json = create_course(
-        course_title=course_title,
-        description=description,
-        knowledge=knowledge,
-        difficulty=difficulty,
-        experience=experience,
+# Async twins, await the LLM instead of blocking a thread per call
+async def acreate_course(course_title: str, description: str, knowledge: str, difficulty: str, experience: str):
+    model = get_chat_model()
+    prompt = course_template.invoke({
+        "course_title": course_title,
+        "description": description,
+        "knowledge": knowledge,
+        "difficulty": difficulty,
+        "experience": experience,
+    })
+    result = await limited("gemini", model.model, lambda: model.ainvoke(prompt))
+    return await aparse_or_reask(
+        message_text(result), CourseSkeleton, _areask(model), parser_course_skeleton.get_format_instructions()
     )
 
-    final_topics = []
-    for topic in course_json.topics:
-        topic_detail = create_topic(
-            topic_title=topic.title,  # ✅ now clearly topic-level
-            description=description,
-            knowledge=knowledge,
-            difficulty=difficulty,
-            experience=experience,
-        )
-        final_topics.append(topic_detail)
+
+async def acreate_topic(topic_title: str, description: str, knowledge: str, difficulty: str, experience: str):
+    model = get_chat_model()
+    prompt = topic_template.invoke({
+        "topic_title": topic_title,
+        "description": description,
+        "knowledge": knowledge,
+        "difficulty": difficulty,
+        "experience": experience,
+    })
+    result = await limited("gemini", model.model, lambda: model.ainvoke(prompt))
+    return await aparse_or_reask(message_text(result), Topic, _areask(model), parser_topic.get_format_instructions())
+
+
+# A failed topic (upstream error or unparseable output) is retried on its own,
+# the topics that already succeeded are kept. An open Gemini breaker fails the
+# topic at once, the checkpoint lets a later build pick it up
+def _create_topic_with_retry(topic_title: str, **inputs):
+    retries = _topic_retries()
+    for attempt in range(retries + 1):
+        try:
+            return create_topic(topic_title=topic_title, **inputs)
+        except Exception as e:
+            if attempt == retries or isinstance(e, CircuitOpen):
+                raise
+            logger.warning("Topic '%s' failed (attempt %s): %s, retrying", topic_title, attempt + 1, e)
+            time.sleep(RETRY_BACKOFF_S * 2 ** attempt)
+
+
+async def _acreate_topic_with_retry(topic_title: str, **inputs):
+    retries = _topic_retries()
+    for attempt in range(retries + 1):
+        try:
+            return await acreate_topic(topic_title=topic_title, **inputs)
+        except Exception as e:
+            if attempt == retries or isinstance(e, CircuitOpen):
+                raise
+            logger.warning("Topic '%s' failed (attempt %s): %s, retrying", topic_title, attempt + 1, e)
+            await asyncio.sleep(RETRY_BACKOFF_S * 2 ** attempt)
+
+
+def _stored_skeleton(store, key):
+    skeleton = store.get_skeleton(key)
+    return CourseSkeleton.model_validate(skeleton) if skeleton is not None else None
+
+
+def _stored_topics(store, key, skeleton):
+    # Positions past the end of the skeleton cannot be placed, ignore them
+    return {
+        position: Topic.model_validate(topic)
+        for position, topic in store.get_topics(key).items()
+        if position < len(skeleton.topics)
+    }
+
+
+# Build full course. The skeleton and each finished topic are checkpointed in
+# the course store, so a rerun after a failure only generates what is missing.
+# A finished build deletes its checkpoint, the next one starts afresh.
+def build_whole_fucking_course(course_title: str, description: str, knowledge: str, difficulty: str, experience: str,
+                               concurrency: int = None):
+    inputs = {
+        "description": description,
+        "knowledge": knowledge,
+        "difficulty": difficulty,
+        "experience": experience,
+    }
+    store = get_course_store()
+    key = course_key(course_title, **inputs)
+
+    course_json = _stored_skeleton(store, key)
+    if course_json is None:
+        course_json = create_course(course_title=course_title, **inputs)
+        # A concurrent build that saved first wins, both then share its topics
+        course_json = CourseSkeleton.model_validate(store.save_skeleton(key, course_json.model_dump()))
+    topics = _stored_topics(store, key, course_json)
+
+    def topic_detail(position):
+        topic = _create_topic_with_retry(topic_title=course_json.topics[position].title, **inputs)
+        store.save_topic(key, position, topic.model_dump())
+        return position, topic
+
+    missing = [position for position in range(len(course_json.topics)) if position not in topics]
+    with ThreadPoolExecutor(max_workers=_topic_concurrency(concurrency)) as pool:
+        topics.update(pool.map(topic_detail, missing))
 
     final_course = Course(
         title=course_json.title,
         duration=course_json.duration,
-        topics=final_topics,
+        topics=[topics[position] for position in range(len(course_json.topics))],
     )
+    store.delete(key)
 
     return final_course.model_dump_json(indent=2)
+
+
+async def astream_course(course_title: str, description: str, knowledge: str, difficulty: str, experience: str,
+                         concurrency: int = None):
+    """
+    Build a course as a stream of events: `skeleton` first, then one `topic`
+    per topic as it completes (checkpointed ones first, flagged `resumed`), a
+    `topic_error` for a topic that failed all its retries, and a final
+    `course` event carrying the assembled Course once every topic exists.
+    A failed topic does not stop the others; rerunning with the same inputs
+    resumes from the topics still missing. Once the course is complete its
+    checkpoint is deleted.
+    """
+    inputs = {
+        "description": description,
+        "knowledge": knowledge,
+        "difficulty": difficulty,
+        "experience": experience,
+    }
+    # The store is blocking SQLite, every call runs in a worker thread
+    store = await asyncio.to_thread(get_course_store)
+    key = course_key(course_title, **inputs)
+
+    skeleton = await asyncio.to_thread(_stored_skeleton, store, key)
+    resumed = skeleton is not None
+    if skeleton is None:
+        skeleton = await acreate_course(course_title=course_title, **inputs)
+        # A concurrent build that saved first wins, both then share its topics
+        created = skeleton.model_dump()
+        stored = await asyncio.to_thread(store.save_skeleton, key, created)
+        resumed = stored != created
+        skeleton = CourseSkeleton.model_validate(stored)
+    yield {"event": "skeleton", "course_key": key, "resumed": resumed, "skeleton": skeleton.model_dump()}
+
+    topics = await asyncio.to_thread(_stored_topics, store, key, skeleton)
+    for position in sorted(topics):
+        yield {"event": "topic", "index": position, "resumed": True, "topic": topics[position].model_dump()}
+
+    semaphore = asyncio.Semaphore(_topic_concurrency(concurrency))
+
+    async def topic_detail(position):
+        title = skeleton.topics[position].title
+        try:
+            async with semaphore:
+                topic = await _acreate_topic_with_retry(topic_title=title, **inputs)
+        except Exception as e:
+            logger.error("Topic '%s' failed after retries: %s", title, e)
+            return position, None, e
+        await asyncio.to_thread(store.save_topic, key, position, topic.model_dump())
+        return position, topic, None
+
+    missing = [position for position in range(len(skeleton.topics)) if position not in topics]
+    tasks = [asyncio.create_task(topic_detail(position)) for position in missing]
+    try:
+        for finished in asyncio.as_completed(tasks):
+            position, topic, error = await finished
+            if error is not None:
+                yield {
+                    "event": "topic_error",
+                    "index": position,
+                    "title": skeleton.topics[position].title,
+                    "message": str(error),
+                }
+                continue
+            topics[position] = topic
+            yield {"event": "topic", "index": position, "resumed": False, "topic": topic.model_dump()}
+    finally:
+        # Consumer went away mid-stream; finished topics are already saved
+        for task in tasks:
+            task.cancel()
+
+    complete = len(topics) == len(skeleton.topics)
+    course = None
+    if complete:
+        course = Course(
+            title=skeleton.title,
+            duration=skeleton.duration,
+            topics=[topics[position] for position in range(len(skeleton.topics))],
+        ).model_dump()
+        # Only unfinished builds are resumed
+        await asyncio.to_thread(store.delete, key)
+    yield {
+        "event": "course",
+        "course_key": key,
+        "complete": complete,
+        "missing": [position for position in range(len(skeleton.topics)) if position not in topics],
+        "course": course,
+    }
+
+
+async def abuild_whole_fucking_course(course_title: str, description: str, knowledge: str, difficulty: str,
+                                      experience: str, concurrency: int = None):
+    """Async build_whole_fucking_course, for use from the event loop"""
+    errors = []
+    async for event in astream_course(course_title, description, knowledge, difficulty, experience, concurrency):
+        if event["event"] == "topic_error":
+            errors.append(f"{event['title']}: {event['message']}")
+        elif event["event"] == "course":
+            if not event["complete"]:
+                raise RuntimeError(f"Course incomplete, failed topics: {'; '.join(errors)}")
+            return Course.model_validate(event["course"]).model_dump_json(indent=2)
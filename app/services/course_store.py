@@ -0,0 +1,169 @@
+"""
+Checkpoints for course builds.
+
+A course build is one skeleton call plus one call per topic, and any topic
+can fail. The skeleton and every finished topic are saved under a key
+derived from the course inputs, so a rerun with the same inputs reuses them
+and only generates the topics that are still missing.
+
+Saving a skeleton is insert-if-absent: when two builds of the same inputs
+race, the second adopts the first one's skeleton instead of replacing it
+and dropping the topics already saved for it.
+
+Only unfinished builds are kept: a build that assembles its course deletes
+its checkpoint, so the next build with the same inputs generates a new
+course. Checkpoints of builds that never finish are dropped after
+COURSE_CHECKPOINT_TTL_S seconds.
+
+Configuration (environment):
+    COURSE_STORE_PATH         sqlite file                          (default: .cache/courses.sqlite3)
+    COURSE_CHECKPOINT_TTL_S   seconds an unfinished build is kept  (default: 86400)
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Optional
+
+DEFAULT_STORE_PATH = os.path.join(".cache", "courses.sqlite3")
+DEFAULT_TTL = 24 * 60 * 60
+# Expired checkpoints are deleted at most this often
+PURGE_INTERVAL = 60.0
+
+
+def course_key(course_title: str, description: str, knowledge: str, difficulty: str, experience: str) -> str:
+    """Stable key for one set of course inputs"""
+    inputs = {
+        "course_title": course_title,
+        "description": description,
+        "knowledge": knowledge,
+        "difficulty": difficulty,
+        "experience": experience,
+    }
+    payload = json.dumps({k: str(v).strip() for k, v in inputs.items()}, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class CourseStore:
+    """Skeleton and finished topics per course key, dropped `ttl` seconds after the skeleton"""
+
+    def __init__(self, path: str = DEFAULT_STORE_PATH, ttl: float = DEFAULT_TTL):
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._last_purge = 0.0
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=5, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS course_skeleton (
+                course_key TEXT PRIMARY KEY,
+                skeleton TEXT NOT NULL,
+                created_at REAL NOT NULL
+            )
+            """
+        )
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS course_topic (
+                course_key TEXT NOT NULL,
+                position INTEGER NOT NULL,
+                topic TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                PRIMARY KEY (course_key, position)
+            )
+            """
+        )
+
+    def get_skeleton(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT skeleton FROM course_skeleton WHERE course_key = ? AND created_at >= ?",
+                (key, time.time() - self.ttl),
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def save_skeleton(self, key: str, skeleton: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Start a checkpoint unless a live one exists, and return the skeleton
+        the build must use: a concurrent build's, if it saved first
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(
+                    "SELECT skeleton FROM course_skeleton WHERE course_key = ? AND created_at >= ?",
+                    (key, now - self.ttl),
+                ).fetchone()
+                if row is not None:
+                    self._conn.execute("COMMIT")
+                    return json.loads(row[0])
+                # Topics left from an expired skeleton no longer fit this one
+                self._conn.execute("DELETE FROM course_topic WHERE course_key = ?", (key,))
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO course_skeleton (course_key, skeleton, created_at) VALUES (?, ?, ?)",
+                    (key, json.dumps(skeleton), now),
+                )
+                if now - self._last_purge > PURGE_INTERVAL:
+                    self._last_purge = now
+                    self._purge(now - self.ttl)
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return skeleton
+
+    def get_topics(self, key: str) -> Dict[int, Dict[str, Any]]:
+        """Finished topics by their position in the skeleton"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT position, topic FROM course_topic WHERE course_key = ?", (key,)
+            ).fetchall()
+        return {position: json.loads(topic) for position, topic in rows}
+
+    def save_topic(self, key: str, position: int, topic: Dict[str, Any]) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO course_topic (course_key, position, topic, created_at) "
+                "VALUES (?, ?, ?, ?)",
+                (key, position, json.dumps(topic), time.time()),
+            )
+
+    def delete(self, key: str) -> None:
+        """Forget a course, the next build starts from a fresh skeleton"""
+        with self._lock:
+            self._conn.execute("DELETE FROM course_topic WHERE course_key = ?", (key,))
+            self._conn.execute("DELETE FROM course_skeleton WHERE course_key = ?", (key,))
+
+    def _purge(self, cutoff: float) -> None:
+        self._conn.execute("DELETE FROM course_skeleton WHERE created_at < ?", (cutoff,))
+        # Topics of expired or deleted skeletons, and ones a concurrent build
+        # saved after its checkpoint was deleted
+        self._conn.execute(
+            "DELETE FROM course_topic WHERE course_key NOT IN (SELECT course_key FROM course_skeleton)"
+        )
+
+
+_course_store: Optional[CourseStore] = None
+_init_lock = threading.Lock()
+
+
+def get_course_store() -> CourseStore:
+    """Process-wide course store, opened on first use"""
+    global _course_store
+    if _course_store is None:
+        with _init_lock:
+            if _course_store is None:
+                _course_store = CourseStore(
+                    os.getenv("COURSE_STORE_PATH", DEFAULT_STORE_PATH),
+                    ttl=float(os.getenv("COURSE_CHECKPOINT_TTL_S", DEFAULT_TTL)),
+                )
+    return _course_store
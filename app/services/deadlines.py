@@ -0,0 +1,87 @@
+"""
+Time budgets for the trip pipeline.
+
+A plan has an overall deadline (TRIP_REQUEST_DEADLINE_S) and every node its
+own budget (TRIP_NODE_TIMEOUT_S, or TRIP_NODE_TIMEOUT_<NODE> for one node,
+e.g. TRIP_NODE_TIMEOUT_ACTIVITIES). A node past its budget is cancelled and
+its section reported as timed out instead of holding up the response.
+
+Upstream calls on the critical path can also be hedged: if the first attempt
+has not answered after TRIP_HEDGE_AFTER_S, a second identical call is started
+and whichever finishes first wins. Only the tools in TRIP_HEDGE_SECTIONS are
+hedged, since each hedge can cost one extra upstream call.
+"""
+
+import asyncio
+import os
+from typing import Awaitable, Callable, Optional, TypeVar
+
+T = TypeVar("T")
+
+DEFAULT_REQUEST_DEADLINE = 60.0
+DEFAULT_NODE_TIMEOUT = 30.0
+DEFAULT_HEDGE_SECTIONS = "generate_itinerary,recommend_activities"
+
+
+def _env_seconds(name: str, default: Optional[float]) -> Optional[float]:
+    value = os.getenv(name, "").strip()
+    if not value:
+        return default
+    try:
+        seconds = float(value)
+    except ValueError:
+        return default
+    # 0 or negative disables the limit
+    return seconds if seconds > 0 else None
+
+
+def request_deadline() -> Optional[float]:
+    """Seconds a whole plan may take, None for no limit"""
+    return _env_seconds("TRIP_REQUEST_DEADLINE_S", DEFAULT_REQUEST_DEADLINE)
+
+
+def node_timeout(node: str) -> Optional[float]:
+    """Seconds a single node may take, None for no limit"""
+    default = _env_seconds("TRIP_NODE_TIMEOUT_S", DEFAULT_NODE_TIMEOUT)
+    return _env_seconds(f"TRIP_NODE_TIMEOUT_{node.upper()}", default)
+
+
+def hedge_delay(tool_name: str) -> Optional[float]:
+    """Seconds before a hedged second attempt starts, None when not hedged"""
+    sections = os.getenv("TRIP_HEDGE_SECTIONS", DEFAULT_HEDGE_SECTIONS)
+    if tool_name not in {s.strip() for s in sections.split(",")}:
+        return None
+    return _env_seconds("TRIP_HEDGE_AFTER_S", None)
+
+
+async def hedged(call: Callable[[], Awaitable[T]], delay: Optional[float]) -> T:
+    """
+    Await `call()`; if it is still running after `delay` seconds start a
+    second attempt and return whichever succeeds first. An attempt that fails
+    does not win while the other is still running.
+    """
+    if delay is None:
+        return await call()
+
+    attempts = [asyncio.ensure_future(call())]
+    try:
+        done, _ = await asyncio.wait(attempts, timeout=delay)
+        if done:
+            return attempts[0].result()
+
+        attempts.append(asyncio.ensure_future(call()))
+        pending = set(attempts)
+        error: Optional[BaseException] = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        # On any exit, the caller's cancellation included, no attempt is left
+        # running on its own, spending quota and feeding the breaker
+        for task in attempts:
+            if not task.done():
+                task.cancel()
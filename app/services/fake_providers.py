@@ -0,0 +1,301 @@
+"""
+Fake Gemini and Serper backends for offline load and latency testing.
+
+The hardcoded mock strings in the tools return instantly, which hides every
+latency and concurrency problem. These fakes go through the real code paths
+instead (shared client registry, cache, single-flight, rate limiter, graph)
+and only replace the network call with a configurable delay and output.
+
+Enable with TRIP_FAKE_PROVIDERS=llm,serper (or "all"). Each provider reads
+its own settings, FAKE_LLM_* for Gemini and FAKE_SERPER_* for Serper:
+    *_LATENCY_MS       median latency (default 800 for the LLM, 300 for Serper)
+    *_LATENCY_SIGMA    log-normal spread, 0 makes every call take the median
+    *_ERROR_RATE       fraction of calls raising a generic error
+    *_429_RATE         fraction of calls raising a 429 / RESOURCE_EXHAUSTED
+    *_OUTPUT_SIZE      characters of LLM text, or organic results for Serper
+    FAKE_SEED          seed for reproducible runs
+
+Prompts carrying a Pydantic format-instructions schema get a JSON instance
+of that schema back, so structured-output callers (the single-shot engine,
+the course builder) parse the fake output like a real one.
+"""
+
+import asyncio
+import json
+import math
+import os
+import random
+import re
+import threading
+import time
+from collections import Counter
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+from pydantic import ConfigDict
+
+_WORDS = (
+    "local market temple museum harbour garden street food tour evening morning "
+    "historic district train station walk river view festival tea noodle lesson "
+    "practice example concept module exercise review project pattern"
+).split()
+
+_SCHEMA_BLOCK = re.compile(r"```(?:json)?\s*(\{.*?\})\s*```", re.DOTALL)
+
+_calls: Counter = Counter()
+_calls_lock = threading.Lock()
+
+
+class FakeProviderError(Exception):
+    """Injected generic upstream failure"""
+
+
+class FakeRateLimitError(Exception):
+    """Injected quota error, shaped like the ones the rate limiter looks for"""
+
+    status_code = 429
+
+
+def enabled(provider: str) -> bool:
+    """True when TRIP_FAKE_PROVIDERS selects `provider` (llm or serper)"""
+    selected = {p.strip().lower() for p in os.getenv("TRIP_FAKE_PROVIDERS", "").split(",")}
+    return provider in selected or "all" in selected
+
+
+@dataclass
+class FakeProfile:
+    latency_ms: float
+    latency_sigma: float = 0.5
+    error_rate: float = 0.0
+    rate_limit_rate: float = 0.0
+    output_size: int = 1500
+
+    @classmethod
+    def from_env(cls, prefix: str, latency_ms: float, output_size: int) -> "FakeProfile":
+        def number(name: str, default: float) -> float:
+            try:
+                return float(os.getenv(f"{prefix}_{name}", default))
+            except ValueError:
+                return default
+
+        return cls(
+            latency_ms=number("LATENCY_MS", latency_ms),
+            latency_sigma=number("LATENCY_SIGMA", 0.5),
+            error_rate=number("ERROR_RATE", 0.0),
+            rate_limit_rate=number("429_RATE", 0.0),
+            output_size=int(number("OUTPUT_SIZE", output_size)),
+        )
+
+    def latency(self, rng: random.Random) -> float:
+        """Seconds for one call, log-normal around the median"""
+        return self.latency_ms / 1000 * math.exp(self.latency_sigma * rng.gauss(0, 1))
+
+    def failure(self, rng: random.Random, name: str) -> Optional[Exception]:
+        roll = rng.random()
+        if roll < self.rate_limit_rate:
+            return FakeRateLimitError(f"429 RESOURCE_EXHAUSTED: {name} quota exceeded (fake)")
+        if roll < self.rate_limit_rate + self.error_rate:
+            return FakeProviderError(f"{name} upstream error (fake)")
+        return None
+
+
+def _rng() -> random.Random:
+    seed = os.getenv("FAKE_SEED")
+    return random.Random(int(seed)) if seed else random.Random()
+
+
+def _count(name: str) -> None:
+    with _calls_lock:
+        _calls[name] += 1
+
+
+def fake_call_counts() -> Dict[str, int]:
+    """Upstream calls made against the fakes so far, per provider"""
+    with _calls_lock:
+        return dict(_calls)
+
+
+def _text(rng: random.Random, size: int) -> str:
+    words: List[str] = []
+    length = 0
+    while length < size:
+        word = rng.choice(_WORDS)
+        words.append(word)
+        length += len(word) + 1
+    return " ".join(words)[:max(size, 1)]
+
+
+def _resolve(schema: Dict[str, Any], defs: Dict[str, Any]) -> Dict[str, Any]:
+    ref = schema.get("$ref")
+    if ref:
+        return defs[ref.rsplit("/", 1)[-1]]
+    for combinator in ("anyOf", "oneOf", "allOf"):
+        options = [s for s in schema.get(combinator, []) if s.get("type") != "null"]
+        if options:
+            return _resolve(options[0], defs)
+    return schema
+
+
+def _string_leaves(schema: Dict[str, Any], defs: Dict[str, Any], items: int) -> int:
+    schema = _resolve(schema, defs)
+    if "properties" in schema:
+        return sum(_string_leaves(s, defs, items) for s in schema["properties"].values())
+    if schema.get("type") == "array":
+        return items * _string_leaves(schema.get("items", {}), defs, items)
+    return 1 if schema.get("type", "string") == "string" else 0
+
+
+def _instance(schema: Dict[str, Any], defs: Dict[str, Any], rng: random.Random,
+              string_size: int, items: int) -> Any:
+    """A value matching a (Pydantic-generated) JSON schema"""
+    schema = _resolve(schema, defs)
+    kind = schema.get("type")
+    if "properties" in schema:
+        return {
+            name: _instance(prop, defs, rng, string_size, items)
+            for name, prop in schema["properties"].items()
+        }
+    if kind == "array":
+        return [_instance(schema.get("items", {}), defs, rng, string_size, items) for _ in range(items)]
+    if kind == "integer":
+        return rng.randint(1, 10)
+    if kind == "number":
+        return round(rng.uniform(1, 10), 2)
+    if kind == "boolean":
+        return rng.random() < 0.5
+    return _text(rng, string_size)
+
+
+def fake_completion(prompt: str, size: int, rng: random.Random) -> str:
+    """Plain text of `size` characters, or JSON when the prompt embeds a schema"""
+    blocks = _SCHEMA_BLOCK.findall(prompt)
+    if blocks:
+        try:
+            schema = json.loads(blocks[-1])
+        except json.JSONDecodeError:
+            schema = None
+        if isinstance(schema, dict) and "properties" in schema:
+            defs = schema.get("$defs", {})
+            items = 3
+            string_size = max(12, size // max(1, _string_leaves(schema, defs, items)))
+            instance = _instance(schema, defs, rng, string_size, items)
+            return "```json\n" + json.dumps(instance, indent=2) + "\n```"
+    return _text(rng, size)
+
+
+class FakeChatModel(BaseChatModel):
+    """Stand-in for ChatGoogleGenerativeAI with simulated latency and failures"""
+
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    model: str = "fake-gemini"
+    profile: FakeProfile
+    rng: random.Random
+    max_output_tokens: Optional[int] = None
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-gemini"
+
+    def _respond(self, messages: List[BaseMessage]) -> ChatResult:
+        prompt = "\n".join(str(m.content) for m in messages)
+        text = fake_completion(prompt, self.profile.output_size, self.rng)
+        if self.max_output_tokens:
+            # Gemini stops mid-answer at the cap, about four characters a token
+            text = text[:self.max_output_tokens * 4]
+        message = AIMessage(
+            content=text,
+            usage_metadata={
+                "input_tokens": len(prompt) // 4,
+                "output_tokens": len(text) // 4,
+                "total_tokens": (len(prompt) + len(text)) // 4,
+            },
+        )
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        _count("llm")
+        time.sleep(self.profile.latency(self.rng))
+        error = self.profile.failure(self.rng, "gemini")
+        if error:
+            raise error
+        return self._respond(messages)
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        _count("llm")
+        await asyncio.sleep(self.profile.latency(self.rng))
+        error = self.profile.failure(self.rng, "gemini")
+        if error:
+            raise error
+        return self._respond(messages)
+
+
+class FakeSerper:
+    """Stand-in for GoogleSerperAPIWrapper's results()/aresults()"""
+
+    def __init__(self, profile: FakeProfile, rng: random.Random):
+        self.profile = profile
+        self.rng = rng
+
+    def _results(self, query: str) -> Dict[str, Any]:
+        error = self.profile.failure(self.rng, "serper")
+        if error:
+            raise error
+        slug = re.sub(r"[^a-z0-9]+", "-", query.lower()).strip("-")
+        return {
+            "organic": [
+                {
+                    "title": f"{query} - result {i + 1}",
+                    "link": f"https://example.com/{slug}/{i + 1}",
+                    "snippet": _text(self.rng, 120),
+                }
+                for i in range(self.profile.output_size)
+            ]
+        }
+
+    def results(self, query: str, **kwargs) -> Dict[str, Any]:
+        _count("serper")
+        time.sleep(self.profile.latency(self.rng))
+        return self._results(query)
+
+    async def aresults(self, query: str, **kwargs) -> Dict[str, Any]:
+        _count("serper")
+        await asyncio.sleep(self.profile.latency(self.rng))
+        return self._results(query)
+
+
+_fake_llm: Optional[FakeChatModel] = None
+_fake_serper: Optional[FakeSerper] = None
+
+
+def get_fake_chat_model(max_output_tokens: Optional[int] = None) -> FakeChatModel:
+    """Shared fake Gemini client, configured from FAKE_LLM_* on first use"""
+    global _fake_llm
+    if _fake_llm is None:
+        _fake_llm = FakeChatModel(
+            profile=FakeProfile.from_env("FAKE_LLM", latency_ms=800, output_size=1500), rng=_rng()
+        )
+    if max_output_tokens:
+        # Same profile and random stream, only the output cap differs
+        return _fake_llm.model_copy(update={"max_output_tokens": max_output_tokens})
+    return _fake_llm
+
+
+def get_fake_serper() -> FakeSerper:
+    """Shared fake Serper client, configured from FAKE_SERPER_* on first use"""
+    global _fake_serper
+    if _fake_serper is None:
+        _fake_serper = FakeSerper(FakeProfile.from_env("FAKE_SERPER", latency_ms=300, output_size=10), _rng())
+    return _fake_serper
+
+
+def reset_fakes() -> None:
+    """Drop the shared fakes and counters, so the next call re-reads the environment"""
+    global _fake_llm, _fake_serper
+    _fake_llm = None
+    _fake_serper = None
+    with _calls_lock:
+        _calls.clear()
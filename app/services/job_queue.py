@@ -0,0 +1,195 @@
+"""
+Durable queue for trip jobs.
+
+POST /trip/jobs only writes a row here and returns; worker processes
+(app.services.job_worker) claim rows, run the agent and write the progress
+and result back. API and workers only share the SQLite file, so they scale
+and restart independently.
+
+A claimed job holds a lease that its worker keeps extending. When a worker
+dies, its lease runs out and the job is claimed again, up to
+TRIP_JOB_MAX_ATTEMPTS times. Finished jobs are kept for TRIP_JOB_RETENTION_S
+seconds so clients can still read the result.
+
+Configuration (environment):
+    TRIP_JOB_DB            sqlite file                        (default: .cache/jobs.sqlite3)
+    TRIP_JOB_LEASE_S       seconds a claim lasts without a heartbeat (default: 120)
+    TRIP_JOB_MAX_ATTEMPTS  claims before a job is failed      (default: 3)
+    TRIP_JOB_RETENTION_S   seconds finished jobs are kept     (default: 86400)
+    TRIP_JOB_MAX_QUEUED    queued jobs before new ones are refused (default: 10000)
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Any, Dict, Optional
+
+DEFAULT_JOB_DB = os.path.join(".cache", "jobs.sqlite3")
+DEFAULT_LEASE = 120.0
+DEFAULT_MAX_ATTEMPTS = 3
+DEFAULT_RETENTION = 24 * 60 * 60
+
+_COLUMNS = "id, status, engine, state, progress, result, error, attempts, created_at, updated_at"
+
+
+def _row(row) -> Dict[str, Any]:
+    job = dict(zip([c.strip() for c in _COLUMNS.split(",")], row))
+    job["state"] = json.loads(job["state"])
+    job["progress"] = json.loads(job["progress"])
+    job["result"] = json.loads(job["result"]) if job["result"] else None
+    return job
+
+
+class JobQueue:
+    """Trip jobs in one SQLite file: queued -> running -> done | failed"""
+
+    def __init__(self, path: str = DEFAULT_JOB_DB, lease: float = DEFAULT_LEASE,
+                 max_attempts: int = DEFAULT_MAX_ATTEMPTS):
+        self.path = path
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=10, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # An accepted job must survive a power cut, not just a process crash
+        self._conn.execute("PRAGMA synchronous=FULL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                engine TEXT NOT NULL,
+                state TEXT NOT NULL,
+                progress TEXT NOT NULL,
+                result TEXT,
+                error TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                worker TEXT,
+                lease_until REAL,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+            """
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at)")
+
+    def enqueue(self, state: Dict[str, Any], engine: str = "graph") -> str:
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO jobs (id, status, engine, state, progress, created_at, updated_at) "
+                "VALUES (?, 'queued', ?, ?, '{}', ?, ?)",
+                (job_id, engine, json.dumps(state), now, now),
+            )
+        return job_id
+
+    def claim(self, worker: str) -> Optional[Dict[str, Any]]:
+        """
+        Oldest queued job, or a running one whose worker stopped renewing its
+        lease, marked as running for `worker`. None when there is nothing to do.
+        """
+        now = time.time()
+        with self._lock:
+            # IMMEDIATE takes the write lock up front, so two workers never
+            # claim the same row
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute(
+                    "UPDATE jobs SET status = 'failed', error = 'gave up after ' || attempts || ' attempts', "
+                    "lease_until = NULL, updated_at = ? "
+                    "WHERE status = 'running' AND lease_until < ? AND attempts >= ?",
+                    (now, now, self.max_attempts),
+                )
+                row = self._conn.execute(
+                    f"UPDATE jobs SET status = 'running', worker = ?, lease_until = ?, "
+                    f"attempts = attempts + 1, updated_at = ? "
+                    f"WHERE id = (SELECT id FROM jobs WHERE status = 'queued' "
+                    f"OR (status = 'running' AND lease_until < ?) ORDER BY created_at LIMIT 1) "
+                    f"RETURNING {_COLUMNS}",
+                    (worker, now + self.lease, now, now),
+                ).fetchone()
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return _row(row) if row else None
+
+    def _update(self, job_id: str, worker: str, sets: str, params: tuple) -> bool:
+        # Only the worker holding the claim may write, a reclaimed job belongs
+        # to its new worker
+        with self._lock:
+            cursor = self._conn.execute(
+                f"UPDATE jobs SET {sets}, updated_at = ? WHERE id = ? AND worker = ? AND status = 'running'",
+                (*params, time.time(), job_id, worker),
+            )
+        return cursor.rowcount == 1
+
+    def heartbeat(self, job_id: str, worker: str) -> bool:
+        """Extend the lease; False when the job is no longer ours"""
+        return self._update(job_id, worker, "lease_until = ?", (time.time() + self.lease,))
+
+    def update_progress(self, job_id: str, worker: str, progress: Dict[str, str]) -> bool:
+        return self._update(job_id, worker, "progress = ?", (json.dumps(progress),))
+
+    def complete(self, job_id: str, worker: str, result: Dict[str, Any], progress: Dict[str, str]) -> bool:
+        return self._update(
+            job_id, worker, "status = 'done', result = ?, progress = ?, lease_until = NULL",
+            (json.dumps(result), json.dumps(progress)),
+        )
+
+    def fail(self, job_id: str, worker: str, error: str, attempts: int) -> bool:
+        """Back to the queue for another attempt, or failed for good"""
+        if attempts < self.max_attempts:
+            return self._update(job_id, worker, "status = 'queued', error = ?, worker = NULL, lease_until = NULL",
+                                (error,))
+        return self._update(job_id, worker, "status = 'failed', error = ?, lease_until = NULL", (error,))
+
+    def release(self, job_id: str, worker: str) -> bool:
+        """Hand an unfinished job back on shutdown, without using up an attempt"""
+        return self._update(
+            job_id, worker, "status = 'queued', worker = NULL, lease_until = NULL, attempts = attempts - 1", (),
+        )
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._conn.execute(f"SELECT {_COLUMNS} FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return _row(row) if row else None
+
+    def counts(self) -> Dict[str, int]:
+        with self._lock:
+            rows = self._conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        return {status: count for status, count in rows}
+
+    def purge(self, older_than: float) -> int:
+        """Drop finished jobs last updated more than `older_than` seconds ago"""
+        with self._lock:
+            cursor = self._conn.execute(
+                "DELETE FROM jobs WHERE status IN ('done', 'failed') AND updated_at < ?",
+                (time.time() - older_than,),
+            )
+        return cursor.rowcount
+
+
+_queue: Optional[JobQueue] = None
+_init_lock = threading.Lock()
+
+
+def get_job_queue() -> JobQueue:
+    """Job queue for this process, opened from the environment on first use"""
+    global _queue
+    if _queue is None:
+        with _init_lock:
+            if _queue is None:
+                _queue = JobQueue(
+                    os.getenv("TRIP_JOB_DB", DEFAULT_JOB_DB),
+                    lease=float(os.getenv("TRIP_JOB_LEASE_S", DEFAULT_LEASE)),
+                    max_attempts=int(os.getenv("TRIP_JOB_MAX_ATTEMPTS", DEFAULT_MAX_ATTEMPTS)),
+                )
+    return _queue
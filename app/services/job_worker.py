@@ -0,0 +1,221 @@
+"""
+Worker processes for the trip job queue.
+
+    python -m app.services.job_worker                   # TRIP_JOB_WORKERS processes
+    python -m app.services.job_worker --processes 8
+    python -m app.services.job_worker --once            # drain the queue, then exit
+
+Each process runs its own event loop with up to TRIP_JOB_CONCURRENCY jobs at
+a time, so one process already overlaps many slow upstream calls; more
+processes add CPU for parsing and prompt building. Workers only need the
+same TRIP_JOB_DB as the API (and ideally SECTION_CACHE_BACKEND=sqlite, so
+both share sections).
+
+Queue calls are blocking SQLite writes, so they run in worker threads: a
+slow fsync must not stall the other jobs on the loop or their heartbeats.
+
+SIGTERM or Ctrl-C stops claiming, hands running jobs back to the queue and
+exits. A worker that is killed outright loses its leases after
+TRIP_JOB_LEASE_S and another worker picks its jobs up.
+
+Configuration (environment):
+    TRIP_JOB_WORKERS       worker processes                 (default: 2)
+    TRIP_JOB_CONCURRENCY   jobs per process                 (default: 8)
+    TRIP_JOB_POLL_S        idle seconds between claims      (default: 0.5)
+"""
+
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import sqlite3
+import time
+from typing import Any, Dict, Optional
+
+from app.services.job_queue import DEFAULT_RETENTION, get_job_queue
+
+logger = logging.getLogger(__name__)
+
+# Retention purge runs at most this often per process
+PURGE_INTERVAL = 60.0
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, default))
+    except ValueError:
+        return default
+
+
+async def run_job(job: Dict[str, Any], worker: str) -> None:
+    """Run one claimed job to completion, keeping its lease alive meanwhile"""
+    # Agent modules imported here so the worker's parent process stays light
+    from app.agents.single_shot import arun_single_shot
+    from app.agents.trip_agent import arun_trip_agent
+    from app.schemas.trip_schema import TokenUsage, TripResponse
+    from app.services.plan_store import save_plan
+    from app.services.token_usage import start_token_usage
+
+    queue = get_job_queue()
+    job_id = job["id"]
+    latest: Optional[Dict[str, str]] = None
+    writer: Optional[asyncio.Task] = None
+
+    async def write_progress():
+        # Only the newest statuses are written, one write at a time
+        nonlocal latest
+        while latest is not None:
+            statuses, latest = latest, None
+            try:
+                await asyncio.to_thread(queue.update_progress, job_id, worker, statuses)
+            except sqlite3.Error as e:
+                logger.warning("Could not record progress of job %s: %s", job_id, e)
+
+    def on_progress(statuses: Dict[str, str]) -> None:
+        nonlocal latest, writer
+        latest = statuses
+        if writer is None or writer.done():
+            writer = asyncio.ensure_future(write_progress())
+
+    async def heartbeat():
+        while True:
+            await asyncio.sleep(queue.lease / 3)
+            if not await asyncio.to_thread(queue.heartbeat, job_id, worker):
+                logger.warning("Job %s lost its lease", job_id)
+                return
+
+    beat = asyncio.create_task(heartbeat())
+    # Counts only this attempt; a resumed job does not pay again for the
+    # sections its checkpoint already holds
+    usage = start_token_usage()
+    try:
+        state = dict(job["state"])
+        sections = state.pop("sections", None)
+        if job["engine"] == "single_shot":
+            result = await arun_single_shot(state, fallback=lambda s, **kw: arun_trip_agent(s, on_progress, **kw))
+        else:
+            # Checkpointed under the job id, a reclaimed job resumes where the
+            # previous worker stopped
+            result = await arun_trip_agent(state, on_progress, sections, thread_id=job_id)
+        response = TripResponse.from_state(result, sections)
+        response.plan_id = await asyncio.to_thread(save_plan, result, sections)
+        response.token_usage = TokenUsage.model_validate(usage)
+        await asyncio.to_thread(
+            queue.complete, job_id, worker, response.model_dump(exclude_none=True), response.section_status
+        )
+    except asyncio.CancelledError:
+        await asyncio.to_thread(queue.release, job_id, worker)
+        raise
+    except Exception as e:
+        logger.exception("Job %s failed: %s", job_id, e)
+        await asyncio.to_thread(queue.fail, job_id, worker, f"{type(e).__name__}: {e}", job["attempts"])
+    finally:
+        beat.cancel()
+        if writer is not None:
+            # Progress of a finished job is ignored by the queue anyway
+            writer.cancel()
+
+
+async def run_worker(concurrency: int, poll: float, once: bool = False) -> None:
+    """Claim and run jobs until stopped (or, with `once`, until the queue is empty)"""
+    from app.agents.trip_agent import get_trip_agent
+    from app.services.checkpoints import aclose_checkpoints
+    from app.services.llm_client import aclose_chat_models
+    from app.services.serper_client import aclose_serper_client
+
+    get_trip_agent()
+    queue = await asyncio.to_thread(get_job_queue)
+    worker = f"{socket.gethostname()}:{os.getpid()}"
+    retention = _env_int("TRIP_JOB_RETENTION_S", DEFAULT_RETENTION)
+    slots = asyncio.Semaphore(max(1, concurrency))
+    running = set()
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, RuntimeError):
+            pass
+
+    logger.info("Job worker %s started, %s jobs at a time", worker, concurrency)
+    last_purge = 0.0
+    try:
+        while not stop.is_set():
+            if time.monotonic() - last_purge > PURGE_INTERVAL:
+                last_purge = time.monotonic()
+                purged = await asyncio.to_thread(queue.purge, retention)
+                if purged:
+                    logger.info("Purged %s finished jobs", purged)
+
+            await slots.acquire()
+            job = await asyncio.to_thread(queue.claim, worker)
+            if job is None:
+                slots.release()
+                if once and not running:
+                    break
+                try:
+                    await asyncio.wait_for(stop.wait(), poll)
+                except TimeoutError:
+                    pass
+                continue
+
+            logger.info("Job %s claimed (attempt %s)", job["id"], job["attempts"])
+            task = asyncio.create_task(run_job(job, worker))
+            running.add(task)
+            task.add_done_callback(running.discard)
+            task.add_done_callback(lambda _: slots.release())
+    finally:
+        # Unfinished jobs go back to the queue for the next worker
+        for task in list(running):
+            task.cancel()
+        await asyncio.gather(*running, return_exceptions=True)
+        await aclose_chat_models()
+        await aclose_serper_client()
+        await aclose_checkpoints()
+        logger.info("Job worker %s stopped", worker)
+
+
+def _worker_main(concurrency: int, poll: float, once: bool) -> None:
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper(),
+                        format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    asyncio.run(run_worker(concurrency, poll, once))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run trip jobs from the durable job queue")
+    parser.add_argument("--processes", type=int, default=None, help="override TRIP_JOB_WORKERS")
+    parser.add_argument("--concurrency", type=int, default=None, help="override TRIP_JOB_CONCURRENCY")
+    parser.add_argument("--once", action="store_true", help="exit once the queue is empty")
+    args = parser.parse_args()
+
+    processes = args.processes or _env_int("TRIP_JOB_WORKERS", 2)
+    concurrency = args.concurrency or _env_int("TRIP_JOB_CONCURRENCY", 8)
+    poll = float(os.getenv("TRIP_JOB_POLL_S", "0.5"))
+
+    if processes <= 1:
+        _worker_main(concurrency, poll, args.once)
+    else:
+        # spawn: every worker opens its own SQLite connections and HTTP pools
+        context = multiprocessing.get_context("spawn")
+        children = [
+            context.Process(target=_worker_main, args=(concurrency, poll, args.once), name=f"trip-worker-{i}")
+            for i in range(processes)
+        ]
+        for child in children:
+            child.start()
+
+        def forward(signum, _frame):
+            for child in children:
+                if child.is_alive():
+                    os.kill(child.pid, signum)
+
+        signal.signal(signal.SIGTERM, forward)
+        signal.signal(signal.SIGINT, forward)
+        for child in children:
+            child.join()
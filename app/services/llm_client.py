@@ -0,0 +1,110 @@
+"""
+Process-wide registry of Gemini chat clients.
+
+Building a ChatGoogleGenerativeAI is not free: it validates settings, creates
+a google-genai client and a fresh httpx connection pool. Tools used to do that
+on every call, throwing the warm connections away each time. Here clients are
+built once per (model, settings) and shared by every tool and service.
+"""
+
+import logging
+import os
+import threading
+from typing import TYPE_CHECKING, Any, Dict, Tuple
+
+if TYPE_CHECKING:
+    from langchain_google_genai import ChatGoogleGenerativeAI
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MODEL = "gemini-2.0-flash"
+DEFAULT_POOL_SIZE = 20
+
+_clients: Dict[Tuple, "ChatGoogleGenerativeAI"] = {}
+_lock = threading.Lock()
+
+
+def _pool_size() -> int:
+    """Max HTTP connections per client, set with GEMINI_POOL_SIZE"""
+    try:
+        return max(1, int(os.getenv("GEMINI_POOL_SIZE", DEFAULT_POOL_SIZE)))
+    except ValueError:
+        return DEFAULT_POOL_SIZE
+
+
+def _build_client(model: str, api_key: str, settings: Dict[str, Any]) -> "ChatGoogleGenerativeAI":
+    # Imported here: google-genai is heavy and only needed once a real call is made
+    import httpx
+    from langchain_google_genai import ChatGoogleGenerativeAI
+
+    pool_size = _pool_size()
+    limits = httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+    return ChatGoogleGenerativeAI(
+        model=model,
+        google_api_key=api_key,
+        client_args={"limits": limits},
+        **settings,
+    )
+
+
+def get_chat_model(model: str = DEFAULT_MODEL, **settings: Any) -> "ChatGoogleGenerativeAI":
+    """
+    Return the shared client for this model and settings, creating it on first use.
+    Extra keyword arguments (temperature, max_output_tokens, ...) are passed to
+    ChatGoogleGenerativeAI and become part of the registry key.
+    """
+    from app.services import fake_providers
+
+    if fake_providers.enabled("llm"):
+        # Offline load testing, see app/services/fake_providers.py
+        return fake_providers.get_fake_chat_model(settings.get("max_output_tokens"))
+
+    api_key = os.getenv("GOOGLE_API_KEY")
+    if not api_key:
+        raise ValueError("GOOGLE_API_KEY environment variable not set")
+
+    # The key is part of the registry key so a rotated key gets a new client
+    key = (model, api_key, tuple(sorted(settings.items())))
+    client = _clients.get(key)
+    if client is None:
+        with _lock:
+            client = _clients.get(key)
+            if client is None:
+                client = _build_client(model, api_key, settings)
+                _clients[key] = client
+    return client
+
+
+def message_text(message: Any) -> str:
+    """
+    Text of a chat message or stream chunk. `.text` is a property in
+    langchain-core 1.x but a method in 0.3.x, so the content is read directly:
+    a string, or a list of content blocks whose text parts are joined.
+    """
+    content = getattr(message, "content", message)
+    if isinstance(content, str):
+        return content
+    parts = []
+    for block in content or ():
+        if isinstance(block, str):
+            parts.append(block)
+        elif isinstance(block, dict) and block.get("type") == "text":
+            parts.append(block.get("text", ""))
+    return "".join(parts)
+
+
+def client_count() -> int:
+    """Number of live clients in the registry"""
+    return len(_clients)
+
+
+async def aclose_chat_models() -> None:
+    """Close every pooled client, call from the FastAPI lifespan on shutdown"""
+    with _lock:
+        clients = list(_clients.values())
+        _clients.clear()
+    for client in clients:
+        try:
+            await client.aclose()
+        except Exception as e:
+            logger.warning("Error closing chat model client: %s", e)
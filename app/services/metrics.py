@@ -0,0 +1,106 @@
+"""
+Prometheus metrics and per-request timings.
+
+Everything the pipeline measures goes through here: node and tool wall time,
+upstream (Gemini / Serper) latency, LLM tokens, section cache hits, errors and
+requests in flight. `GET /metrics` renders the registry; with several uvicorn
+workers set PROMETHEUS_MULTIPROC_DIR so the workers' samples are aggregated.
+
+`timed()` also records into the current request's timing collector, which
+the routes turn into a `Server-Timing` header when TRIP_SERVER_TIMING is set.
+"""
+
+import contextvars
+import os
+import time
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+# LLM calls take seconds, cache hits microseconds; cover both ends
+_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 60)
+
+REQUEST_SECONDS = Histogram(
+    "trip_request_duration_seconds", "End-to-end request latency", ["endpoint"], buckets=_BUCKETS
+)
+NODE_SECONDS = Histogram(
+    "trip_node_duration_seconds", "Wall time per trip_agent node", ["node"], buckets=_BUCKETS
+)
+TOOL_SECONDS = Histogram(
+    "trip_tool_duration_seconds", "Wall time per tool call, cache hits included", ["tool"], buckets=_BUCKETS
+)
+UPSTREAM_SECONDS = Histogram(
+    "trip_upstream_duration_seconds", "Latency of calls to Gemini and Serper",
+    ["provider", "operation"], buckets=_BUCKETS,
+)
+CACHE_LOOKUPS = Counter(
+    "trip_section_cache_lookups_total", "Section cache lookups", ["section", "result"]
+)
+ERRORS = Counter("trip_errors_total", "Errors by component", ["component"])
+STRUCTURED_PARSES = Counter(
+    "trip_structured_output_parses_total",
+    "Structured model output parses by outcome (clean, repaired, reasked, failed)",
+    ["schema", "outcome"],
+)
+REPLAN_SECTIONS = Counter(
+    "trip_replan_sections_total", "Sections of re-planned trips by outcome (reused, recomputed)", ["outcome"]
+)
+LLM_TOKENS = Counter(
+    "trip_llm_tokens_total", "LLM tokens by operation, direction (input, output) and source (reported, estimated)",
+    ["operation", "direction", "source"],
+)
+IN_FLIGHT = Gauge(
+    "trip_requests_in_flight", "Requests currently being served", ["endpoint"], multiprocess_mode="livesum"
+)
+
+_timings: contextvars.ContextVar[Optional[Dict[str, float]]] = contextvars.ContextVar(
+    "trip_server_timings", default=None
+)
+
+
+def server_timing_enabled() -> bool:
+    return os.getenv("TRIP_SERVER_TIMING", "").strip().lower() in ("1", "true", "yes", "on")
+
+
+def start_request_timings() -> Dict[str, float]:
+    """Begin collecting timings for the current request (and the tasks it spawns)"""
+    timings: Dict[str, float] = {}
+    _timings.set(timings)
+    return timings
+
+
+def server_timing_header(timings: Dict[str, float]) -> str:
+    """Format collected timings, e.g. `node_weather;dur=812.4, total;dur=1650.2`"""
+    return ", ".join(f"{name};dur={seconds * 1000:.1f}" for name, seconds in timings.items())
+
+
+@contextmanager
+def timed(histogram: Histogram, timing_name: Optional[str] = None, **labels: str):
+    """Observe the block's wall time on `histogram` and in the request timings"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        histogram.labels(**labels).observe(elapsed)
+        timings = _timings.get()
+        if timing_name and timings is not None:
+            timings[timing_name] = timings.get(timing_name, 0.0) + elapsed
+
+
+def render_metrics():
+    """Body and content type for the /metrics endpoint"""
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(), CONTENT_TYPE_LATEST
@@ -0,0 +1,115 @@
+"""
+Finished trip plans, kept so a plan can be re-planned incrementally.
+
+Every generated plan is saved under a plan id with its canonical
+preferences, its sections and their statuses. POST /trip/replan loads a
+plan, applies a preference change and recomputes only the sections that
+read a changed field (see PREFERENCE_DEPENDENCIES in app.agents.trip_agent);
+the rest are reused as they are.
+
+Configuration (environment):
+    TRIP_PLAN_STORE_PATH   sqlite file                  (default: .cache/plans.sqlite3)
+    TRIP_PLAN_TTL_S        seconds a plan is kept       (default: 604800, a week)
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_STORE_PATH = os.path.join(".cache", "plans.sqlite3")
+DEFAULT_TTL = 7 * 24 * 60 * 60
+# Expired plans are deleted at most this often
+PURGE_INTERVAL = 60.0
+
+
+class PlanStore:
+    """Plans by id in a single SQLite file, dropped after `ttl` seconds"""
+
+    def __init__(self, path: str = DEFAULT_STORE_PATH, ttl: float = DEFAULT_TTL):
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._last_purge = 0.0
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=5, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS plans (
+                plan_id TEXT PRIMARY KEY,
+                plan TEXT NOT NULL,
+                created_at REAL NOT NULL
+            )
+            """
+        )
+
+    def save(self, plan: Dict[str, Any]) -> str:
+        plan_id = uuid.uuid4().hex
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO plans (plan_id, plan, created_at) VALUES (?, ?, ?)",
+                (plan_id, json.dumps(plan), now),
+            )
+            if now - self._last_purge > PURGE_INTERVAL:
+                self._last_purge = now
+                self._conn.execute("DELETE FROM plans WHERE created_at < ?", (now - self.ttl,))
+        return plan_id
+
+    def get(self, plan_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT plan FROM plans WHERE plan_id = ? AND created_at >= ?",
+                (plan_id, time.time() - self.ttl),
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+
+_plan_store: Optional[PlanStore] = None
+_init_lock = threading.Lock()
+
+
+def get_plan_store() -> PlanStore:
+    """Process-wide plan store, opened on first use"""
+    global _plan_store
+    if _plan_store is None:
+        with _init_lock:
+            if _plan_store is None:
+                _plan_store = PlanStore(
+                    os.getenv("TRIP_PLAN_STORE_PATH", DEFAULT_STORE_PATH),
+                    ttl=float(os.getenv("TRIP_PLAN_TTL_S", DEFAULT_TTL)),
+                )
+    return _plan_store
+
+
+def save_plan(result: Dict[str, Any], sections: Optional[List[str]] = None) -> Optional[str]:
+    """
+    Store a final agent state and return its plan id. Storage problems are
+    logged and give None, a plan is still served without an id.
+    """
+    from app.agents.trip_agent import SECTION_KEYS
+
+    section_status = result.get("section_status", {})
+    plan = {
+        "preferences": result.get("preferences", {}),
+        "sections": sections,
+        # Every section that ran, including dependencies that were not
+        # requested (the itinerary behind activities), so replans can reuse them
+        "values": {key: result.get(key) for key in SECTION_KEYS.values() if key in section_status},
+        "section_status": section_status,
+    }
+    try:
+        return get_plan_store().save(plan)
+    except (sqlite3.Error, OSError) as e:
+        logger.warning("Could not store plan: %s", e)
+        return None
@@ -0,0 +1,294 @@
+"""
+Canonical trip preferences.
+
+"Tokyo", "tokyo ", "Tokyo, Japan" and "TOKYO" are the same trip, and so are
+"April", "apr" and "04". Preferences are canonicalized before they reach the
+agent, so the section cache and in-flight coalescing see one key for them.
+
+Destinations are resolved against a curated alias table only: an exact
+alias ("nyc", "Tokyo, Japan"), else the closest curated name by trigram
+similarity (typos such as "Barcelonna"). A qualifier after the first comma
+is kept unless the whole text is an alias, so "Paris, Texas", "Lagos,
+Portugal" and "Lagos, Nigeria" stay different trips. Anything else keeps
+the user's spelling, trimmed, since it goes into the prompts and the saved
+plan ("La Paz", "Washington, D.C."); only its key, from destination_key(),
+is casefolded. Nothing is learned: the key of a destination depends on the
+text alone, not on the order requests arrive in, so every worker and every
+restart computes the same one. Extra aliases can be loaded from a JSON file
+of {"Canonical": ["alias", ...]} via DESTINATION_ALIASES_PATH.
+
+Configuration (environment):
+    DESTINATION_ALIASES_PATH       extra aliases (optional)
+    DESTINATION_MATCH_THRESHOLD    trigram similarity for a fuzzy match (default: 0.6)
+"""
+
+import json
+import logging
+import os
+import re
+import threading
+from collections import defaultdict
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MATCH_THRESHOLD = 0.6
+# Report memory bound: raw spellings kept per canonical key, canonical keys tracked
+MAX_RAW_PER_KEY = 100
+MAX_TRACKED_KEYS = 10000
+# Resolved spellings remembered, resolution is deterministic so this is only a memo
+MAX_RESOLVED = 50000
+
+MONTHS = [
+    "January", "February", "March", "April", "May", "June",
+    "July", "August", "September", "October", "November", "December",
+]
+_MONTH_ALIASES = {"sept": "September"}
+
+_DESTINATION_ALIASES = {
+    "Tokyo": ["tokio", "tokyo japan"],
+    "Kyoto": ["kyoto japan"],
+    "Osaka": ["osaka japan"],
+    "Seoul": ["seoul korea", "seoul south korea"],
+    "Bangkok": ["krung thep", "bangkok thailand"],
+    "Bali": ["bali indonesia"],
+    "Singapore": ["singapore city"],
+    "Hong Kong": ["hk", "hongkong"],
+    "New York City": ["nyc", "new york", "new york ny", "manhattan"],
+    "Los Angeles": ["la", "los angeles ca"],
+    "San Francisco": ["sf", "san fran"],
+    "Mexico City": ["cdmx", "ciudad de mexico", "mexico df"],
+    "Rio de Janeiro": ["rio"],
+    "London": ["london uk", "london england"],
+    "Paris": ["paris france"],
+    "Rome": ["roma", "rome italy"],
+    "Barcelona": ["barca", "barcelona spain"],
+    "Lisbon": ["lisboa"],
+    "Prague": ["praha"],
+    "Vienna": ["wien"],
+    "Munich": ["munchen", "münchen"],
+    "Florence": ["firenze"],
+    "Venice": ["venezia"],
+    "Istanbul": ["constantinople"],
+    "Dubai": ["dubai uae"],
+    "Marrakech": ["marrakesh"],
+    "Cape Town": ["capetown"],
+    "Sydney": ["sydney australia"],
+    "Reykjavik": ["reykjavík"],
+    "Delhi": ["new delhi"],
+    "Mumbai": ["bombay"],
+    "Ho Chi Minh City": ["saigon", "hcmc"],
+    "Beijing": ["peking"],
+}
+
+
+def _normalize(text: str) -> str:
+    """casefold, punctuation to spaces (commas kept), single spaces"""
+    text = re.sub(r"[^\w\s,']", " ", text.casefold())
+    text = re.sub(r"\s*,\s*", ", ", text)
+    return " ".join(text.split()).strip(" ,")
+
+
+def _trim(text: str) -> str:
+    """The user's spelling with single spaces and no stray commas at the ends"""
+    return " ".join(text.split()).strip(" ,")
+
+
+def destination_key(destination: str) -> str:
+    """Key form of a resolved destination, "Paris, texas" and "paris, Texas" are one trip"""
+    return _normalize(destination or "")
+
+
+def _trigrams(text: str) -> Set[str]:
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def canonical_month(month: str) -> str:
+    """"apr", "04", "4" and "April" all become "April"; anything else is kept, trimmed"""
+    value = _normalize(month or "").replace(" ", "")
+    if value.isdigit() and 1 <= int(value) <= 12:
+        return MONTHS[int(value) - 1]
+    if value in _MONTH_ALIASES:
+        return _MONTH_ALIASES[value]
+    if len(value) >= 3:
+        for name in MONTHS:
+            if name.lower().startswith(value):
+                return name
+    return (month or "").strip()
+
+
+def canonical_interests(interests: List[str]) -> List[str]:
+    """Trimmed, lower-cased, de-duplicated and sorted"""
+    return sorted({_normalize(i) for i in interests or [] if _normalize(i)})
+
+
+class DestinationIndex:
+    """Curated alias table plus a trigram index over its canonical destinations"""
+
+    def __init__(self, aliases: Dict[str, List[str]], threshold: float = DEFAULT_MATCH_THRESHOLD):
+        self.threshold = threshold
+        self._aliases: Dict[str, str] = {}
+        self._grams: Dict[str, Set[str]] = {}
+        self._postings: Dict[str, Set[str]] = defaultdict(set)
+        self._resolved: Dict[str, str] = {}
+        self._lock = threading.Lock()
+        for canonical, names in aliases.items():
+            self.add(canonical, names)
+
+    def add(self, canonical: str, aliases: List[str] = ()) -> None:
+        """Curate a destination; only names added here are ever canonical"""
+        with self._lock:
+            self._add(canonical, aliases)
+            self._resolved.clear()
+
+    def _add(self, canonical: str, aliases: List[str] = ()) -> None:
+        for name in (canonical, *aliases):
+            self._aliases[_normalize(name)] = canonical
+        key = _normalize(canonical)
+        if key not in self._grams:
+            grams = _trigrams(key)
+            self._grams[key] = grams
+            for gram in grams:
+                self._postings[gram].add(key)
+
+    def _closest(self, text: str) -> Optional[str]:
+        grams = _trigrams(text)
+        candidates: Dict[str, int] = defaultdict(int)
+        for gram in grams:
+            for key in self._postings.get(gram, ()):
+                candidates[key] += 1
+        best, best_score = None, 0.0
+        for key, shared in candidates.items():
+            score = shared / len(grams | self._grams[key])
+            if score > best_score:
+                best, best_score = key, score
+        return self._aliases[best] if best is not None and best_score >= self.threshold else None
+
+    def _place(self, spelling: str) -> str:
+        """Curated name for one place, by alias or closest match, else the user's spelling"""
+        text = _normalize(spelling)
+        if text in self._aliases:
+            return self._aliases[text]
+        match = self._closest(text)
+        return match if match is not None else _trim(spelling)
+
+    def _resolve(self, spelling: str) -> str:
+        text = _normalize(spelling)
+        for candidate in (text, text.replace(",", "")):
+            if candidate in self._aliases:
+                return self._aliases[candidate]
+        head, _, qualifier = spelling.partition(",")
+        place = self._place(head)
+        qualifier = _trim(qualifier)
+        # "Paris, France" is an alias, "Paris, Texas" a different city
+        return f"{place}, {qualifier}" if _normalize(qualifier) else place
+
+    def resolve(self, destination: str) -> str:
+        """Curated name for the destination, else the user's spelling, trimmed"""
+        spelling = _trim(destination or "")
+        if not _normalize(spelling):
+            return (destination or "").strip()
+        with self._lock:
+            canonical = self._resolved.get(spelling)
+            if canonical is None:
+                canonical = self._resolve(spelling)
+                if len(self._resolved) < MAX_RESOLVED:
+                    self._resolved[spelling] = canonical
+            return canonical
+
+
+class CollapseTracker:
+    """How many distinct raw preference payloads map onto each canonical key"""
+
+    def __init__(self):
+        self._raw: Dict[str, Set[str]] = {}
+        self._requests: Dict[str, int] = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def record(self, raw_key: str, canonical_key: str) -> None:
+        with self._lock:
+            raw = self._raw.get(canonical_key)
+            if raw is None:
+                if len(self._raw) >= MAX_TRACKED_KEYS:
+                    return
+                raw = self._raw[canonical_key] = set()
+            if len(raw) < MAX_RAW_PER_KEY:
+                raw.add(raw_key)
+            self._requests[canonical_key] += 1
+
+    def report(self, top: int = 20) -> Dict[str, Any]:
+        with self._lock:
+            rows = [
+                {
+                    "canonical": json.loads(key),
+                    "raw_variants": len(raw),
+                    "requests": self._requests[key],
+                    "examples": [json.loads(r) for r in sorted(raw)[:5]],
+                }
+                for key, raw in self._raw.items()
+            ]
+        rows.sort(key=lambda row: (row["raw_variants"], row["requests"]), reverse=True)
+        raw_total = sum(row["raw_variants"] for row in rows)
+        return {
+            "canonical_keys": len(rows),
+            "raw_keys": raw_total,
+            "collapse_ratio": round(raw_total / len(rows), 3) if rows else 0.0,
+            "top": rows[:top],
+        }
+
+
+def _stable_key(preferences: Dict[str, Any]) -> str:
+    return json.dumps(preferences, sort_keys=True, ensure_ascii=False)
+
+
+def preferences_key(preferences: Dict[str, Any]) -> str:
+    """Stable key for canonical preferences, the destination in its key form"""
+    return _stable_key({**preferences, "destination": destination_key(preferences.get("destination", ""))})
+
+
+class PreferenceCanonicalizer:
+    def __init__(self, index: DestinationIndex):
+        self.index = index
+        self.tracker = CollapseTracker()
+
+    def canonicalize(self, preferences: Dict[str, Any]) -> Tuple[Dict[str, Any], str]:
+        """Canonical copy of the preferences and its stable cache key"""
+        canonical = dict(preferences)
+        canonical["destination"] = self.index.resolve(preferences.get("destination", ""))
+        canonical["month"] = canonical_month(preferences.get("month", ""))
+        canonical["interests"] = canonical_interests(preferences.get("interests", []))
+        for field in ("budget_type", "travelStyle", "travel_style"):
+            if isinstance(canonical.get(field), str):
+                canonical[field] = canonical[field].strip().lower()
+        key = preferences_key(canonical)
+        self.tracker.record(_stable_key(preferences), key)
+        return canonical, key
+
+
+def _load_aliases() -> Dict[str, List[str]]:
+    aliases = {name: list(names) for name, names in _DESTINATION_ALIASES.items()}
+    path = os.getenv("DESTINATION_ALIASES_PATH")
+    if path:
+        try:
+            with open(path) as f:
+                for canonical, names in json.load(f).items():
+                    aliases.setdefault(canonical, []).extend(names)
+        except (OSError, ValueError) as e:
+            logger.warning("Could not load destination aliases from %s: %s", path, e)
+    return aliases
+
+
+_canonicalizer: Optional[PreferenceCanonicalizer] = None
+_init_lock = threading.Lock()
+
+
+def get_canonicalizer() -> PreferenceCanonicalizer:
+    """Process-wide canonicalizer, built from the environment on first use"""
+    global _canonicalizer
+    if _canonicalizer is None:
+        with _init_lock:
+            if _canonicalizer is None:
+                threshold = float(os.getenv("DESTINATION_MATCH_THRESHOLD", DEFAULT_MATCH_THRESHOLD))
+                _canonicalizer = PreferenceCanonicalizer(DestinationIndex(_load_aliases(), threshold))
+    return _canonicalizer
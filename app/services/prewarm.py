@@ -0,0 +1,354 @@
+"""
+Background pre-warming of the sections that only depend on where and when.
+
+Weather, food & culture and useful links are keyed on (destination, month)
+or (destination, budget_type), and most traffic goes to a few hundred
+destinations. Live requests are counted per (destination, month,
+budget_type). During off-peak hours the warmer fills the section cache for
+the top-N combinations, so that a popular request only pays for the
+itinerary and activities calls.
+
+Counting a request is an in-memory increment; a background thread flushes
+the counts to SQLite every PREWARM_FLUSH_S seconds, so the request path
+never waits on the disk. Counts decay with a half-life of
+PREWARM_DEMAND_HALF_LIFE_S, and combinations nobody asks for anymore fade
+out of the table.
+
+Each run spends at most PREWARM_CALL_BUDGET upstream calls. Sections that
+are already cached cost nothing, and a section is only warmed when its own
+provider is configured (Gemini for weather and food, Serper for links):
+mock results are never cached. The warmer runs inside the app
+(PREWARM_ENABLED=1) or as its own process:
+
+    python -m app.services.prewarm            # loop, warming in off-peak hours
+    python -m app.services.prewarm --once     # one run now, then exit
+
+A separate process only helps the API when both share the section cache, so
+use SECTION_CACHE_BACKEND=sqlite with the same SECTION_CACHE_PATH.
+
+Every uvicorn / gunicorn worker with PREWARM_ENABLED runs the loop, but the
+processes sharing PREWARM_DEMAND_PATH elect one warmer through a lease row
+in that file, so the budget is spent once per host rather than once per
+worker. The holder renews the lease every run, for one and a half
+PREWARM_INTERVAL_S; when it dies, another process takes over once it runs
+out.
+
+Configuration (environment):
+    PREWARM_ENABLED       run the warmer inside the app   (default: off)
+    PREWARM_TOP_N         combinations warmed per run     (default: 50)
+    PREWARM_CALL_BUDGET   upstream calls per run          (default: 100)
+    PREWARM_HOURS         local off-peak hours, e.g. 1-6 or 22-5 (default: 1-6)
+    PREWARM_INTERVAL_S    seconds between checks          (default: 900)
+    PREWARM_CONCURRENCY   sections warmed at once         (default: 4)
+    PREWARM_DEMAND_PATH   sqlite file for request counts (default: .cache/demand.sqlite3)
+    PREWARM_FLUSH_S       seconds between demand flushes (default: 5)
+    PREWARM_DEMAND_HALF_LIFE_S  half-life of request counts (default: 604800, a week)
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from app.services.section_cache import get_section_cache
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DEMAND_PATH = os.path.join(".cache", "demand.sqlite3")
+DEFAULT_FLUSH_INTERVAL = 5.0
+DEFAULT_HALF_LIFE = 7 * 24 * 60 * 60
+# Counts are decayed at most this often, across every process sharing the file
+DECAY_INTERVAL = 60 * 60
+# Combinations whose decayed count falls below this are forgotten
+MIN_REQUESTS = 0.5
+
+
+class DemandTracker:
+    """
+    Request counts per (destination, month, budget_type), counted in memory
+    and flushed to SQLite from a background thread, so every process sharing
+    the file contributes
+    """
+
+    def __init__(self, path: str = DEFAULT_DEMAND_PATH, flush_interval: float = DEFAULT_FLUSH_INTERVAL,
+                 half_life: float = DEFAULT_HALF_LIFE):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.half_life = half_life
+        self._lock = threading.Lock()
+        self._pending: Counter = Counter()
+        self._pending_lock = threading.Lock()
+        self._flusher: Optional[threading.Thread] = None
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=5, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS demand (
+                destination TEXT NOT NULL,
+                month TEXT NOT NULL,
+                budget_type TEXT NOT NULL,
+                requests REAL NOT NULL,
+                last_seen REAL NOT NULL,
+                PRIMARY KEY (destination, month, budget_type)
+            )
+            """
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS demand_decay (id INTEGER PRIMARY KEY, decayed_at REAL NOT NULL)"
+        )
+        self._conn.execute("INSERT OR IGNORE INTO demand_decay (id, decayed_at) VALUES (1, ?)", (time.time(),))
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS prewarm_leader (id INTEGER PRIMARY KEY, owner TEXT NOT NULL, until REAL NOT NULL)"
+        )
+
+    def record(self, destination: str, month: str, budget_type: str) -> None:
+        """Count one request in memory; the flusher thread writes it out"""
+        with self._pending_lock:
+            self._pending[(destination, month, budget_type)] += 1
+            if self._flusher is None:
+                self._flusher = threading.Thread(target=self._flush_loop, name="demand-flusher", daemon=True)
+                self._flusher.start()
+
+    def _flush_loop(self) -> None:
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except (sqlite3.Error, OSError) as e:
+                logger.warning("Could not flush demand: %s", e)
+
+    def flush(self) -> None:
+        """Write the pending counts and apply the decay when it is due"""
+        with self._pending_lock:
+            pending, self._pending = self._pending, Counter()
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.executemany(
+                    "INSERT INTO demand (destination, month, budget_type, requests, last_seen) "
+                    "VALUES (?, ?, ?, ?, ?) "
+                    "ON CONFLICT (destination, month, budget_type) "
+                    "DO UPDATE SET requests = requests + excluded.requests, last_seen = excluded.last_seen",
+                    [(*key, count, now) for key, count in pending.items()],
+                )
+                self._decay(now)
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                with self._pending_lock:
+                    # Counted again with the next flush
+                    self._pending.update(pending)
+                raise
+
+    def _decay(self, now: float) -> None:
+        (decayed_at,) = self._conn.execute("SELECT decayed_at FROM demand_decay WHERE id = 1").fetchone()
+        if now - decayed_at < DECAY_INTERVAL:
+            return
+        factor = 0.5 ** ((now - decayed_at) / self.half_life)
+        self._conn.execute("UPDATE demand SET requests = requests * ?", (factor,))
+        self._conn.execute("DELETE FROM demand WHERE requests < ?", (MIN_REQUESTS,))
+        self._conn.execute("UPDATE demand_decay SET decayed_at = ? WHERE id = 1", (now,))
+
+    def claim_warmer(self, owner: str, lease: float) -> bool:
+        """Become, or stay, the one warmer among the processes sharing this file"""
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute("SELECT owner, until FROM prewarm_leader WHERE id = 1").fetchone()
+                won = row is None or row[0] == owner or row[1] < now
+                if won:
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO prewarm_leader (id, owner, until) VALUES (1, ?, ?)",
+                        (owner, now + lease),
+                    )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return won
+
+    def top(self, n: int) -> List[Tuple[str, str, str, float]]:
+        """Most requested combinations, most recent first on ties"""
+        self.flush()
+        with self._lock:
+            return self._conn.execute(
+                "SELECT destination, month, budget_type, requests FROM demand "
+                "ORDER BY requests DESC, last_seen DESC LIMIT ?",
+                (n,),
+            ).fetchall()
+
+
+_tracker: Optional[DemandTracker] = None
+_init_lock = threading.Lock()
+
+
+def get_demand_tracker() -> DemandTracker:
+    global _tracker
+    if _tracker is None:
+        with _init_lock:
+            if _tracker is None:
+                _tracker = DemandTracker(
+                    os.getenv("PREWARM_DEMAND_PATH", DEFAULT_DEMAND_PATH),
+                    flush_interval=float(os.getenv("PREWARM_FLUSH_S", DEFAULT_FLUSH_INTERVAL)),
+                    half_life=float(os.getenv("PREWARM_DEMAND_HALF_LIFE_S", DEFAULT_HALF_LIFE)),
+                )
+    return _tracker
+
+
+def record_demand(preferences: Dict) -> None:
+    """Count one live request, in memory; never lets a tracking failure reach the caller"""
+    try:
+        get_demand_tracker().record(
+            preferences.get("destination", ""),
+            preferences.get("month", ""),
+            preferences.get("budget_type", ""),
+        )
+    except (sqlite3.Error, OSError) as e:
+        logger.warning("Could not record demand: %s", e)
+
+
+def flush_demand() -> None:
+    """Write out the counts not flushed yet, call on shutdown"""
+    if _tracker is not None:
+        try:
+            _tracker.flush()
+        except (sqlite3.Error, OSError) as e:
+            logger.warning("Could not flush demand: %s", e)
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, default))
+    except ValueError:
+        return default
+
+
+def in_off_peak(hours: Optional[str] = None, now: Optional[datetime] = None) -> bool:
+    """True when the local hour falls in PREWARM_HOURS ("1-6", or "22-5" across midnight)"""
+    hours = hours or os.getenv("PREWARM_HOURS", "1-6")
+    hour = (now or datetime.now()).hour
+    try:
+        start, end = (int(h) for h in hours.split("-", 1))
+    except ValueError:
+        logger.warning("Invalid PREWARM_HOURS '%s'", hours)
+        return False
+    if start <= end:
+        return start <= hour <= end
+    return hour >= start or hour <= end
+
+
+def _warm_targets():
+    # Tools imported here so the module stays cheap for the request path
+    from app.tools import all_tools
+
+    # Only sections whose provider is configured, mock results are never cached
+    targets = []
+    if all_tools.llm_available():
+        targets += [
+            ("weather_forecaster", all_tools._weather_inputs, all_tools.aweather_forecaster),
+            ("food_culture_recommender", all_tools._food_inputs, all_tools.afood_culture_recommender),
+        ]
+    if all_tools.serper_available():
+        targets.append(("fetch_useful_links", all_tools._links_inputs, all_tools.afetch_useful_links))
+    return targets
+
+
+async def warm_once(top_n: Optional[int] = None, budget: Optional[int] = None) -> Dict[str, int]:
+    """Fill the section cache for the top-N combinations within the call budget"""
+    top_n = top_n if top_n is not None else _env_int("PREWARM_TOP_N", 50)
+    budget = budget if budget is not None else _env_int("PREWARM_CALL_BUDGET", 100)
+    stats = {"combinations": 0, "cached": 0, "warmed": 0, "failed": 0, "skipped": 0}
+
+    targets = _warm_targets()
+    if not targets:
+        logger.info("Pre-warm skipped: no real LLM / Serper configured")
+        return stats
+
+    cache = get_section_cache()
+    jobs = []
+    queued = set()
+    # Flushes pending counts first, off the event loop
+    top = await asyncio.to_thread(get_demand_tracker().top, top_n)
+    for destination, month, budget_type, _ in top:
+        stats["combinations"] += 1
+        state = {"preferences": {"destination": destination, "month": month, "budget_type": budget_type}}
+        for tool_name, inputs, tool in targets:
+            key = cache.make_key(tool_name, inputs(state))
+            # Combinations share sections, e.g. weather across budgets
+            if key in queued or await cache.acontains(key):
+                stats["cached"] += 1
+            elif len(jobs) >= budget:
+                stats["skipped"] += 1
+            else:
+                queued.add(key)
+                jobs.append((tool, state))
+
+    semaphore = asyncio.Semaphore(max(1, _env_int("PREWARM_CONCURRENCY", 4)))
+
+    async def warm(tool, state):
+        async with semaphore:
+            result = await tool(state)
+        stats["failed" if result.get("warning") else "warmed"] += 1
+
+    await asyncio.gather(*[warm(tool, state) for tool, state in jobs])
+    logger.info("Pre-warm run: %s", stats)
+    return stats
+
+
+async def run_warmer(interval: Optional[float] = None) -> None:
+    """
+    Loop forever, warming once per interval while inside the off-peak window
+    and this process holds the warmer lease
+    """
+    interval = interval if interval is not None else _env_int("PREWARM_INTERVAL_S", 900)
+    owner = f"{socket.gethostname()}:{os.getpid()}"
+    while True:
+        if in_off_peak():
+            try:
+                # Outlasts the gap to the holder's next run, so it keeps the lease
+                if await asyncio.to_thread(get_demand_tracker().claim_warmer, owner, interval * 1.5):
+                    await warm_once()
+                else:
+                    logger.debug("Pre-warm left to another process")
+            except Exception as e:
+                logger.exception("Pre-warm run failed: %s", e)
+        await asyncio.sleep(interval)
+
+
+def prewarm_enabled() -> bool:
+    return os.getenv("PREWARM_ENABLED", "").strip().lower() in ("1", "true", "yes", "on")
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper(),
+                        format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    parser = argparse.ArgumentParser(description="Pre-warm hot destination x month sections")
+    parser.add_argument("--once", action="store_true", help="warm now, ignoring PREWARM_HOURS, then exit")
+    parser.add_argument("--top", type=int, default=None, help="override PREWARM_TOP_N")
+    parser.add_argument("--budget", type=int, default=None, help="override PREWARM_CALL_BUDGET")
+    args = parser.parse_args()
+
+    if os.getenv("SECTION_CACHE_BACKEND", "memory").strip().lower() != "sqlite":
+        logger.warning("SECTION_CACHE_BACKEND is not sqlite, the API will not see what this process warms")
+
+    if args.once:
+        print(asyncio.run(warm_once(args.top, args.budget)))
+    else:
+        asyncio.run(run_warmer())
@@ -0,0 +1,295 @@
+"""
+Quota protection for upstream providers, plus admission control for routes.
+
+Every Gemini / Serper call first passes the provider's circuit breaker (see
+circuit_breaker.py) and then takes a token from the bucket for its provider
+and model. Callers queue for a token (bounded by RATE_LIMIT_MAX_WAIT_S)
+instead of hammering the provider, and the bucket adapts AIMD-style: each success nudges the rate up towards its ceiling, each
+429 halves it. Throughput then settles at the quota instead of collapsing
+into retry storms.
+
+Configuration (environment), per provider GEMINI_* / SERPER_*:
+    <PROVIDER>_RATE_LIMIT_RPS   ceiling in requests per second
+    <PROVIDER>_RATE_BURST       bucket size
+    RATE_LIMIT_MAX_WAIT_S       longest a call may queue for a token
+
+The AdmissionController keeps routes from accepting more work than the
+limiters can drain: past TRIP_MAX_IN_FLIGHT running plans new requests queue
+(at most TRIP_MAX_QUEUE of them, for TRIP_QUEUE_TIMEOUT_S), and beyond that
+they are rejected at once with a Retry-After hint.
+"""
+
+import asyncio
+import math
+import os
+import threading
+import time
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, Dict, Optional, Tuple, TypeVar
+
+from app.services.circuit_breaker import get_breaker
+from app.services.metrics import ERRORS
+
+T = TypeVar("T")
+
+_DEFAULT_RPS = {"gemini": 10.0, "serper": 5.0}
+
+
+class RateLimitExceeded(Exception):
+    """No token within the allowed wait, or the provider answered 429"""
+
+    def __init__(self, message: str, retry_after: float = 1.0):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def is_rate_limit_error(error: BaseException) -> bool:
+    """Best-effort detection of a provider 429 / quota error"""
+    if isinstance(error, RateLimitExceeded):
+        return True
+    for attr in ("status_code", "code", "status"):
+        if getattr(error, attr, None) == 429:
+            return True
+    response = getattr(error, "response", None)
+    if getattr(response, "status_code", None) == 429:
+        return True
+    text = str(error).lower()
+    return "429" in text or "resource_exhausted" in text or "rate limit" in text or "quota" in text
+
+
+class AdaptiveTokenBucket:
+    """
+    Token bucket whose refill rate follows AIMD. Tokens are reserved, so the
+    bucket may go negative: the deficit is the queue, and each caller sleeps
+    for its own place in it outside the lock.
+    """
+
+    def __init__(self, name: str, rate: float, burst: float, min_rate: Optional[float] = None,
+                 increase: Optional[float] = None, decrease: float = 0.5):
+        self.name = name
+        self.max_rate = rate
+        self.rate = rate
+        self.min_rate = min_rate if min_rate is not None else max(rate / 20, 0.05)
+        self.increase = increase if increase is not None else max(rate / 50, 0.01)
+        self.decrease = decrease
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self, max_wait: Optional[float]) -> float:
+        """Take a token, return how long to wait for it; raise if that is too long"""
+        with self._lock:
+            self._refill(time.monotonic())
+            wait = 0.0 if self._tokens >= 1 else (1 - self._tokens) / self.rate
+            if max_wait is not None and wait > max_wait:
+                raise RateLimitExceeded(
+                    f"{self.name} rate limit queue is full (wait {wait:.1f}s)", retry_after=wait
+                )
+            self._tokens -= 1
+            return wait
+
+    async def acquire(self, max_wait: Optional[float] = None) -> None:
+        wait = self.reserve(max_wait)
+        if wait > 0:
+            try:
+                await asyncio.sleep(wait)
+            except asyncio.CancelledError:
+                # Deadline, losing hedge or gone client: the call never happens
+                self.refund()
+                raise
+
+    def refund(self) -> None:
+        """Give back a reserved token that was not used"""
+        with self._lock:
+            self._refill(time.monotonic())
+            self._tokens = min(self.burst, self._tokens + 1)
+
+    def acquire_sync(self, max_wait: Optional[float] = None) -> None:
+        wait = self.reserve(max_wait)
+        if wait > 0:
+            time.sleep(wait)
+
+    def on_success(self) -> None:
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def on_throttled(self) -> None:
+        with self._lock:
+            self._refill(time.monotonic())
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+            # Drop any saved-up burst, the provider just told us we are over
+            self._tokens = min(self._tokens, 0.0)
+
+
+_limiters: Dict[Tuple[str, str], AdaptiveTokenBucket] = {}
+_limiters_lock = threading.Lock()
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, default))
+    except ValueError:
+        return default
+
+
+def max_wait() -> float:
+    return _env_float("RATE_LIMIT_MAX_WAIT_S", 10.0)
+
+
+def get_limiter(provider: str, model: str = "default") -> AdaptiveTokenBucket:
+    """Shared bucket for a provider and model, configured from the environment"""
+    key = (provider, model)
+    limiter = _limiters.get(key)
+    if limiter is None:
+        with _limiters_lock:
+            limiter = _limiters.get(key)
+            if limiter is None:
+                prefix = provider.upper()
+                rate = _env_float(f"{prefix}_RATE_LIMIT_RPS", _DEFAULT_RPS.get(provider, 5.0))
+                burst = _env_float(f"{prefix}_RATE_BURST", max(1.0, rate))
+                limiter = AdaptiveTokenBucket(f"{provider}:{model}", rate, burst)
+                _limiters[key] = limiter
+    return limiter
+
+
+def _on_error(provider: str, limiter: AdaptiveTokenBucket, breaker, error: Exception) -> None:
+    """A 429 shrinks the bucket; only other errors count towards opening the breaker"""
+    if is_rate_limit_error(error):
+        ERRORS.labels(component=f"throttled_{provider}").inc()
+        limiter.on_throttled()
+        breaker.on_throttled()
+    else:
+        breaker.on_failure()
+
+
+async def limited(provider: str, model: str, call: Callable[[], Awaitable[T]]) -> T:
+    """
+    Await `call()` once the provider's circuit breaker lets it through and a
+    token is available, feeding the outcome back to both
+    """
+    breaker = get_breaker(provider)
+    breaker.before_call()
+    limiter = get_limiter(provider, model)
+    try:
+        await limiter.acquire(max_wait())
+    except BaseException:
+        breaker.on_abandoned(0.0)
+        raise
+    started = time.monotonic()
+    try:
+        result = await call()
+    except asyncio.CancelledError:
+        breaker.on_abandoned(time.monotonic() - started)
+        raise
+    except Exception as e:
+        _on_error(provider, limiter, breaker, e)
+        raise
+    limiter.on_success()
+    breaker.on_success()
+    return result
+
+
+def limited_sync(provider: str, model: str, call: Callable[[], T]) -> T:
+    """Blocking twin of limited() for the sync tools and course generation"""
+    breaker = get_breaker(provider)
+    breaker.before_call()
+    limiter = get_limiter(provider, model)
+    try:
+        limiter.acquire_sync(max_wait())
+    except BaseException:
+        breaker.on_abandoned(0.0)
+        raise
+    try:
+        result = call()
+    except Exception as e:
+        _on_error(provider, limiter, breaker, e)
+        raise
+    limiter.on_success()
+    breaker.on_success()
+    return result
+
+
+def limiter_stats() -> Dict[str, Dict[str, float]]:
+    return {
+        limiter.name: {"rate": round(limiter.rate, 3), "max_rate": limiter.max_rate}
+        for limiter in list(_limiters.values())
+    }
+
+
+class Overloaded(Exception):
+    """Raised by the admission controller when a request cannot be queued"""
+
+    def __init__(self, retry_after: int):
+        super().__init__(f"Service overloaded, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """
+    Bounded concurrency with a bounded queue in front of it. Retry-After is
+    estimated from the average request time and the queue ahead.
+    """
+
+    def __init__(self, max_in_flight: int, max_queue: int, queue_timeout: float):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self.queued = 0
+        self._avg_seconds = 5.0
+        self._slots = asyncio.Semaphore(max_in_flight)
+
+    def retry_after(self) -> int:
+        ahead = self.queued + 1
+        return max(1, math.ceil(self._avg_seconds * ahead / self.max_in_flight))
+
+    def check(self) -> None:
+        """Reject now if a new request could not even be queued"""
+        if self._slots.locked() and self.queued >= self.max_queue:
+            ERRORS.labels(component="admission_rejected").inc()
+            raise Overloaded(self.retry_after())
+
+    @asynccontextmanager
+    async def slot(self):
+        """Hold one of the in-flight slots, queueing for it if need be"""
+        if self._slots.locked():
+            self.check()
+            self.queued += 1
+            try:
+                await asyncio.wait_for(self._slots.acquire(), self.queue_timeout)
+            except asyncio.TimeoutError:
+                ERRORS.labels(component="admission_timeout").inc()
+                raise Overloaded(self.retry_after())
+            finally:
+                self.queued -= 1
+        else:
+            await self._slots.acquire()
+
+        self.in_flight += 1
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            self._slots.release()
+            # EWMA of request time, drives the Retry-After estimate
+            self._avg_seconds = 0.9 * self._avg_seconds + 0.1 * (time.monotonic() - start)
+
+
+_admission: Optional[AdmissionController] = None
+
+
+def get_admission() -> AdmissionController:
+    global _admission
+    if _admission is None:
+        _admission = AdmissionController(
+            max_in_flight=int(_env_float("TRIP_MAX_IN_FLIGHT", 64)),
+            max_queue=int(_env_float("TRIP_MAX_QUEUE", 128)),
+            queue_timeout=_env_float("TRIP_QUEUE_TIMEOUT_S", 10.0),
+        )
+    return _admission
@@ -0,0 +1,313 @@
+"""
+Cache for individual trip sections.
+
+Each section is keyed only on the preference fields it actually reads, so
+e.g. the weather for (Tokyo, April) is reused no matter what budget or
+interests the next traveller picks. Two backends are available:
+
+- memory: per-process LRU with a TTL and a size cap (default)
+- sqlite: a file shared by every uvicorn worker on the host
+
+Expired entries are kept for SECTION_CACHE_STALE_TTL more seconds. They are
+never served as hits, only as the last known good section while a
+provider's circuit breaker is open.
+
+The sqlite backend blocks, so async callers use the a* methods, which run it
+in a worker thread. Its reads stay reads: access times are batched and
+written at most every TOUCH_INTERVAL seconds, and eviction runs at most
+every EVICT_INTERVAL seconds, only once the table is over its size cap.
+
+Configuration (environment):
+    SECTION_CACHE_BACKEND      memory | sqlite | none   (default: memory)
+    SECTION_CACHE_TTL          seconds an entry stays fresh (default: 86400)
+    SECTION_CACHE_STALE_TTL    seconds an expired entry is kept as a fallback (default: 604800)
+    SECTION_CACHE_MAX_ENTRIES  size cap before eviction   (default: 1024)
+    SECTION_CACHE_PATH         sqlite file (default: .cache/sections.sqlite3)
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from typing import Any, Dict, Optional, Tuple
+
+from app.services.metrics import CACHE_LOOKUPS
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TTL = 24 * 60 * 60
+DEFAULT_STALE_TTL = 7 * 24 * 60 * 60
+DEFAULT_MAX_ENTRIES = 1024
+DEFAULT_SQLITE_PATH = os.path.join(".cache", "sections.sqlite3")
+# sqlite backend housekeeping: batched access times, periodic eviction (seconds)
+TOUCH_INTERVAL = 30
+EVICT_INTERVAL = 60
+
+_MISSING = object()
+
+
+class MemoryCache:
+    """
+    Thread-safe LRU cache with a per-entry TTL and a max number of entries.
+    Expired entries stay readable through get_stale() for `stale_ttl` seconds.
+    """
+
+    # Cheap enough to call on the event loop
+    blocking = False
+
+    def __init__(self, ttl: float = DEFAULT_TTL, max_entries: int = DEFAULT_MAX_ENTRIES, stale_ttl: float = 0.0):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.stale_ttl = stale_ttl
+        self._entries: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Any:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return _MISSING
+            expires_at, value = entry
+            now = time.time()
+            if expires_at < now:
+                if expires_at + self.stale_ttl < now:
+                    del self._entries[key]
+                return _MISSING
+            self._entries.move_to_end(key)
+            return value
+
+    def get_stale(self, key: str) -> Any:
+        """The entry even if expired, as long as it is within stale_ttl"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] + self.stale_ttl < time.time():
+                return _MISSING
+            return entry[1]
+
+    def set(self, key: str, value: Any) -> None:
+        with self._lock:
+            self._entries[key] = (time.time() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class SQLiteCache:
+    """
+    Persistent cache in a single SQLite file. WAL mode lets several worker
+    processes read while one writes. Eviction drops the least recently used
+    rows once the table grows past max_entries; it is checked periodically,
+    so the table may briefly exceed the cap.
+    """
+
+    blocking = True
+
+    def __init__(self, path: str = DEFAULT_SQLITE_PATH, ttl: float = DEFAULT_TTL,
+                 max_entries: int = DEFAULT_MAX_ENTRIES, stale_ttl: float = 0.0):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.stale_ttl = stale_ttl
+        self._lock = threading.Lock()
+        # key -> last read, written in one batch by _flush_touches
+        self._touched: Dict[str, float] = {}
+        self._touched_at = self._evicted_at = time.time()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=5, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS section_cache (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                expires_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )
+            """
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS section_cache_accessed ON section_cache (accessed_at)"
+        )
+
+    def get(self, key: str) -> Any:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, expires_at FROM section_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or row[1] < now:
+                # Expired rows are deleted by _evict
+                return _MISSING
+            self._touched[key] = now
+            if now - self._touched_at >= TOUCH_INTERVAL:
+                self._flush_touches(now)
+        return json.loads(row[0])
+
+    def get_stale(self, key: str) -> Any:
+        """The entry even if expired, as long as it is within stale_ttl"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM section_cache WHERE key = ? AND expires_at + ? >= ?",
+                (key, self.stale_ttl, time.time()),
+            ).fetchone()
+        return json.loads(row[0]) if row else _MISSING
+
+    def set(self, key: str, value: Any) -> None:
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO section_cache (key, value, expires_at, accessed_at) "
+                "VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value), now + self.ttl, now),
+            )
+            self._touched.pop(key, None)
+            if now - self._evicted_at >= EVICT_INTERVAL:
+                self._flush_touches(now)
+                self._evict(now)
+
+    def _flush_touches(self, now: float) -> None:
+        """Write the batched access times in one transaction; caller holds the lock"""
+        touched, self._touched = self._touched, {}
+        self._touched_at = now
+        if touched:
+            self._conn.executemany(
+                "UPDATE section_cache SET accessed_at = MAX(accessed_at, ?) WHERE key = ?",
+                [(accessed_at, key) for key, accessed_at in touched.items()],
+            )
+
+    def _evict(self, now: float) -> None:
+        """Drop rows past their stale window, then the least recently used over the cap"""
+        self._evicted_at = now
+        self._conn.execute("DELETE FROM section_cache WHERE expires_at + ? < ?", (self.stale_ttl, now))
+        count = self._conn.execute("SELECT COUNT(*) FROM section_cache").fetchone()[0]
+        if count > self.max_entries:
+            self._conn.execute(
+                "DELETE FROM section_cache WHERE key IN ("
+                "SELECT key FROM section_cache ORDER BY accessed_at ASC LIMIT ?)",
+                (count - self.max_entries,),
+            )
+
+    def clear(self) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM section_cache")
+            self._touched.clear()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM section_cache").fetchone()[0]
+
+
+class SectionCache:
+    """Section-aware front of a cache backend, keeps hit/miss counters per section"""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self._stats: Dict[str, Dict[str, int]] = defaultdict(lambda: {"hits": 0, "misses": 0})
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(section: str, inputs: Dict[str, Any]) -> str:
+        """Stable key from the section name and the inputs that section reads"""
+        payload = json.dumps(inputs, sort_keys=True, default=str)
+        digest = hashlib.sha256(payload.encode("utf-8")).hexdigest()
+        return f"{section}:{digest}"
+
+    def get(self, section: str, key: str) -> Tuple[bool, Any]:
+        value = self.backend.get(key) if self.backend is not None else _MISSING
+        hit = value is not _MISSING
+        with self._lock:
+            self._stats[section]["hits" if hit else "misses"] += 1
+        CACHE_LOOKUPS.labels(section=section, result="hit" if hit else "miss").inc()
+        return hit, (value if hit else None)
+
+    def get_stale(self, section: str, key: str) -> Tuple[bool, Any]:
+        """Last known good value, fresh or expired; counted as a `stale` lookup"""
+        value = self.backend.get_stale(key) if self.backend is not None else _MISSING
+        if value is _MISSING:
+            return False, None
+        CACHE_LOOKUPS.labels(section=section, result="stale").inc()
+        return True, value
+
+    def contains(self, key: str) -> bool:
+        """Fresh entry present; not counted as a lookup (used by the pre-warmer)"""
+        return self.backend is not None and self.backend.get(key) is not _MISSING
+
+    def set(self, key: str, value: Any) -> None:
+        if self.backend is not None:
+            self.backend.set(key, value)
+
+    async def _off_loop(self, method, *args):
+        """Run a cache method in a worker thread when the backend blocks"""
+        if getattr(self.backend, "blocking", False):
+            return await asyncio.to_thread(method, *args)
+        return method(*args)
+
+    async def aget(self, section: str, key: str) -> Tuple[bool, Any]:
+        return await self._off_loop(self.get, section, key)
+
+    async def aget_stale(self, section: str, key: str) -> Tuple[bool, Any]:
+        return await self._off_loop(self.get_stale, section, key)
+
+    async def acontains(self, key: str) -> bool:
+        return await self._off_loop(self.contains, key)
+
+    async def aset(self, key: str, value: Any) -> None:
+        await self._off_loop(self.set, key, value)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            sections = {name: dict(counts) for name, counts in self._stats.items()}
+        hits = sum(c["hits"] for c in sections.values())
+        misses = sum(c["misses"] for c in sections.values())
+        return {
+            "backend": type(self.backend).__name__ if self.backend is not None else None,
+            "entries": len(self.backend) if self.backend is not None else 0,
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": round(hits / (hits + misses), 4) if hits + misses else 0.0,
+            "sections": sections,
+        }
+
+
+_section_cache: Optional[SectionCache] = None
+_init_lock = threading.Lock()
+
+
+def _build_backend():
+    backend = os.getenv("SECTION_CACHE_BACKEND", "memory").strip().lower()
+    ttl = float(os.getenv("SECTION_CACHE_TTL", DEFAULT_TTL))
+    max_entries = int(os.getenv("SECTION_CACHE_MAX_ENTRIES", DEFAULT_MAX_ENTRIES))
+    stale_ttl = float(os.getenv("SECTION_CACHE_STALE_TTL", DEFAULT_STALE_TTL))
+    if backend == "none":
+        return None
+    if backend == "sqlite":
+        path = os.getenv("SECTION_CACHE_PATH", DEFAULT_SQLITE_PATH)
+        return SQLiteCache(path, ttl=ttl, max_entries=max_entries, stale_ttl=stale_ttl)
+    if backend != "memory":
+        logger.warning("Unknown SECTION_CACHE_BACKEND '%s', falling back to memory", backend)
+    return MemoryCache(ttl=ttl, max_entries=max_entries, stale_ttl=stale_ttl)
+
+
+def get_section_cache() -> SectionCache:
+    """Process-wide section cache, built from the environment on first use"""
+    global _section_cache
+    if _section_cache is None:
+        with _init_lock:
+            if _section_cache is None:
+                _section_cache = SectionCache(_build_backend())
+    return _section_cache
@@ -0,0 +1,182 @@
+"""
+Shared Serper search client.
+
+GoogleSerperAPIWrapper opens a new connection for every search. This client
+keeps one keep-alive httpx pool per process (async, plus a sync one for the
+sync tools), normalizes queries so trivially different spellings share a
+result, caches results for SERPER_CACHE_TTL seconds and lets concurrent
+callers of the same query share a single request. A popular destination's
+links then come from memory instead of an HTTPS round trip.
+
+Configuration (environment):
+    SERPER_API_KEY            required for real searches
+    SERPER_POOL_SIZE          max pooled connections      (default: 20)
+    SERPER_TIMEOUT_S          per-request timeout         (default: 10)
+    SERPER_CACHE_TTL          seconds, 0 disables caching (default: 21600)
+    SERPER_CACHE_MAX_ENTRIES  cached queries              (default: 1024)
+"""
+
+import asyncio
+import os
+import re
+import threading
+from typing import Any, Dict, Optional
+
+from app.services.metrics import CACHE_LOOKUPS
+from app.services.rate_limit import limited, limited_sync
+from app.services.section_cache import _MISSING, MemoryCache
+from app.services.singleflight import SingleFlight
+
+SERPER_URL = "https://google.serper.dev/search"
+DEFAULT_POOL_SIZE = 20
+DEFAULT_TIMEOUT = 10.0
+DEFAULT_CACHE_TTL = 6 * 60 * 60
+DEFAULT_CACHE_MAX_ENTRIES = 1024
+
+
+def normalize_query(query: str) -> str:
+    """Case, whitespace and stray punctuation do not change what Serper returns"""
+    query = re.sub(r"[^\w\s'&-]", " ", query.casefold())
+    return " ".join(query.split())
+
+
+class SerperClient:
+    """Drop-in for GoogleSerperAPIWrapper's results()/aresults()"""
+
+    def __init__(self, api_key: Optional[str] = None, pool_size: int = DEFAULT_POOL_SIZE,
+                 timeout: float = DEFAULT_TIMEOUT, cache_ttl: float = DEFAULT_CACHE_TTL,
+                 cache_max_entries: int = DEFAULT_CACHE_MAX_ENTRIES, num_results: int = 10):
+        self.api_key = api_key
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.num_results = num_results
+        self._cache = MemoryCache(ttl=cache_ttl, max_entries=cache_max_entries) if cache_ttl > 0 else None
+        self._flights = SingleFlight()
+        self._async_client = None
+        self._async_loop = None
+        self._sync_client = None
+        self._lock = threading.Lock()
+
+    def _http_settings(self) -> Dict[str, Any]:
+        import httpx
+
+        return {
+            "headers": {"X-API-KEY": self.api_key or "", "Content-Type": "application/json"},
+            "limits": httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size),
+            "timeout": self.timeout,
+        }
+
+    def _aclient(self):
+        # An AsyncClient belongs to the loop it was first used on
+        loop = asyncio.get_running_loop()
+        if self._async_client is None or self._async_loop is not loop:
+            import httpx
+
+            self._async_client = httpx.AsyncClient(**self._http_settings())
+            self._async_loop = loop
+        return self._async_client
+
+    def _client(self):
+        if self._sync_client is None:
+            with self._lock:
+                if self._sync_client is None:
+                    import httpx
+
+                    self._sync_client = httpx.Client(**self._http_settings())
+        return self._sync_client
+
+    def _payload(self, query: str) -> Dict[str, Any]:
+        return {"q": query, "num": self.num_results}
+
+    def _cached(self, query: str) -> Any:
+        if self._cache is None:
+            return _MISSING
+        value = self._cache.get(query)
+        CACHE_LOOKUPS.labels(section="serper_query", result="miss" if value is _MISSING else "hit").inc()
+        return value
+
+    def _store(self, query: str, results: Dict[str, Any]) -> None:
+        if self._cache is not None and results.get("organic"):
+            self._cache.set(query, results)
+
+    async def _afetch(self, query: str) -> Dict[str, Any]:
+        from app.services import fake_providers
+
+        if fake_providers.enabled("serper"):
+            return await limited("serper", "search", lambda: fake_providers.get_fake_serper().aresults(query))
+
+        async def post():
+            response = await self._aclient().post(SERPER_URL, json=self._payload(query))
+            response.raise_for_status()
+            return response.json()
+
+        return await limited("serper", "search", post)
+
+    def _fetch(self, query: str) -> Dict[str, Any]:
+        from app.services import fake_providers
+
+        if fake_providers.enabled("serper"):
+            return limited_sync("serper", "search", lambda: fake_providers.get_fake_serper().results(query))
+
+        def post():
+            response = self._client().post(SERPER_URL, json=self._payload(query))
+            response.raise_for_status()
+            return response.json()
+
+        return limited_sync("serper", "search", post)
+
+    async def aresults(self, query: str, **kwargs) -> Dict[str, Any]:
+        query = normalize_query(query)
+        cached = self._cached(query)
+        if cached is not _MISSING:
+            return cached
+
+        async def search():
+            results = await self._afetch(query)
+            self._store(query, results)
+            return results
+
+        return await self._flights.do(query, search)
+
+    def results(self, query: str, **kwargs) -> Dict[str, Any]:
+        query = normalize_query(query)
+        cached = self._cached(query)
+        if cached is not _MISSING:
+            return cached
+        results = self._fetch(query)
+        self._store(query, results)
+        return results
+
+    async def aclose(self) -> None:
+        if self._async_client is not None:
+            await self._async_client.aclose()
+            self._async_client = None
+        if self._sync_client is not None:
+            self._sync_client.close()
+            self._sync_client = None
+
+
+_serper_client: Optional[SerperClient] = None
+_init_lock = threading.Lock()
+
+
+def get_serper_client() -> SerperClient:
+    """Process-wide Serper client, configured from the environment on first use"""
+    global _serper_client
+    if _serper_client is None:
+        with _init_lock:
+            if _serper_client is None:
+                _serper_client = SerperClient(
+                    api_key=os.getenv("SERPER_API_KEY"),
+                    pool_size=int(os.getenv("SERPER_POOL_SIZE", DEFAULT_POOL_SIZE)),
+                    timeout=float(os.getenv("SERPER_TIMEOUT_S", DEFAULT_TIMEOUT)),
+                    cache_ttl=float(os.getenv("SERPER_CACHE_TTL", DEFAULT_CACHE_TTL)),
+                    cache_max_entries=int(os.getenv("SERPER_CACHE_MAX_ENTRIES", DEFAULT_CACHE_MAX_ENTRIES)),
+                )
+    return _serper_client
+
+
+async def aclose_serper_client() -> None:
+    """Close the pooled connections, call from the FastAPI lifespan on shutdown"""
+    if _serper_client is not None:
+        await _serper_client.aclose()
@@ -0,0 +1,58 @@
+"""
+Single-flight coalescing of identical in-flight async work.
+
+When many callers ask for the same thing at once (a trending destination),
+only the first one starts the computation; the rest await the same task.
+The key is forgotten as soon as the task finishes, so this only dedupes work
+that overlaps in time - reuse across time is the section cache's job.
+"""
+
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable
+
+
+class _Call:
+    __slots__ = ("task", "waiters")
+
+    def __init__(self, task: "asyncio.Task"):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    Errors raised by the shared computation propagate to every waiter.
+    A caller that is cancelled only stops waiting; the shared task keeps
+    running for the others and is cancelled once nobody is waiting anymore.
+    """
+
+    def __init__(self):
+        self._calls: Dict[Hashable, _Call] = {}
+
+    def in_flight(self) -> int:
+        return len(self._calls)
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        call = self._calls.get(key)
+        if call is None or call.task.done():
+            call = _Call(asyncio.ensure_future(fn()))
+            self._calls[key] = call
+            call.task.add_done_callback(lambda _task, key=key, call=call: self._forget(key, call))
+
+        call.waiters += 1
+        try:
+            return await asyncio.shield(call.task)
+        except asyncio.CancelledError:
+            if not call.task.done() and call.waiters == 1:
+                # Last interested caller went away, stop the upstream work too
+                call.task.cancel()
+            raise
+        finally:
+            call.waiters -= 1
+
+    def _forget(self, key: Hashable, call: _Call) -> None:
+        if self._calls.get(key) is call:
+            del self._calls[key]
+        if not call.task.cancelled():
+            # Mark the error retrieved even if every waiter already gave up
+            call.task.exception()
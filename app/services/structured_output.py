@@ -0,0 +1,248 @@
+"""
+Structured (JSON) model output without regenerating on every formatting slip.
+
+Model output goes through three steps, cheapest first:
+
+1. parse as-is, after cutting away code fences and prose around the JSON
+2. local repair: trailing commas are dropped and truncated output is cut back
+   to the last complete value, with the open strings, arrays and objects
+   closed
+3. only if that still does not validate, a short re-ask: the broken output
+   and the error go back to the model with a request for corrected JSON,
+   which costs far less than generating the whole answer again
+
+The same scanner works incrementally: IncrementalJSONParser takes streamed
+chunks and can return the object as far as it has arrived at any point.
+Outcomes are counted in trip_structured_output_parses_total.
+"""
+
+import json
+import logging
+from typing import Any, Awaitable, Callable, List, Optional, Tuple, Type, TypeVar
+
+from pydantic import BaseModel, ValidationError
+
+from app.services.metrics import STRUCTURED_PARSES
+
+logger = logging.getLogger(__name__)
+
+M = TypeVar("M", bound=BaseModel)
+
+_CLOSERS = {"{": "}", "[": "]"}
+
+
+class StructuredOutputError(ValueError):
+    """Model output could not be turned into the expected schema"""
+
+
+class IncrementalJSONParser:
+    """
+    Single-pass JSON scanner fed chunk by chunk. Text before the first `{` or
+    `[` (prose, an opening code fence) and after the top-level value closes is
+    ignored; commas directly before `}` or `]` are dropped. snapshot() returns
+    the document as far as it is complete.
+    """
+
+    def __init__(self):
+        self._out: List[str] = []
+        self._stack: List[str] = []
+        self._started = False
+        self._done = False
+        self._in_string = False
+        self._escape = False
+        self._string_is_key = False
+        self._comma_at: Optional[int] = None
+        self._last = ""
+        self._changed = False
+        # Longest prefix of _out that is complete JSON once the containers open
+        # at that point are closed, and those closers
+        self._safe = (0, "")
+
+    @property
+    def done(self) -> bool:
+        """True once the top-level value has closed"""
+        return self._done
+
+    @property
+    def repaired(self) -> bool:
+        """True when something had to be dropped or closed to get valid JSON"""
+        return self._changed or not self._done
+
+    def _mark_safe(self) -> None:
+        closers = "".join(_CLOSERS[c] for c in reversed(self._stack))
+        self._safe = (len(self._out), closers)
+
+    def feed(self, chunk: str) -> None:
+        for char in chunk:
+            if self._done:
+                return
+            if not self._started:
+                if char in "{[":
+                    self._started = True
+                    self._last = char
+                    self._stack.append(char)
+                    self._out.append(char)
+                    self._mark_safe()
+                continue
+
+            if self._in_string:
+                self._out.append(char)
+                if self._escape:
+                    self._escape = False
+                elif char == "\\":
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+                    self._last = '"'
+                    if not self._string_is_key:
+                        self._mark_safe()
+                continue
+
+            if char.isspace():
+                self._out.append(char)
+                continue
+
+            last, self._last = self._last, char
+
+            if self._comma_at is not None:
+                if char in "}]":
+                    # Trailing comma, e.g. `[1, 2,]`
+                    del self._out[self._comma_at]
+                    self._changed = True
+                self._comma_at = None
+
+            if char == ",":
+                self._mark_safe()
+                self._comma_at = len(self._out)
+                self._out.append(char)
+            elif char == '"':
+                # A string right after `{` or `,` inside an object is a key
+                self._string_is_key = self._stack[-1] == "{" and last in "{,"
+                self._in_string = True
+                self._out.append(char)
+            elif char in "{[":
+                self._stack.append(char)
+                self._out.append(char)
+                self._mark_safe()
+            elif char in "}]":
+                if self._stack:
+                    self._stack.pop()
+                self._out.append(char)
+                self._mark_safe()
+                if not self._stack:
+                    self._done = True
+            else:
+                self._out.append(char)
+
+    def text(self, partial_strings: bool = False) -> Optional[str]:
+        """
+        The JSON so far, closed up to be parseable. With partial_strings a
+        value string still being written is kept (closed where it stops),
+        otherwise the document is cut back to the last complete value.
+        """
+        if not self._started:
+            return None
+        if self._done:
+            return "".join(self._out)
+        if partial_strings and self._in_string and not self._string_is_key:
+            body = "".join(self._out)
+            if self._escape:
+                body = body[:-1]
+            closers = "".join(_CLOSERS[c] for c in reversed(self._stack))
+            return body + '"' + closers
+        length, closers = self._safe
+        return "".join(self._out[:length]) + closers
+
+    def snapshot(self, partial_strings: bool = False) -> Any:
+        """The parsed document so far, None before anything usable arrived"""
+        text = self.text(partial_strings)
+        if text is None:
+            return None
+        try:
+            return json.loads(text, strict=False)
+        except json.JSONDecodeError:
+            return None
+
+
+def repair_json(text: str, partial_strings: bool = False) -> Tuple[Optional[str], bool]:
+    """Locally repaired JSON for `text` and whether any repair was needed"""
+    parser = IncrementalJSONParser()
+    parser.feed(text)
+    return parser.text(partial_strings), parser.repaired
+
+
+def _validate(text: str, schema: Type[M]) -> Tuple[M, bool]:
+    repaired_text, repaired = repair_json(text)
+    if repaired_text is None:
+        raise StructuredOutputError("no JSON object found in the model output")
+    try:
+        data = json.loads(repaired_text, strict=False)
+        return schema.model_validate(data), repaired
+    except (json.JSONDecodeError, ValidationError) as e:
+        raise StructuredOutputError(str(e)) from e
+
+
+def _count(schema: Type[BaseModel], outcome: str) -> None:
+    STRUCTURED_PARSES.labels(schema=schema.__name__, outcome=outcome).inc()
+
+
+def parse_structured(text: str, schema: Type[M]) -> M:
+    """Parse with local repair only, raise StructuredOutputError on failure"""
+    try:
+        result, repaired = _validate(text, schema)
+    except StructuredOutputError:
+        _count(schema, "failed")
+        raise
+    _count(schema, "repaired" if repaired else "clean")
+    return result
+
+
+def reask_prompt(text: str, error: Exception, format_instructions: str) -> str:
+    """Prompt asking the model to fix its own output, instead of starting over"""
+    return f"""
+Your previous answer could not be parsed.
+
+Error: {error}
+
+Previous answer:
+{text}
+
+Return the corrected answer only, as JSON matching this schema:
+{format_instructions}
+"""
+
+
+def _after_reask(fixed: str, schema: Type[M]) -> M:
+    try:
+        result, _ = _validate(fixed, schema)
+    except StructuredOutputError:
+        _count(schema, "failed")
+        raise
+    _count(schema, "reasked")
+    return result
+
+
+def parse_or_reask(text: str, schema: Type[M], reask: Callable[[str], str], format_instructions: str) -> M:
+    """
+    Local parse first; if that fails, one re-ask through `reask(prompt) -> text`.
+    Each call counts once, as clean, repaired, reasked or failed.
+    """
+    try:
+        result, repaired = _validate(text, schema)
+    except StructuredOutputError as e:
+        logger.warning("%s output needs a re-ask: %s", schema.__name__, e)
+        return _after_reask(reask(reask_prompt(text, e, format_instructions)), schema)
+    _count(schema, "repaired" if repaired else "clean")
+    return result
+
+
+async def aparse_or_reask(text: str, schema: Type[M], reask: Callable[[str], Awaitable[str]],
+                          format_instructions: str) -> M:
+    """Async parse_or_reask"""
+    try:
+        result, repaired = _validate(text, schema)
+    except StructuredOutputError as e:
+        logger.warning("%s output needs a re-ask: %s", schema.__name__, e)
+        return _after_reask(await reask(reask_prompt(text, e, format_instructions)), schema)
+    _count(schema, "repaired" if repaired else "clean")
+    return result
@@ -0,0 +1,161 @@
+"""
+Token accounting and prompt budgets for the Gemini calls.
+
+Every call records its input and output tokens, taken from the response's
+usage_metadata or, when the provider reports none, estimated locally from
+the text (about four characters a token). The counts go to the
+trip_llm_tokens_total counter and to the current request's collector, which
+the routes return as TripResponse.token_usage. Like the Server-Timing
+collector, a call is billed to the request that made it: cache hits and
+calls shared with an identical request in flight cost nothing.
+
+Budgets keep prompts and answers small, which is both latency and cost:
+output is capped per tool, and context copied from another section (the
+itinerary in the activities prompt) is condensed to an outline once it is
+larger than the tool's input budget.
+
+Configuration (environment), <TOOL> is the tool name, e.g. RECOMMEND_ACTIVITIES
+or SINGLE_SHOT:
+    TRIP_MAX_OUTPUT_TOKENS          output cap for every call        (default: none)
+    TRIP_MAX_OUTPUT_TOKENS_<TOOL>   output cap for one tool          (default: TRIP_MAX_OUTPUT_TOKENS)
+    TRIP_INPUT_BUDGET               context tokens a prompt may copy (default: none)
+    TRIP_INPUT_BUDGET_<TOOL>        the same for one tool            (default: 600 for recommend_activities)
+"""
+
+import contextvars
+import os
+import re
+from typing import Any, Dict, Optional
+
+from app.services.metrics import LLM_TOKENS
+
+# Rough size of a token in English text, good enough for budgets and estimates
+CHARS_PER_TOKEN = 4
+DEFAULT_INPUT_BUDGETS = {"recommend_activities": 600}
+# Bullets kept in an outline are clipped to this many characters
+OUTLINE_LINE_CHARS = 80
+
+_DAY_LINE = re.compile(r"^[#*_\s]*day\s*\d", re.IGNORECASE)
+
+_usage: contextvars.ContextVar[Optional[Dict[str, Any]]] = contextvars.ContextVar(
+    "trip_token_usage", default=None
+)
+
+
+def _env_tokens(name: str, default: Optional[int]) -> Optional[int]:
+    value = os.getenv(name, "").strip()
+    if not value:
+        return default
+    try:
+        tokens = int(value)
+    except ValueError:
+        return default
+    # 0 or less switches the budget off
+    return tokens if tokens > 0 else None
+
+
+def max_output_tokens(tool_name: str) -> Optional[int]:
+    """Output cap for one tool's calls, None when uncapped"""
+    default = _env_tokens("TRIP_MAX_OUTPUT_TOKENS", None)
+    return _env_tokens(f"TRIP_MAX_OUTPUT_TOKENS_{tool_name.upper()}", default)
+
+
+def input_budget(tool_name: str) -> Optional[int]:
+    """Tokens of copied context a tool's prompt may carry, None when unlimited"""
+    default = _env_tokens("TRIP_INPUT_BUDGET", DEFAULT_INPUT_BUDGETS.get(tool_name))
+    return _env_tokens(f"TRIP_INPUT_BUDGET_{tool_name.upper()}", default)
+
+
+def llm_settings(tool_name: str) -> Dict[str, Any]:
+    """get_chat_model() settings for a tool"""
+    limit = max_output_tokens(tool_name)
+    return {"max_output_tokens": limit} if limit else {}
+
+
+def estimate_tokens(text: str) -> int:
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def fit(text: str, budget: Optional[int]) -> str:
+    """`text` cut at a line boundary to about `budget` tokens"""
+    if budget is None or estimate_tokens(text) <= budget:
+        return text
+    cut = text[:budget * CHARS_PER_TOKEN]
+    if "\n" in cut:
+        cut = cut[:cut.rindex("\n")]
+    return cut.rstrip() + "\n..."
+
+
+def itinerary_outline(itinerary: str, budget: Optional[int]) -> str:
+    """
+    The itinerary as is when it fits the budget, else a condensed outline:
+    headings, day lines and clipped bullets, then headings and day lines only,
+    then cut to the budget.
+    """
+    if budget is None or estimate_tokens(itinerary) <= budget:
+        return itinerary
+    structure, bullets = [], []
+    for line in itinerary.splitlines():
+        line = line.strip()
+        if line.startswith("#") or _DAY_LINE.match(line):
+            structure.append(line)
+            bullets.append(line)
+        elif line.startswith(("-", "*", "•")):
+            clipped = line if len(line) <= OUTLINE_LINE_CHARS else line[:OUTLINE_LINE_CHARS].rstrip() + "..."
+            bullets.append(clipped)
+    for lines in (bullets, structure):
+        outline = "\n".join(lines)
+        if outline and estimate_tokens(outline) <= budget:
+            return outline
+    return fit("\n".join(structure) or itinerary, budget)
+
+
+def start_token_usage() -> Dict[str, Any]:
+    """Begin collecting token counts for the current request (and the tasks it spawns)"""
+    usage: Dict[str, Any] = {"input_tokens": 0, "output_tokens": 0, "calls": 0, "estimated_calls": 0, "by_tool": {}}
+    _usage.set(usage)
+    return usage
+
+
+def current_token_usage() -> Optional[Dict[str, Any]]:
+    return _usage.get()
+
+
+def _text(value: Any) -> str:
+    if isinstance(value, str):
+        return value
+    if isinstance(value, (list, tuple)):
+        return "\n".join(_text(item) for item in value)
+    content = getattr(value, "content", None)
+    if content is not None:
+        return _text(content)
+    return str(value)
+
+
+def record_usage(operation: str, prompt: Any, message: Any) -> None:
+    """
+    Count one finished call. The provider's usage_metadata is used when it
+    has any, else both sides are estimated from the prompt and the answer.
+    """
+    metadata = getattr(message, "usage_metadata", None) or {}
+    if metadata.get("input_tokens") or metadata.get("output_tokens"):
+        source = "reported"
+        input_tokens = metadata.get("input_tokens", 0)
+        output_tokens = metadata.get("output_tokens", 0)
+    else:
+        source = "estimated"
+        input_tokens = estimate_tokens(_text(prompt))
+        output_tokens = estimate_tokens(_text(message))
+    LLM_TOKENS.labels(operation=operation, direction="input", source=source).inc(input_tokens)
+    LLM_TOKENS.labels(operation=operation, direction="output", source=source).inc(output_tokens)
+
+    usage = _usage.get()
+    if usage is None:
+        return
+    tool = usage["by_tool"].setdefault(operation, {"input_tokens": 0, "output_tokens": 0, "calls": 0})
+    for counts in (usage, tool):
+        counts["input_tokens"] += input_tokens
+        counts["output_tokens"] += output_tokens
+        counts["calls"] += 1
+    if source == "estimated":
+        usage["estimated_calls"] += 1
@@ -4,6 +4,11 @@ from .all_tools import (
     generate_itinerary,
     fetch_useful_links,
     food_culture_recommender,
+    arecommend_activities,
+    aweather_forecaster,
+    agenerate_itinerary,
+    afetch_useful_links,
+    afood_culture_recommender,
 )
 
 __all__ = [
@@ -12,4 +17,9 @@ __all__ = [
     "generate_itinerary",
     "fetch_useful_links",
     "food_culture_recommender",
+    "arecommend_activities",
+    "aweather_forecaster",
+    "agenerate_itinerary",
+    "afetch_useful_links",
+    "afood_culture_recommender",
 ]
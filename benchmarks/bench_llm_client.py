@@ -0,0 +1,48 @@
+"""
+Microbenchmark: per-call cost of building a fresh ChatGoogleGenerativeAI
+(what get_llm() used to do) versus looking it up in the shared registry.
+
+No request is sent, so no real API key is needed:
+
+    python -m benchmarks.bench_llm_client --iterations 200
+"""
+
+import argparse
+import os
+import time
+
+from langchain_google_genai import ChatGoogleGenerativeAI
+
+from app.services.llm_client import DEFAULT_MODEL, get_chat_model
+
+
+def _time_per_call(fn, iterations: int) -> float:
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (time.perf_counter() - start) / iterations
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=200)
+    args = parser.parse_args()
+
+    os.environ.setdefault("GOOGLE_API_KEY", "benchmark-key")
+    api_key = os.environ["GOOGLE_API_KEY"]
+
+    fresh = _time_per_call(
+        lambda: ChatGoogleGenerativeAI(model=DEFAULT_MODEL, google_api_key=api_key),
+        args.iterations,
+    )
+    get_chat_model()  # warm the registry once, like the first request would
+    pooled = _time_per_call(get_chat_model, args.iterations)
+
+    print(f"fresh client per call : {fresh * 1e6:10.1f} us")
+    print(f"shared registry lookup: {pooled * 1e6:10.1f} us")
+    print(f"saved per call        : {(fresh - pooled) * 1e6:10.1f} us ({fresh / pooled:.0f}x)")
+    print(f"saved per trip (4 LLM calls): {(fresh - pooled) * 4e3:.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""
+Concurrency check for request coalescing: fire N identical /trip/generate
+requests at once against a slow, counting stand-in for Gemini and Serper,
+then report how many upstream calls each section made. With single-flight
+in place every section should be called exactly once.
+
+    python -m benchmarks.bench_singleflight --requests 50 --latency 0.3
+"""
+
+import argparse
+import asyncio
+import os
+import time
+from collections import Counter
+
+import httpx
+from langchain_core.messages import AIMessage
+
+_SECTION_MARKERS = {
+    "create a detailed itinerary": "generate_itinerary",
+    "detailed weather forecast": "weather_forecaster",
+    "suggest unique local activities": "recommend_activities",
+    "'Food & Dining'": "food_culture_recommender",
+}
+
+
+class CountingLLM:
+    def __init__(self, latency: float, calls: Counter):
+        self.latency = latency
+        self.calls = calls
+
+    async def ainvoke(self, messages, *args, **kwargs):
+        prompt = messages[-1].content
+        section = next((name for marker, name in _SECTION_MARKERS.items() if marker in prompt), "unknown")
+        self.calls[section] += 1
+        await asyncio.sleep(self.latency)
+        return AIMessage(content=f"{section} result")
+
+
+class CountingSerper:
+    latency = 0.0
+    calls: Counter = Counter()
+
+    async def aresults(self, query, **kwargs):
+        self.calls["fetch_useful_links"] += 1
+        await asyncio.sleep(self.latency)
+        return {"organic": [{"title": query, "link": "https://example.com"}]}
+
+
+async def run(requests: int, latency: float) -> Counter:
+    os.environ["GOOGLE_API_KEY"] = "benchmark-key"
+    os.environ["SERPER_API_KEY"] = "benchmark-key"
+    os.environ["SECTION_CACHE_BACKEND"] = "none"
+
+    from app.main import app
+    from app.tools import all_tools
+
+    calls: Counter = Counter()
+    llm = CountingLLM(latency, calls)
+    CountingSerper.latency = latency
+    CountingSerper.calls = calls
+    all_tools.get_llm = lambda *a, **k: llm
+    all_tools._serper_search = CountingSerper
+
+    payload = {"preferences": {"destination": "Tokyo", "month": "April", "interests": ["food", "anime"]}}
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        start = time.perf_counter()
+        responses = await asyncio.gather(
+            *[client.post("/trip/generate", json=payload) for _ in range(requests)]
+        )
+        elapsed = time.perf_counter() - start
+
+    statuses = Counter(r.status_code for r in responses)
+    print(f"{requests} identical requests in {elapsed:.2f}s, statuses: {dict(statuses)}")
+    return calls
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0.3, help="seconds per upstream call")
+    args = parser.parse_args()
+
+    calls = asyncio.run(run(args.requests, args.latency))
+    for section in sorted(calls):
+        print(f"  {section:26s} upstream calls: {calls[section]}")
+    # Every section must be counted: a tool that fell back to mock data makes
+    # no upstream call at all and would otherwise pass unnoticed
+    expected = set(_SECTION_MARKERS.values()) | {"fetch_useful_links"}
+    wrong = {section: calls.get(section, 0) for section in expected | set(calls) if calls.get(section, 0) != 1}
+    if wrong:
+        raise SystemExit(f"expected exactly one upstream call per section, got {wrong}")
+    print("ok: one upstream call per section")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+"""
+Cold-start benchmark: how long a fresh interpreter takes to import app.main,
+which is what every uvicorn worker (and every serverless cold start) pays
+before it can accept a request. Each run uses a new subprocess so nothing
+is served from an already-populated sys.modules.
+
+    python -m benchmarks.bench_startup --runs 5
+    python -m benchmarks.bench_startup --runs 5 --top 15   # slowest imports too
+"""
+
+import argparse
+import statistics
+import subprocess
+import sys
+
+_SNIPPET = "import time; t = time.perf_counter(); import app.main; print(time.perf_counter() - t)"
+
+
+def _import_seconds() -> float:
+    out = subprocess.run(
+        [sys.executable, "-c", _SNIPPET], check=True, capture_output=True, text=True
+    ).stdout
+    return float(out.strip().splitlines()[-1])
+
+
+def _slowest_imports(top: int):
+    """Parse `python -X importtime` output, cumulative microseconds per module"""
+    err = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import app.main"],
+        check=True, capture_output=True, text=True,
+    ).stderr
+    rows = []
+    for line in err.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        rows.append((int(cumulative), name.rstrip()))
+    return sorted(rows, reverse=True)[:top]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=0, help="also list the N slowest imports")
+    args = parser.parse_args()
+
+    times = [_import_seconds() for _ in range(args.runs)]
+    print(f"import app.main over {args.runs} cold runs: "
+          f"median {statistics.median(times) * 1000:.0f} ms, "
+          f"min {min(times) * 1000:.0f} ms, max {max(times) * 1000:.0f} ms")
+
+    if args.top:
+        print(f"\nslowest {args.top} imports (cumulative):")
+        for cumulative, name in _slowest_imports(args.top):
+            print(f"  {cumulative / 1000:8.1f} ms  {name}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,255 @@
+"""
+Offline load test against the fake Gemini / Serper backends
+(app/services/fake_providers.py). Drives POST /trip/generate in-process and
+build_whole_fucking_course (or its async twin) at each concurrency level,
+then reports throughput, latency percentiles and peak memory. Results are
+written as JSON, tagged with the current commit, so runs can be compared
+across commits.
+
+    python -m benchmarks.load_test --concurrency 1,8,32 --requests 64
+    python -m benchmarks.load_test --target course --latency-ms 1200 --error-rate 0.05
+    python -m benchmarks.load_test --target course --course-mode sync
+    python -m benchmarks.load_test --compare benchmarks/results/<earlier>.json
+
+Each trip request uses a different destination, distinct after
+canonicalization too, so the section cache and single-flight do not hide
+the upstream cost; pass --repeat-destination to
+measure the coalesced case instead.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+_DESTINATIONS = ["Tokyo", "Lisbon", "Mexico City", "Cape Town", "Hanoi", "Reykjavik", "Lima", "Seoul"]
+
+
+def _configure(args) -> None:
+    """Set the fake-provider environment before the app is imported"""
+    os.environ["TRIP_FAKE_PROVIDERS"] = "all"
+    os.environ["FAKE_LLM_LATENCY_MS"] = str(args.latency_ms)
+    os.environ["FAKE_LLM_LATENCY_SIGMA"] = str(args.latency_sigma)
+    os.environ["FAKE_LLM_ERROR_RATE"] = str(args.error_rate)
+    os.environ["FAKE_LLM_429_RATE"] = str(args.rate_limit_rate)
+    os.environ["FAKE_LLM_OUTPUT_SIZE"] = str(args.output_chars)
+    os.environ["FAKE_SERPER_LATENCY_MS"] = str(args.serper_latency_ms)
+    os.environ["FAKE_SERPER_ERROR_RATE"] = str(args.error_rate)
+    os.environ["FAKE_SERPER_429_RATE"] = str(args.rate_limit_rate)
+    if args.seed is not None:
+        os.environ["FAKE_SEED"] = str(args.seed)
+    # Measure the pipeline, not the limits meant for production quotas;
+    # export these yourself to benchmark with them in place
+    os.environ.setdefault("SECTION_CACHE_BACKEND", "none")
+    os.environ.setdefault("SERPER_CACHE_TTL", "0")
+    # A fresh course store per run, checkpoints from earlier runs would skip the work
+    os.environ["COURSE_STORE_PATH"] = os.path.join(tempfile.mkdtemp(prefix="load-test-"), "courses.sqlite3")
+    os.environ.setdefault("GEMINI_RATE_LIMIT_RPS", "100000")
+    os.environ.setdefault("SERPER_RATE_LIMIT_RPS", "100000")
+    os.environ.setdefault("TRIP_MAX_IN_FLIGHT", "100000")
+    os.environ.setdefault("LOG_LEVEL", "ERROR")
+
+
+def _percentile(sorted_values: List[float], pct: float) -> float:
+    """Nearest-rank percentile"""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, round(pct / 100 * len(sorted_values)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def _peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def _summary(target: str, concurrency: int, latencies: List[float], outcomes: Counter,
+             elapsed: float, upstream_calls: Dict[str, int]) -> dict:
+    ordered = sorted(latencies)
+    return {
+        "target": target,
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "outcomes": dict(outcomes),
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(len(latencies) / elapsed, 3) if elapsed else 0.0,
+        "latency_ms": {
+            "p50": round(_percentile(ordered, 50) * 1000, 1),
+            "p95": round(_percentile(ordered, 95) * 1000, 1),
+            "p99": round(_percentile(ordered, 99) * 1000, 1),
+            "mean": round(statistics.fmean(ordered) * 1000, 1) if ordered else 0.0,
+            "max": round(ordered[-1] * 1000, 1) if ordered else 0.0,
+        },
+        "upstream_calls": upstream_calls,
+        "peak_rss_mb": _peak_rss_mb(),
+    }
+
+
+async def _drive(concurrency: int, requests: int, call) -> tuple:
+    """Run `call(i)` for i in range(requests), at most `concurrency` at a time"""
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies: List[float] = []
+    outcomes: Counter = Counter()
+
+    async def one(i: int) -> None:
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                outcomes[await call(i)] += 1
+            except Exception as e:
+                outcomes[type(e).__name__] += 1
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[one(i) for i in range(requests)])
+    return latencies, outcomes, time.perf_counter() - start
+
+
+async def run_trip(concurrency: int, requests: int, repeat_destination: bool) -> dict:
+    import httpx
+    from app.agents.trip_agent import get_trip_agent
+    from app.main import app
+    from app.services import fake_providers
+
+    get_trip_agent()
+    fake_providers.reset_fakes()
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+        async def call(i: int) -> str:
+            # The numbered qualifier survives canonicalization ("Lima, Stop 9"),
+            # a bare suffix ("Lima 9") would be fuzzy-matched back onto "Lima"
+            destination = "Tokyo" if repeat_destination else f"{_DESTINATIONS[i % len(_DESTINATIONS)]}, Stop {i}"
+            payload = {"preferences": {"destination": destination, "month": "April", "interests": ["food"]}}
+            response = await client.post("/trip/generate", json=payload)
+            if response.status_code != 200:
+                return f"http_{response.status_code}"
+            return response.json().get("status", "success")
+
+        latencies, outcomes, elapsed = await _drive(concurrency, requests, call)
+    return _summary("trip", concurrency, latencies, outcomes, elapsed, fake_providers.fake_call_counts())
+
+
+async def run_course(concurrency: int, requests: int, mode: str) -> dict:
+    from app.services import fake_providers
+    from app.services.course_generate import abuild_whole_fucking_course, build_whole_fucking_course
+
+    fake_providers.reset_fakes()
+
+    async def call(i: int) -> str:
+        inputs = {
+            "course_title": f"Python course {i}",
+            "description": "Practical Python for data work",
+            "knowledge": "basic programming",
+            "difficulty": "beginner",
+            "experience": "1",
+        }
+        if mode == "async":
+            await abuild_whole_fucking_course(**inputs)
+        else:
+            # The sync builder blocks, run it on a worker thread like a sync route would
+            await asyncio.to_thread(build_whole_fucking_course, **inputs)
+        return "success"
+
+    latencies, outcomes, elapsed = await _drive(concurrency, requests, call)
+    return _summary("course", concurrency, latencies, outcomes, elapsed, fake_providers.fake_call_counts())
+
+
+def _commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], check=True, capture_output=True, text=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _print_result(result: dict) -> None:
+    latency = result["latency_ms"]
+    print(
+        f"{result['target']:6s} c={result['concurrency']:<4d} n={result['requests']:<5d} "
+        f"{result['throughput_rps']:8.2f} req/s  p50 {latency['p50']:8.1f}  p95 {latency['p95']:8.1f}  "
+        f"p99 {latency['p99']:8.1f} ms  rss {result['peak_rss_mb']} MB  {result['outcomes']}"
+    )
+
+
+def _compare(previous_path: str, current: dict) -> None:
+    with open(previous_path) as f:
+        previous = json.load(f)
+    before = {(r["target"], r["concurrency"]): r for r in previous["results"]}
+    print(f"\ncompared with {previous.get('commit')} ({previous_path}):")
+    for result in current["results"]:
+        old = before.get((result["target"], result["concurrency"]))
+        if old is None:
+            continue
+        print(
+            f"{result['target']:6s} c={result['concurrency']:<4d} "
+            f"throughput {old['throughput_rps']:.2f} -> {result['throughput_rps']:.2f} req/s, "
+            f"p95 {old['latency_ms']['p95']:.1f} -> {result['latency_ms']['p95']:.1f} ms"
+        )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--target", choices=["trip", "course", "both"], default="both")
+    parser.add_argument("--concurrency", default="1,8,32", help="comma separated levels")
+    parser.add_argument("--requests", type=int, default=32, help="requests per level")
+    parser.add_argument("--latency-ms", type=float, default=800, help="median fake LLM latency")
+    parser.add_argument("--latency-sigma", type=float, default=0.5, help="log-normal spread")
+    parser.add_argument("--serper-latency-ms", type=float, default=300)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="fraction of calls answering 429")
+    parser.add_argument("--output-chars", type=int, default=1500, help="characters per LLM response")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--course-mode", choices=["sync", "async"], default="async",
+                        help="build_whole_fucking_course on a thread, or abuild_whole_fucking_course")
+    parser.add_argument("--repeat-destination", action="store_true", help="same trip every request")
+    parser.add_argument("--output", default=None, help="JSON results path")
+    parser.add_argument("--compare", default=None, help="earlier JSON results to diff against")
+    args = parser.parse_args()
+
+    _configure(args)
+    levels = [int(level) for level in args.concurrency.split(",") if level.strip()]
+    targets = ["trip", "course"] if args.target == "both" else [args.target]
+
+    results = []
+    for target in targets:
+        for level in levels:
+            if target == "trip":
+                result = asyncio.run(run_trip(level, args.requests, args.repeat_destination))
+            else:
+                result = asyncio.run(run_course(level, args.requests, args.course_mode))
+            _print_result(result)
+            results.append(result)
+
+    commit = _commit()
+    report = {
+        "commit": commit,
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": sys.version.split()[0],
+        "config": {k: v for k, v in vars(args).items() if k not in ("output", "compare")},
+        "results": results,
+    }
+    output = args.output or os.path.join(
+        "benchmarks", "results", f"load-{datetime.now():%Y%m%d-%H%M%S}-{commit or 'nogit'}.json"
+    )
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nresults written to {output}")
+
+    if args.compare:
+        _compare(args.compare, report)
+
+
+if __name__ == "__main__":
+    main()